@@ -0,0 +1,303 @@
+/*
+ * CPython extension wrapping the generated PIDController_step. The model and its
+ * state live in the Python object, so stepping is one direct C call without any
+ * argument marshalling through ctypes. Built by setup.py as _pidcontroller.
+ */
+
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include "PIDController.h"
+
+typedef struct {
+  PyObject_HEAD
+  RT_MODEL_PIDController_T model;
+  DW_PIDController_T dwork;
+  real_T pGain;
+  real_T iGain;
+  real_T dGain;
+  real_T filterCoeff;
+  real_T upperLimit;
+  real_T lowerLimit;
+  real_T output;
+} PidControllerObject;
+
+static void PidController_initializeModel(PidControllerObject *self)
+{
+  real_T u, p, i, d, n, i0, d0, upper, lower, ts;
+  self->model.errorStatus = NULL;
+  self->model.dwork = &self->dwork;
+  /* Only the states matter, the zeroed inputs are passed explicitly on every step */
+  PIDController_initialize(&self->model, &u, &p, &i, &d, &n, &i0, &d0, &upper,
+    &lower, &ts, &self->output);
+}
+
+static int PidController_init(PidControllerObject *self, PyObject *args,
+  PyObject *kwds)
+{
+  static char *kwlist[] = { "pGain", "iGain", "dGain", "filterCoeff",
+    "upperLimit", "lowerLimit", NULL };
+  if (!PyArg_ParseTupleAndKeywords(args, kwds, "dddddd", kwlist, &self->pGain,
+       &self->iGain, &self->dGain, &self->filterCoeff, &self->upperLimit,
+       &self->lowerLimit)) {
+    return -1;
+  }
+
+  PidController_initializeModel(self);
+  return 0;
+}
+
+static inline real_T PidController_stepOnce(PidControllerObject *self, real_T
+  error, real_T sampleTime)
+{
+  PIDController_step(&self->model, error, self->pGain, self->iGain, self->dGain,
+                     self->filterCoeff, 0.0, 0.0, self->upperLimit,
+                     self->lowerLimit, sampleTime, &self->output);
+  return self->output;
+}
+
+static PyObject *PidController_setGains(PidControllerObject *self, PyObject
+  *args)
+{
+  if (!PyArg_ParseTuple(args, "dddddd", &self->pGain, &self->iGain,
+                        &self->dGain, &self->filterCoeff, &self->upperLimit,
+                        &self->lowerLimit)) {
+    return NULL;
+  }
+
+  Py_RETURN_NONE;
+}
+
+static PyObject *PidController_getOutput(PidControllerObject *self, PyObject
+  *Py_UNUSED(ignored))
+{
+  return PyFloat_FromDouble(self->output);
+}
+
+static PyObject *PidController_reset(PidControllerObject *self, PyObject
+  *Py_UNUSED(ignored))
+{
+  PidController_initializeModel(self);
+  Py_RETURN_NONE;
+}
+
+static PyObject *PidController_step(PidControllerObject *self, PyObject *const
+  *args, Py_ssize_t nargs)
+{
+  real_T error, sampleTime;
+  if (nargs != 2) {
+    PyErr_SetString(PyExc_TypeError, "step() takes error and sampleTime");
+    return NULL;
+  }
+
+  error = PyFloat_AsDouble(args[0]);
+  sampleTime = PyFloat_AsDouble(args[1]);
+  if (PyErr_Occurred()) {
+    return NULL;
+  }
+
+  return PyFloat_FromDouble(PidController_stepOnce(self, error, sampleTime));
+}
+
+/* Reads a float64 buffer if obj exports one, otherwise a sequence of numbers */
+static int PidController_readDoubles(PyObject *obj, Py_buffer *view, PyObject
+  **sequence, const double **values, Py_ssize_t *count)
+{
+  *sequence = NULL;
+  view->obj = NULL;
+  if (PyObject_CheckBuffer(obj) && PyObject_GetBuffer(obj, view,
+       PyBUF_C_CONTIGUOUS | PyBUF_FORMAT) == 0) {
+    if (view->ndim <= 1 && view->itemsize == sizeof(double) && view->format !=
+        NULL && (strcmp(view->format, "d") == 0 || strcmp(view->format, "<d") ==
+                 0 || strcmp(view->format, "=d") == 0)) {
+      *values = (const double *)view->buf;
+      *count = view->len / (Py_ssize_t)sizeof(double);
+      return 0;
+    }
+
+    PyBuffer_Release(view);
+    view->obj = NULL;
+  }
+
+  PyErr_Clear();
+  *sequence = PySequence_Fast(obj, "expected a sequence of numbers");
+  if (*sequence == NULL) {
+    return -1;
+  }
+
+  *values = NULL;
+  *count = PySequence_Fast_GET_SIZE(*sequence);
+  return 0;
+}
+
+static double PidController_valueAt(PyObject *sequence, const double *values,
+  Py_ssize_t index)
+{
+  if (values != NULL) {
+    return values[index];
+  }
+
+  return PyFloat_AsDouble(PySequence_Fast_GET_ITEM(sequence, index));
+}
+
+static PyObject *PidController_stepMany(PidControllerObject *self, PyObject
+  *args)
+{
+  PyObject *errorsObj, *dtsObj, *errorSequence = NULL, *dtSequence = NULL;
+  PyObject *outputs = NULL;
+  Py_buffer errorView, dtView;
+  const double *errors, *dts = NULL;
+  Py_ssize_t count, dtCount = 0, i;
+  double fixedDt = 0.0;
+  int fixedSampleTime = 0;
+  if (!PyArg_ParseTuple(args, "OO", &errorsObj, &dtsObj)) {
+    return NULL;
+  }
+
+  dtView.obj = NULL;
+  if (PidController_readDoubles(errorsObj, &errorView, &errorSequence, &errors,
+       &count) != 0) {
+    return NULL;
+  }
+
+  /* Any number that is not a sequence, so NumPy scalars of every width too */
+  if (PyNumber_Check(dtsObj) && !PySequence_Check(dtsObj)) {
+    fixedDt = PyFloat_AsDouble(dtsObj);
+    if (fixedDt == -1.0 && PyErr_Occurred()) {
+      goto done;
+    }
+
+    fixedSampleTime = 1;
+  } else {
+    if (PidController_readDoubles(dtsObj, &dtView, &dtSequence, &dts, &dtCount)
+        != 0) {
+      goto done;
+    }
+
+    if (dtCount != count) {
+      PyErr_SetString(PyExc_ValueError,
+                      "errors and dts must have the same length");
+      goto done;
+    }
+  }
+
+  outputs = PyList_New(count);
+  if (outputs == NULL) {
+    goto done;
+  }
+
+  for (i = 0; i < count; i++) {
+    double error = PidController_valueAt(errorSequence, errors, i);
+    double dt = fixedSampleTime ? fixedDt : PidController_valueAt(dtSequence,
+      dts, i);
+    PyObject *output;
+    if (PyErr_Occurred()) {
+      Py_CLEAR(outputs);
+      goto done;
+    }
+
+    output = PyFloat_FromDouble(PidController_stepOnce(self, error, dt));
+    if (output == NULL) {
+      Py_CLEAR(outputs);
+      goto done;
+    }
+
+    PyList_SET_ITEM(outputs, i, output);
+  }
+
+ done:
+  if (errorView.obj != NULL) {
+    PyBuffer_Release(&errorView);
+  }
+
+  if (dtView.obj != NULL) {
+    PyBuffer_Release(&dtView);
+  }
+
+  Py_XDECREF(errorSequence);
+  Py_XDECREF(dtSequence);
+  return outputs;
+}
+
+static PyObject *PidController_getIntegratorState(PidControllerObject *self,
+  void *closure)
+{
+  return PyFloat_FromDouble(self->dwork.Integrator_DSTATE);
+}
+
+static PyObject *PidController_getFilterState(PidControllerObject *self, void
+  *closure)
+{
+  return PyFloat_FromDouble(self->dwork.Filter_DSTATE);
+}
+
+static PyMethodDef PidController_methods[] = {
+  { "setGains", (PyCFunction)PidController_setGains, METH_VARARGS,
+    "setGains(pGain, iGain, dGain, filterCoeff, upperLimit, lowerLimit)" },
+
+  { "getOutput", (PyCFunction)PidController_getOutput, METH_NOARGS,
+    "Output of the latest step" },
+
+  { "reset", (PyCFunction)PidController_reset, METH_NOARGS,
+    "Clears integrator and filter states" },
+
+  { "step", (PyCFunction)(void (*)(void))PidController_step, METH_FASTCALL,
+    "step(error, sampleTime) -> output" },
+
+  { "step_many", (PyCFunction)PidController_stepMany, METH_VARARGS,
+    "step_many(errors, dts) -> list of outputs. errors is a sequence or float64 buffer, dts either the same or one sample time for all steps." },
+
+  { NULL, NULL, 0, NULL }
+};
+
+static PyGetSetDef PidController_getset[] = {
+  { "integratorState", (getter)PidController_getIntegratorState, NULL,
+    "Integrator state", NULL },
+
+  { "filterState", (getter)PidController_getFilterState, NULL,
+    "Derivative filter state", NULL },
+
+  { NULL, NULL, NULL, NULL, NULL }
+};
+
+static PyTypeObject PidControllerType = {
+  PyVarObject_HEAD_INIT(NULL, 0)
+  .tp_name = "_pidcontroller.PidController",
+  .tp_doc = "Generated Simulink discrete PID with anti-windup clamping",
+  .tp_basicsize = sizeof(PidControllerObject),
+  .tp_itemsize = 0,
+  .tp_flags = Py_TPFLAGS_DEFAULT,
+  .tp_new = PyType_GenericNew,
+  .tp_init = (initproc)PidController_init,
+  .tp_methods = PidController_methods,
+  .tp_getset = PidController_getset,
+};
+
+static struct PyModuleDef pidcontrollerModule = {
+  PyModuleDef_HEAD_INIT,
+  .m_name = "_pidcontroller",
+  .m_doc = "Native binding of the generated PIDController",
+  .m_size = -1,
+};
+
+PyMODINIT_FUNC PyInit__pidcontroller(void)
+{
+  PyObject *module;
+  if (PyType_Ready(&PidControllerType) < 0) {
+    return NULL;
+  }
+
+  module = PyModule_Create(&pidcontrollerModule);
+  if (module == NULL) {
+    return NULL;
+  }
+
+  Py_INCREF(&PidControllerType);
+  if (PyModule_AddObject(module, "PidController", (PyObject *)&PidControllerType)
+      < 0) {
+    Py_DECREF(&PidControllerType);
+    Py_DECREF(module);
+    return NULL;
+  }
+
+  return module;
+}
@@ -1 +1,2 @@
-gcc -shared -o DiscretePid.so ./CodegenPid/*.c
\ No newline at end of file
+gcc -shared -o DiscretePid.so ./CodegenPid/PIDController.c ./CodegenPid/ert_main.c
+python3 setup.py build_ext --inplace
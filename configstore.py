@@ -0,0 +1,190 @@
+import dbm
+import json
+import math
+import os
+import shelve
+import time
+from gaggiahardware import originalModule
+
+CONFIG_FILE_EXTENSION = ".json"
+DEFAULT_QUIET_PERIOD = 2.0
+# Longest a change waits for the changes after it to stop
+DEFAULT_MAX_DELAY = 10.0
+# Allowed range of every known setting, None for settings that only have to be finite numbers
+CONFIG_LIMITS = {
+    "brew_setpoint": (80, 110),
+    "steam_setpoint": (120, 160),
+    "shot_time_limit": (0, 45),
+    "brew_feedforward_compensation": (0, 0.3),
+    "p_gain": None,
+    "i_gain": None,
+    "d_gain": None,
+    "filter_coeff_n": (0, None),
+}
+
+
+def isValidSetting(key: str, value) -> bool:
+    if (key not in CONFIG_LIMITS or type(value) not in (int, float) or not math.isfinite(value)):
+        return False
+    limits = CONFIG_LIMITS[key]
+    if (limits == None):
+        return True
+    low, high = limits
+    return (low == None or value >= low) and (high == None or value <= high)
+
+
+class ConfigStore():
+    """
+    Validated in-memory settings with write-behind persistence to basePath + ".json". Changes are coalesced
+    and written by a native background thread once no further change has arrived for quietPeriod seconds,
+    so a dragged slider costs one write, or at the latest maxDelay seconds after the first unwritten change
+    under a steady stream of changes. Files are replaced atomically (temp file, fsync, rename).
+    Only the keys changed through this store are written, merged into what the file holds at that moment,
+    so processes sharing the file, like pidautotuner storing gains, do not overwrite each other's settings.
+    Settings of the old shelve at basePath are imported on first use and written along with the first
+    flush. A basePath of None keeps everything in memory only.
+    """
+
+    def __init__(self, basePath: str, quietPeriod: float = DEFAULT_QUIET_PERIOD, maxDelay: float = DEFAULT_MAX_DELAY):
+        self.basePath = basePath
+        self.quietPeriod = quietPeriod
+        self.maxDelay = maxDelay
+        self.values = {}
+        # Keys changed since the last write
+        self.dirtyKeys = set()
+        self.writeCount = 0
+        # Native primitives, the writer must not run on the web server's event loop
+        threading = originalModule("threading")
+        self.lock = threading.Lock()
+        self.writeLock = threading.Lock()
+        self.changed = threading.Event()
+        self.writerThread = None
+        self.running = True
+        if (basePath != None):
+            self.path = basePath + CONFIG_FILE_EXTENSION
+            self.__load()
+
+    def __load(self):
+        if (os.path.exists(self.path)):
+            self.values = self.__readFile()
+            return
+        for key, value in self.__readLegacyShelve().items():
+            if (isValidSetting(key, value)):
+                self.values[key] = value
+                self.dirtyKeys.add(key)
+
+    def __readFile(self) -> dict:
+        """
+        Returns the valid settings currently in the file
+        """
+        try:
+            with open(self.path, "r") as f:
+                loaded = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            print(f"Ignoring unreadable config {self.path}: {e}")
+            return {}
+        return {key: value for key, value in loaded.items() if isValidSetting(key, value)}
+
+    def __readLegacyShelve(self) -> dict:
+        try:
+            with shelve.open(self.basePath, flag="r") as cfg:
+                return {key: cfg[key] for key in cfg.keys()}
+        except dbm.error:
+            return {}
+
+    def get(self, key: str, default=None):
+        return self.values.get(key, default)
+
+    def set(self, key: str, value) -> bool:
+        """
+        Stores value if it is valid for key and schedules a write. Returns False for invalid values.
+        """
+        return self.update({key: value})
+
+    def update(self, values: dict) -> bool:
+        """
+        Stores all values or, if any of them is invalid, none of them
+        """
+        for key, value in values.items():
+            if (not isValidSetting(key, value)):
+                return False
+        with self.lock:
+            self.values.update(values)
+            self.dirtyKeys.update(values.keys())
+        if (self.basePath != None):
+            self.__ensureWriterThread()
+            self.changed.set()
+        return True
+
+    def flush(self):
+        """
+        Writes pending changes right away, does nothing if there are none
+        """
+        with self.writeLock:
+            with self.lock:
+                if (len(self.dirtyKeys) == 0 or self.basePath == None):
+                    return
+                changes = {key: self.values[key] for key in self.dirtyKeys}
+                self.dirtyKeys = set()
+            try:
+                snapshot = self.__readFile()
+                snapshot.update(changes)
+                self.__writeAtomically(snapshot)
+            except OSError:
+                with self.lock:
+                    self.dirtyKeys.update(changes.keys())
+                raise
+            self.writeCount += 1
+
+    def __writeAtomically(self, snapshot: dict):
+        temporaryPath = self.path + ".tmp"
+        with open(temporaryPath, "w") as f:
+            json.dump(snapshot, f, indent=1, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporaryPath, self.path)
+        self.__fsyncDirectory()
+
+    def close(self):
+        self.running = False
+        self.changed.set()
+        self.flush()
+
+    def __fsyncDirectory(self):
+        # Makes the rename itself durable
+        try:
+            directory = os.open(os.path.dirname(
+                os.path.abspath(self.path)), os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(directory)
+        except OSError:
+            pass
+        finally:
+            os.close(directory)
+
+    def __ensureWriterThread(self):
+        if (self.writerThread != None):
+            return
+        self.writerThread = originalModule("threading").Thread(
+            target=self.__writeBehind, args=(), daemon=True)
+        self.writerThread.start()
+
+    def __writeBehind(self):
+        while self.running:
+            self.changed.wait()
+            self.changed.clear()
+            # Wait until changes stop arriving, but not for longer than maxDelay after the first of them
+            deadline = time.monotonic() + self.maxDelay
+            while self.running:
+                remaining = deadline - time.monotonic()
+                if (remaining <= 0 or not self.changed.wait(min(self.quietPeriod, remaining))):
+                    break
+                self.changed.clear()
+            try:
+                self.flush()
+            except OSError as e:
+                print(f"Failed to write config {self.path}: {e}")
@@ -0,0 +1,148 @@
+import bisect
+import math
+import os
+import time
+
+# Upper edges of the latency histogram buckets in seconds, the last bucket catches everything above
+LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0)
+METRIC_PREFIX = "gaggia_"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class LatencyHistogram():
+    """
+    Fixed bucket histogram of durations in seconds. observe() is a bisect and three additions, everything
+    else happens when the metrics are scraped.
+    """
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+
+def formatLabels(labels: dict) -> str:
+    if (labels == None or len(labels) == 0):
+        return ""
+    pairs = []
+    for key, value in labels.items():
+        escaped = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{key}="{escaped}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def formatValue(value: float) -> str:
+    if (isinstance(value, bool)):
+        value = int(value)
+    if (isinstance(value, float) and math.isinf(value)):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class MetricsWriter():
+    """
+    Builds a scrape in the Prometheus text exposition format. samples are either a single value or a list of
+    (labels, value) pairs, all names get METRIC_PREFIX.
+    """
+
+    def __init__(self):
+        self.lines = []
+
+    def add(self, name: str, metricType: str, help: str, samples):
+        name = METRIC_PREFIX + name
+        self.lines.append(f"# HELP {name} {help}")
+        self.lines.append(f"# TYPE {name} {metricType}")
+        if (not isinstance(samples, list)):
+            samples = [(None, samples)]
+        for labels, value in samples:
+            self.lines.append(f"{name}{formatLabels(labels)} {formatValue(value)}")
+
+    def addCounter(self, name: str, help: str, samples):
+        self.add(name, "counter", help, samples)
+
+    def addGauge(self, name: str, help: str, samples):
+        self.add(name, "gauge", help, samples)
+
+    def addHistogram(self, name: str, help: str, histograms):
+        """
+        histograms is a LatencyHistogram or a list of (labels, LatencyHistogram) pairs
+        """
+        name = METRIC_PREFIX + name
+        self.lines.append(f"# HELP {name} {help}")
+        self.lines.append(f"# TYPE {name} histogram")
+        if (not isinstance(histograms, list)):
+            histograms = [(None, histograms)]
+        for labels, histogram in histograms:
+            labels = dict(labels) if labels != None else {}
+            cumulative = 0
+            for edge, count in zip(list(histogram.buckets) + [math.inf], histogram.counts):
+                cumulative += count
+                bucketLabels = dict(labels, le=formatValue(float(edge)))
+                self.lines.append(f"{name}_bucket{formatLabels(bucketLabels)} {cumulative}")
+            self.lines.append(f"{name}_sum{formatLabels(labels)} {formatValue(histogram.sum)}")
+            self.lines.append(f"{name}_count{formatLabels(labels)} {histogram.count}")
+
+    def addText(self, text: str):
+        """
+        Appends families rendered by another MetricsWriter, e.g. in the control process
+        """
+        if (len(text) > 0):
+            self.lines.append(text.rstrip("\n"))
+
+    def render(self) -> str:
+        return "\n".join(self.lines) + "\n"
+
+
+def processAge() -> float:
+    """
+    Seconds since the kernel started this process, None where /proc is not available. Has the resolution of
+    the scheduler clock tick, 10 ms on most systems.
+    """
+    try:
+        with open("/proc/self/stat") as f:
+            # The command name may contain spaces, fields are counted from after it
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return max(0.0, uptime - int(fields[19]) / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class StartupTimer():
+    """
+    Splits startup into named phases, phase(name) ends the phase that is running. Time before the timer was
+    created is reported as the "interpreter" phase when the process start time is known.
+    """
+
+    def __init__(self):
+        self.phases = []
+        age = processAge()
+        self.lastMark = time.perf_counter()
+        if (age != None):
+            self.phases.append(("interpreter", age))
+
+    def phase(self, name: str) -> float:
+        now = time.perf_counter()
+        seconds = now - self.lastMark
+        self.lastMark = now
+        self.phases.append((name, seconds))
+        return seconds
+
+    def total(self) -> float:
+        return sum(seconds for name, seconds in self.phases)
+
+    def summary(self) -> str:
+        return f"{self.total() * 1000:.0f} ms (" + ", ".join(
+            f"{name} {seconds * 1000:.0f}" for name, seconds in self.phases) + ")"
+
+    def writeMetrics(self, writer: MetricsWriter, name: str = "startup_phase_seconds"):
+        writer.addGauge(name, "Wall time of each startup phase",
+                        [({"phase": phase}, seconds) for phase, seconds in self.phases])
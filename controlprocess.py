@@ -0,0 +1,495 @@
+import argparse
+import os
+import signal
+import struct
+import subprocess
+import sys
+import time
+from multiprocessing import shared_memory, resource_tracker
+from telemetrysample import TelemetrySample
+from telemetrydecimator import DECIMATE_FULL, DECIMATION_MODES
+from controlmetrics import MetricsWriter, StartupTimer
+from udptelemetry import parseAddress, UDP_PROTOCOLS, PROTOCOL_LEGACY, DEFAULT_BATCH_INTERVAL
+from configstore import isValidSetting
+
+TELEMETRY_RING_CAPACITY = 256
+COMMAND_CHANNEL_CAPACITY = 64
+COMMAND_POLL_INTERVAL = 0.05
+METRICS_BUFFER_SIZE = 64 * 1024
+METRICS_TIMEOUT = 1.0
+# Reads of the controller state that may find the writer busy before the last consistent state is returned
+STATE_READ_RETRIES = 1000
+
+HEADER_SIZE = 64
+# seq, shot recorder record fields, seq again as a torn-write guard
+TELEMETRY_RECORD = struct.Struct("<QdffffBBxxQ")
+# command id, value
+COMMAND_RECORD = struct.Struct("<Bxxxxxxxd")
+# version, odd while the values are being written
+STATE_VERSION = struct.Struct("<Q")
+# brew setpoint, steam setpoint, shot time limit, brew feedforward
+STATE_VALUES = struct.Struct("<dddd")
+# request id, text length
+METRICS_HEADER = struct.Struct("<QQ")
+COUNTER = struct.Struct("<Q")
+
+CMD_SET_BREW_SETPOINT = 1
+CMD_SET_STEAM_SETPOINT = 2
+CMD_SET_SHOT_TIME_LIMIT = 3
+CMD_SET_BREW_FEEDFORWARD = 4
+CMD_RENDER_METRICS = 5
+
+
+def attachSharedMemory(name: str) -> shared_memory.SharedMemory:
+    """
+    Attaches to a segment owned by another process without letting this process' resource tracker unlink it on exit
+    """
+    shm = shared_memory.SharedMemory(name)
+    resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+
+class TelemetryRing():
+    """
+    Single producer, any number of readers ring of fixed size telemetry records in shared memory.
+    The producer never blocks; a reader that falls more than a full ring behind skips the overwritten records.
+    """
+
+    def __init__(self, shm: shared_memory.SharedMemory):
+        self.shm = shm
+        self.buffer = shm.buf
+        self.capacity = (shm.size - HEADER_SIZE) // TELEMETRY_RECORD.size
+        self.writeCount = COUNTER.unpack_from(self.buffer, 0)[0]
+        self.readCount = self.writeCount
+        self.droppedCount = 0
+
+    @staticmethod
+    def create(capacity: int = TELEMETRY_RING_CAPACITY):
+        shm = shared_memory.SharedMemory(
+            create=True, size=HEADER_SIZE + capacity * TELEMETRY_RECORD.size)
+        COUNTER.pack_into(shm.buf, 0, 0)
+        return TelemetryRing(shm)
+
+    def write(self, sample: TelemetrySample):
+        seq = self.writeCount + 1
+        offset = HEADER_SIZE + (self.writeCount %
+                                self.capacity) * TELEMETRY_RECORD.size
+        TELEMETRY_RECORD.pack_into(self.buffer, offset, seq, sample.timestamp, sample.temperature, sample.setpoint,
+                                   sample.output, sample.shotDuration, sample.brewSwitch, sample.steamSwitch, seq)
+        self.writeCount = seq
+        COUNTER.pack_into(self.buffer, 0, seq)
+
+    def pendingCount(self) -> int:
+        return COUNTER.unpack_from(self.buffer, 0)[0] - self.readCount
+
+    def readNew(self) -> list:
+        """
+        Returns the TelemetrySamples written since the previous call
+        """
+        writeCount = COUNTER.unpack_from(self.buffer, 0)[0]
+        if (writeCount - self.readCount > self.capacity):
+            self.droppedCount += writeCount - self.readCount - self.capacity
+            self.readCount = writeCount - self.capacity
+        records = []
+        for index in range(self.readCount, writeCount):
+            offset = HEADER_SIZE + (index % self.capacity) * \
+                TELEMETRY_RECORD.size
+            record = TELEMETRY_RECORD.unpack_from(self.buffer, offset)
+            seq = record[0]
+            if (seq != index + 1 or record[-1] != seq):
+                # Overwritten by the producer while we were reading
+                self.droppedCount += 1
+                continue
+            timestamp, temperature, setpoint, output, shotDuration, brewSwitch, steamSwitch = record[1:-1]
+            records.append(TelemetrySample(timestamp, seq, temperature, setpoint, output, shotDuration,
+                                           bool(brewSwitch), bool(steamSwitch)))
+        self.readCount = writeCount
+        return records
+
+
+class CommandChannel():
+    """
+    Lock-free single producer single consumer queue of (command, value) pairs in shared memory.
+    The head counter is only written by the producer and the tail counter only by the consumer.
+    """
+
+    def __init__(self, shm: shared_memory.SharedMemory):
+        self.shm = shm
+        self.buffer = shm.buf
+        self.capacity = (shm.size - 2 * HEADER_SIZE) // COMMAND_RECORD.size
+
+    @staticmethod
+    def create(capacity: int = COMMAND_CHANNEL_CAPACITY):
+        shm = shared_memory.SharedMemory(
+            create=True, size=2 * HEADER_SIZE + capacity * COMMAND_RECORD.size)
+        COUNTER.pack_into(shm.buf, 0, 0)
+        COUNTER.pack_into(shm.buf, HEADER_SIZE, 0)
+        return CommandChannel(shm)
+
+    def push(self, command: int, value: float) -> bool:
+        head = COUNTER.unpack_from(self.buffer, 0)[0]
+        tail = COUNTER.unpack_from(self.buffer, HEADER_SIZE)[0]
+        if (head - tail >= self.capacity):
+            return False
+        COMMAND_RECORD.pack_into(self.buffer, 2 * HEADER_SIZE + (head % self.capacity) * COMMAND_RECORD.size,
+                                 command, value)
+        COUNTER.pack_into(self.buffer, 0, head + 1)
+        return True
+
+    def popAll(self) -> list:
+        head = COUNTER.unpack_from(self.buffer, 0)[0]
+        tail = COUNTER.unpack_from(self.buffer, HEADER_SIZE)[0]
+        commands = []
+        for index in range(tail, head):
+            commands.append(COMMAND_RECORD.unpack_from(
+                self.buffer, 2 * HEADER_SIZE + (index % self.capacity) * COMMAND_RECORD.size))
+        COUNTER.pack_into(self.buffer, HEADER_SIZE, head)
+        return commands
+
+
+class ControllerState():
+    """
+    Settings published by the control process for the web server, guarded by a seqlock: the version is odd
+    while the values are being written, and a reader retries when it sees an odd version or the version
+    changed while it copied the values.
+    """
+
+    def __init__(self, shm: shared_memory.SharedMemory):
+        self.shm = shm
+        self.buffer = shm.buf
+        self.version = STATE_VERSION.unpack_from(self.buffer, 0)[0]
+        self.lastRecord = (0, 0, 0, 0, 0)
+
+    @staticmethod
+    def create():
+        shm = shared_memory.SharedMemory(create=True, size=STATE_VERSION.size + STATE_VALUES.size)
+        STATE_VERSION.pack_into(shm.buf, 0, 0)
+        STATE_VALUES.pack_into(shm.buf, STATE_VERSION.size, 0, 0, 0, 0)
+        return ControllerState(shm)
+
+    def publish(self, brewSetpoint: float, steamSetpoint: float, shotTimeLimit: float, brewFeedForward: float):
+        STATE_VERSION.pack_into(self.buffer, 0, self.version + 1)
+        STATE_VALUES.pack_into(self.buffer, STATE_VERSION.size, brewSetpoint, steamSetpoint, shotTimeLimit,
+                               brewFeedForward)
+        self.version += 2
+        STATE_VERSION.pack_into(self.buffer, 0, self.version)
+
+    def read(self):
+        """
+        Returns (version, brewSetpoint, steamSetpoint, shotTimeLimit, brewFeedForward). Gives up after
+        STATE_READ_RETRIES attempts, e.g. when the control process died while writing, and returns the last
+        consistent state instead.
+        """
+        for attempt in range(STATE_READ_RETRIES):
+            version = STATE_VERSION.unpack_from(self.buffer, 0)[0]
+            if (version % 2 == 1):
+                continue
+            values = STATE_VALUES.unpack_from(self.buffer, STATE_VERSION.size)
+            if (STATE_VERSION.unpack_from(self.buffer, 0)[0] == version):
+                self.lastRecord = (version,) + values
+                break
+        return self.lastRecord
+
+
+class ControllerProcess():
+    """
+    Web server side handle of a GaggiaController running in its own process. Mirrors the parts of the
+    GaggiaController interface that gaggiaserver.py uses; setters are queued to the control process.
+    """
+
+    def __init__(self, telemetryAddresses, disablePrints: bool, simulate: bool, useMeasuredSampleTime: bool = False,
+                 recordDirectory: str = None, udpDecimation: str = DECIMATE_FULL, oversampleTemperature: bool = True,
+                 recordIoDirectory: str = None, udpProtocol: str = PROTOCOL_LEGACY,
+                 udpBatchInterval: float = DEFAULT_BATCH_INTERVAL):
+        self.telemetryRing = TelemetryRing.create()
+        self.commandChannel = CommandChannel.create()
+        self.state = ControllerState.create()
+        self.metricsBuffer = MetricsBuffer.create()
+        self.metricsRequestId = 0
+        self.lastStateVersion = 0
+        self.process = None
+        self.sharedMemoryReleased = False
+        self.args = [sys.executable, os.path.abspath(__file__),
+                     "--telemetry", self.telemetryRing.shm.name,
+                     "--commands", self.commandChannel.shm.name,
+                     "--state", self.state.shm.name,
+                     "--metrics", self.metricsBuffer.shm.name]
+        if (telemetryAddresses != None and len(telemetryAddresses) > 0):
+            for host, port in telemetryAddresses:
+                self.args += ["--ip", f"{host}:{port}"]
+            self.args += ["--udpdecimation", udpDecimation,
+                          "--udpprotocol", udpProtocol,
+                          "--udpbatchinterval", repr(float(udpBatchInterval))]
+        if (disablePrints):
+            self.args.append("--disableprints")
+        if (simulate):
+            self.args.append("--simulate")
+        if (useMeasuredSampleTime):
+            self.args.append("--measureddt")
+        if (recordDirectory != None):
+            self.args += ["--recorddir", recordDirectory]
+        if (not oversampleTemperature):
+            self.args.append("--directread")
+        if (recordIoDirectory != None):
+            self.args += ["--recordio", recordIoDirectory]
+
+    def start(self):
+        self.spawn()
+        self.waitUntilReady()
+
+    def spawn(self):
+        """
+        Launches the control process without waiting for it, so the web server can start up alongside it
+        """
+        self.process = subprocess.Popen(self.args)
+
+    def waitUntilReady(self):
+        # Wait for the control process to publish its loaded config
+        while self.state.read()[0] == 0 and self.process.poll() == None:
+            time.sleep(COMMAND_POLL_INTERVAL)
+
+    def stop(self):
+        if (self.process != None and self.process.poll() == None):
+            self.process.terminate()
+            self.process.wait()
+        if (self.sharedMemoryReleased):
+            return
+        self.sharedMemoryReleased = True
+        for shm in [self.telemetryRing.shm, self.commandChannel.shm, self.state.shm, self.metricsBuffer.shm]:
+            shm.close()
+            shm.unlink()
+
+    def join(self):
+        self.process.wait()
+
+    def readTelemetry(self) -> list:
+        return self.telemetryRing.readNew()
+
+    def getTelemetryStats(self) -> dict:
+        return {"ring": {"delivered": self.telemetryRing.readCount, "dropped": self.telemetryRing.droppedCount}}
+
+    def getTelemetryBacklog(self) -> int:
+        """
+        Samples in the telemetry ring that have not been forwarded to Socket.IO clients yet
+        """
+        return max(0, self.telemetryRing.pendingCount())
+
+    def writeMetrics(self, writer: MetricsWriter):
+        """
+        Asks the control process for its metrics and adds them to a scrape along with the ring reader side.
+        Waits at most METRICS_TIMEOUT, yielding with sleep, which is what only makes scrapes cost anything.
+        """
+        self.metricsRequestId += 1
+        requestId = self.metricsRequestId
+        text = None
+        if (self.commandChannel.push(CMD_RENDER_METRICS, requestId)):
+            deadline = time.monotonic() + METRICS_TIMEOUT
+            while text == None and time.monotonic() < deadline and self.process.poll() == None:
+                time.sleep(COMMAND_POLL_INTERVAL / 5)
+                text = self.metricsBuffer.read(requestId)
+        writer.addGauge("control_process_up", "Whether the control process answered the scrape", text != None)
+        if (text != None):
+            writer.addText(text)
+        writer.addCounter("telemetry_ring_forwarded_total", "Samples read from the control process ring",
+                          self.telemetryRing.readCount)
+        writer.addCounter("telemetry_ring_dropped_total", "Samples overwritten before they were read",
+                          self.telemetryRing.droppedCount)
+
+    def hasConfigChanged(self) -> bool:
+        version = self.state.read()[0]
+        changed = version != self.lastStateVersion
+        self.lastStateVersion = version
+        return changed
+
+    @property
+    def brew_setpoint(self):
+        return self.state.read()[1]
+
+    @property
+    def steam_setpoint(self):
+        return self.state.read()[2]
+
+    @property
+    def shot_time_limit(self):
+        return self.state.read()[3]
+
+    @property
+    def brew_feedforward_compensation(self):
+        return self.state.read()[4]
+
+    def __pushSetting(self, key: str, command: int, value) -> bool:
+        # Rejected here like GaggiaController does, a non-numeric value could not even be packed
+        if (not isValidSetting(key, value)):
+            return False
+        return self.commandChannel.push(command, value)
+
+    def setBrewSetpoint(self, setpoint: float):
+        return self.__pushSetting("brew_setpoint", CMD_SET_BREW_SETPOINT, setpoint)
+
+    def setSteamSetpoint(self, setpoint: float):
+        return self.__pushSetting("steam_setpoint", CMD_SET_STEAM_SETPOINT, setpoint)
+
+    def setShotTimeLimit(self, limitSeconds: float):
+        return self.__pushSetting("shot_time_limit", CMD_SET_SHOT_TIME_LIMIT, limitSeconds)
+
+    def setBrewFeedForwardCompensation(self, brewCompensation: float):
+        return self.__pushSetting("brew_feedforward_compensation", CMD_SET_BREW_FEEDFORWARD, brewCompensation)
+
+
+class MetricsBuffer():
+    """
+    Metrics text rendered by the control process on request. The request id is cleared while the text is
+    rewritten, so a reader that sees its id before and after copying the text has a consistent scrape.
+    """
+
+    def __init__(self, shm: shared_memory.SharedMemory):
+        self.shm = shm
+        self.buffer = shm.buf
+
+    @staticmethod
+    def create(size: int = METRICS_BUFFER_SIZE):
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        METRICS_HEADER.pack_into(shm.buf, 0, 0, 0)
+        return MetricsBuffer(shm)
+
+    def write(self, requestId: int, text: str):
+        data = text.encode()[:self.shm.size - METRICS_HEADER.size]
+        METRICS_HEADER.pack_into(self.buffer, 0, 0, 0)
+        self.buffer[METRICS_HEADER.size:METRICS_HEADER.size + len(data)] = data
+        METRICS_HEADER.pack_into(self.buffer, 0, requestId, len(data))
+
+    def read(self, requestId: int) -> str:
+        """
+        Returns the text rendered for requestId or a later request, None if it is not there yet
+        """
+        servedId, length = METRICS_HEADER.unpack_from(self.buffer, 0)
+        if (servedId < requestId):
+            return None
+        text = bytes(self.buffer[METRICS_HEADER.size:METRICS_HEADER.size + length])
+        if (METRICS_HEADER.unpack_from(self.buffer, 0)[0] != servedId):
+            return None
+        return text.decode(errors="replace")
+
+
+def publishState(state: ControllerState, controller):
+    state.publish(controller.brew_setpoint, controller.steam_setpoint,
+                  controller.shot_time_limit, controller.brew_feedforward_compensation)
+
+
+def applyCommand(controller, command: int, value: float, metricsBuffer: MetricsBuffer,
+                 startupTimer: StartupTimer = None):
+    if (command == CMD_RENDER_METRICS):
+        writer = MetricsWriter()
+        controller.writeMetrics(writer)
+        if (startupTimer != None):
+            startupTimer.writeMetrics(writer, "control_process_startup_phase_seconds")
+        metricsBuffer.write(int(value), writer.render())
+    elif (command == CMD_SET_BREW_SETPOINT):
+        controller.setBrewSetpoint(value)
+    elif (command == CMD_SET_STEAM_SETPOINT):
+        controller.setSteamSetpoint(value)
+    elif (command == CMD_SET_SHOT_TIME_LIMIT):
+        controller.setShotTimeLimit(value)
+    elif (command == CMD_SET_BREW_FEEDFORWARD):
+        controller.setBrewFeedForwardCompensation(value)
+
+
+def main():
+    startupTimer = StartupTimer()
+    parser = argparse.ArgumentParser(description="Gaggia control loop process, started by gaggiaserver.py",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--telemetry", action="store", required=True,
+                        help="Telemetry ring shared memory name")
+    parser.add_argument("--commands", action="store", required=True,
+                        help="Command channel shared memory name")
+    parser.add_argument("--state", action="store", required=True,
+                        help="Controller state shared memory name")
+    parser.add_argument("--metrics", action="store", required=True,
+                        help="Metrics buffer shared memory name")
+    parser.add_argument("-i", "--ip", action="append",
+                        help="Send UDP telemetry to ip address or ip:port, may be repeated", default=None)
+    parser.add_argument("-p", "--port", action="store", type=int,
+                        help="Send UDP telemetry to port", default=7788)
+    parser.add_argument("--udpdecimation", action="store", choices=DECIMATION_MODES,
+                        help="Decimation of the UDP telemetry", default=DECIMATE_FULL)
+    parser.add_argument("--udpprotocol", action="store", choices=UDP_PROTOCOLS,
+                        help="UDP telemetry format", default=PROTOCOL_LEGACY)
+    parser.add_argument("--udpbatchinterval", action="store", type=float,
+                        help="Longest time a sample waits for a batched UDP datagram", default=DEFAULT_BATCH_INTERVAL)
+    parser.add_argument("-d", "--disableprints", action="store_true",
+                        help="Disable prints", default=False)
+    parser.add_argument("-s", "--simulate", action="store_true",
+                        help="Run against a simulated boiler", default=False)
+    parser.add_argument("-m", "--measureddt", action="store_true",
+                        help="Step the PID with the measured sample period", default=False)
+    parser.add_argument("-r", "--recorddir", action="store",
+                        help="Record every control sample into this directory", default=None)
+    parser.add_argument("--directread", action="store_true",
+                        help="Read the thermocouple once per control step", default=False)
+    parser.add_argument("--recordio", action="store",
+                        help="Record all hardware I/O into this directory", default=None)
+    config = vars(parser.parse_args())
+    startupTimer.phase("arguments")
+
+    # The heater pin is driven low before anything that is not needed for controlling it is imported
+    from gaggiahardware import BlinkaHardware, SimulatedHardware
+    hardware = SimulatedHardware() if config["simulate"] else BlinkaHardware()
+    if (config["recordio"] != None):
+        from hardwarerecording import recordHardware
+        hardware = recordHardware(hardware, config["recordio"], not config["directread"])
+    startupTimer.phase("hardware")
+
+    from gaggiacontroller import GaggiaController
+    from temperaturesampler import TemperatureSampler
+    telemetryRing = TelemetryRing(attachSharedMemory(config["telemetry"]))
+    commandChannel = CommandChannel(attachSharedMemory(config["commands"]))
+    state = ControllerState(attachSharedMemory(config["state"]))
+    metricsBuffer = MetricsBuffer(attachSharedMemory(config["metrics"]))
+    telemetryAddresses = []
+    if (config["ip"] != None):
+        telemetryAddresses = [parseAddress(address, config["port"]) for address in config["ip"]]
+    shotRecorder = None
+    if (config["recorddir"] != None):
+        from shotrecorder import ShotRecorder
+        shotRecorder = ShotRecorder(config["recorddir"])
+    temperatureSampler = None
+    if (not config["directread"]):
+        temperatureSampler = TemperatureSampler(hardware)
+
+    controller = GaggiaController(None, telemetryAddresses, None, config["disableprints"], hardware,
+                                  useMeasuredSampleTime=config["measureddt"], shotRecorder=shotRecorder,
+                                  telemetryDecimation={"udp": config["udpdecimation"]},
+                                  temperatureSampler=temperatureSampler, udpProtocol=config["udpprotocol"],
+                                  udpBatchInterval=config["udpbatchinterval"])
+    controller.telemetryBus.addSink("ring", telemetryRing.write)
+    startupTimer.phase("controller")
+
+    def onTerminate(signum, frame):
+        # systemd and the web server may both signal us, a second SIGTERM during interpreter shutdown would
+        # interrupt the exit handlers
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        # Let the control loop thread finish so the atexit handler can turn the outputs off
+        controller.stop()
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, onTerminate)
+    parentPid = os.getppid()
+    controller.start()
+    publishState(state, controller)
+    startupTimer.phase("start")
+    if (not config["disableprints"]):
+        print(f"Control process started in {startupTimer.summary()}")
+    while controller.isRunning:
+        commands = commandChannel.popAll()
+        for command, value in commands:
+            applyCommand(controller, command, value, metricsBuffer, startupTimer)
+        if (any(command != CMD_RENDER_METRICS for command, value in commands)):
+            publishState(state, controller)
+        if (os.getppid() != parentPid):
+            # Web server died, do not keep heating unattended
+            onTerminate(None, None)
+        time.sleep(COMMAND_POLL_INTERVAL)
+
+
+if __name__ == "__main__":
+    main()
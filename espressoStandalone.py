@@ -9,6 +9,7 @@ import warnings
 import socket
 import argparse
 import os
+from configstore import ConfigStore
 import simulinkpid
 
 parser = argparse.ArgumentParser(description="PID Control for Gaggia Classic Pro",
@@ -45,7 +46,13 @@ latestTimeoutTimestamp = time.time()
 sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
 lastControlTimestamp = time.time()
 startedTime = time.time()
-pidController = simulinkpid.DiscretePid(0.046, 0.0018, -0.0030, 3.168544, 1, 0)
+pidGains = (0.046, 0.0018, -0.0030, 3.168544)
+# Gains written by pidautotuner.py
+storedGains = ConfigStore("config").get
+if (None not in [storedGains(key) for key in ["p_gain", "i_gain", "d_gain", "filter_coeff_n"]]):
+    pidGains = (storedGains("p_gain"), storedGains("i_gain"),
+                storedGains("d_gain"), storedGains("filter_coeff_n"))
+pidController = simulinkpid.DiscretePid(*pidGains, 1, 0)
 i = 0
 steam_setpoint = 150.0
 brew_setpoint = 94.0
@@ -0,0 +1,63 @@
+import math
+import time
+from controlmetrics import LatencyHistogram
+
+# Upper edges of the lateness histogram buckets in seconds, the last bucket catches everything above
+JITTER_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5)
+
+
+class FixedRateScheduler():
+    """
+    Fires at absolute deadlines start + k * interval on the monotonic clock, so lateness of one cycle
+    does not push back the following ones. Deadlines that pass completely are counted as missed and skipped.
+    """
+
+    def __init__(self, interval: float, clock=time, lateThreshold: float = None):
+        self.interval = interval
+        self.clock = clock
+        self.lateThreshold = lateThreshold if lateThreshold != None else interval * 0.1
+        self.nextDeadline = None
+        self.lastFired = None
+        self.cycleCount = 0
+        self.lateCount = 0
+        self.missedCount = 0
+        self.maxLateness = 0.0
+        self.latenessHistogram = LatencyHistogram(JITTER_BUCKETS)
+
+    def start(self):
+        now = self.clock.monotonic()
+        self.lastFired = now
+        self.nextDeadline = now + self.interval
+
+    def timeUntilDue(self) -> float:
+        return max(0.0, self.nextDeadline - self.clock.monotonic())
+
+    def poll(self):
+        """
+        Returns None if the next deadline has not been reached yet, otherwise the measured time since the
+        previous cycle
+        """
+        now = self.clock.monotonic()
+        if (now < self.nextDeadline):
+            return None
+
+        lateness = now - self.nextDeadline
+        missed = math.floor(lateness / self.interval)
+        self.nextDeadline += (missed + 1) * self.interval
+        self.missedCount += missed
+        lateness -= missed * self.interval
+        self.cycleCount += 1
+        if (lateness > self.lateThreshold):
+            self.lateCount += 1
+        if (lateness > self.maxLateness):
+            self.maxLateness = lateness
+        self.latenessHistogram.observe(lateness)
+
+        elapsed = now - self.lastFired
+        self.lastFired = now
+        return elapsed
+
+    def getStats(self) -> dict:
+        return {"cycles": self.cycleCount, "late": self.lateCount, "missed": self.missedCount,
+                "maxLateness": self.maxLateness,
+                "jitterHistogram": dict(zip([str(b) for b in JITTER_BUCKETS] + ["+Inf"], self.latenessHistogram.counts))}
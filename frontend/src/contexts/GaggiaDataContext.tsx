@@ -15,11 +15,96 @@ const host =
       ':' +
       window.location.port;
 
+export type TelemetryDecimation = 'full' | 'average' | 'minmax' | 'onchange';
+
+// Last received telemetry sequence number, sent on reconnect so the server only replays what we missed.
+// The chosen decimation is sent along so it survives reconnects, and binary telemetry is requested.
+const telemetrySession: {
+  epoch?: string;
+  lastSeq?: number;
+  decimation?: TelemetryDecimation;
+  encoding: 'json' | 'binary';
+} = { encoding: 'binary' };
+
 const socket = io(host, {
   transports: ['websocket'],
   reconnectionDelayMax: 3000,
+  auth: (cb) => cb(telemetrySession),
 });
 
+const trackTelemetrySequence = (msg: ITelemetryMessage) => {
+  if (
+    msg.seq !== undefined &&
+    (telemetrySession.lastSeq === undefined ||
+      msg.seq > telemetrySession.lastSeq)
+  )
+    telemetrySession.lastSeq = msg.seq;
+};
+
+// Binary telemetry block kinds and fields with their fixed-point scale, see
+// telemetrycodec.py
+const TELEMETRY_BLOCK_KEYFRAME = 1;
+const TELEMETRY_BLOCK_DELTA = 2;
+const TELEMETRY_BLOCK_FIELDS: [keyof ITelemetryMessage, number][] = [
+  ['seq', 1],
+  ['ts', 1],
+  ['temp', 100],
+  ['set', 10],
+  ['shotdur', 10],
+];
+
+// Last record of the live telemetryBinary stream, delta blocks continue from it
+let liveTelemetryState: number[] | undefined;
+
+const decodeTelemetryBlock = (
+  buffer: ArrayBuffer,
+  state?: number[],
+): ITelemetryMessage[] => {
+  const bytes = new Uint8Array(buffer);
+  if (bytes.length === 0) return [];
+  let previous: number[];
+  if (bytes[0] === TELEMETRY_BLOCK_KEYFRAME) {
+    previous = TELEMETRY_BLOCK_FIELDS.map(() => 0);
+  } else if (bytes[0] === TELEMETRY_BLOCK_DELTA && state !== undefined) {
+    previous = state;
+  } else {
+    return [];
+  }
+  let offset = 1;
+  // Timestamps exceed 32 bits, so no bitwise operators here
+  const readVarint = () => {
+    let value = 0;
+    let scale = 1;
+    let byte;
+    do {
+      byte = bytes[offset++];
+      value += (byte & 0x7f) * scale;
+      scale *= 128;
+    } while (byte >= 0x80);
+    return value;
+  };
+  const count = readVarint();
+  const msgs: ITelemetryMessage[] = [];
+  for (let i = 0; i < count; i++) {
+    const msg = {} as ITelemetryMessage;
+    TELEMETRY_BLOCK_FIELDS.forEach(([key, scale], field) => {
+      const zigzag = readVarint();
+      previous[field] += zigzag % 2 === 0 ? zigzag / 2 : -(zigzag + 1) / 2;
+      msg[key] = previous[field] / scale;
+    });
+    msgs.push(msg);
+  }
+  if (state !== undefined) state.splice(0, state.length, ...previous);
+  return msgs;
+};
+
+const decodeLiveTelemetryBlock = (buffer: ArrayBuffer): ITelemetryMessage[] => {
+  if (new Uint8Array(buffer)[0] === TELEMETRY_BLOCK_KEYFRAME) {
+    liveTelemetryState = TELEMETRY_BLOCK_FIELDS.map(() => 0);
+  }
+  return decodeTelemetryBlock(buffer, liveTelemetryState);
+};
+
 export interface ITelemetryData {
   localReceivedTimestamp: Date;
   timestamp: Date;
@@ -29,6 +114,7 @@ export interface ITelemetryData {
 }
 
 export interface ITelemetryMessage {
+  seq?: number;
   ts: number;
   temp: number;
   set: number;
@@ -41,6 +127,11 @@ export interface IGaggiaConfig {
   brewSetpoint: number;
 }
 
+export interface IShotRange {
+  start: number;
+  end: number | null;
+}
+
 export interface IGaggiaDataContext {
   telemetryData: ITelemetryData[];
   brewTimer?: number;
@@ -49,6 +140,16 @@ export interface IGaggiaDataContext {
   setShotTimeLimit: (limit: number) => void;
   setBrewSetpoint: (setpoint: number) => void;
   setSteamSetpoint: (setpoint: number) => void;
+  queryTelemetryHistory: (
+    start: Date,
+    end: Date,
+    points: number,
+    method?: 'lttb' | 'minmax',
+  ) => Promise<ITelemetryData[]>;
+  listShots: () => Promise<IShotRange[]>;
+  setTelemetryDecimation: (
+    decimation: TelemetryDecimation,
+  ) => Promise<TelemetryDecimation>;
 }
 
 export const GaggiaDataContext = React.createContext<IGaggiaDataContext>(
@@ -121,14 +222,76 @@ export const GaggiaDataContextProvider: React.FC<PropsWithChildren> = ({
     socket.emit('set_shot_time_limit', limit);
   }, []);
 
+  const queryTelemetryHistory = useCallback(
+    (start: Date, end: Date, points: number, method?: 'lttb' | 'minmax') =>
+      new Promise<ITelemetryData[]>((resolve) => {
+        socket.emit(
+          'query_telemetry',
+          { start: start.getTime(), end: end.getTime(), points, method },
+          (msgs: ITelemetryMessage[]) =>
+            resolve(msgs.map((d) => convertTelemetryMsgToData(d))),
+        );
+      }),
+    [],
+  );
+
+  const listShots = useCallback(
+    () =>
+      new Promise<IShotRange[]>((resolve) => {
+        socket.emit('list_shots', null, (shots: IShotRange[]) =>
+          resolve(shots),
+        );
+      }),
+    [],
+  );
+
+  const setTelemetryDecimation = useCallback(
+    (decimation: TelemetryDecimation) =>
+      new Promise<TelemetryDecimation>((resolve) => {
+        socket.emit(
+          'set_telemetry_decimation',
+          decimation,
+          (active: TelemetryDecimation) => {
+            telemetrySession.decimation = active;
+            resolve(active);
+          },
+        );
+      }),
+    [],
+  );
+
   useEffect(() => {
-    socket.on('connect', () => setSocketConnected(true));
+    socket.on('connect', () => {
+      // The server starts every new connection with a keyframe
+      liveTelemetryState = undefined;
+      setSocketConnected(true);
+    });
     socket.on('disconnect', () => setSocketConnected(false));
     socket.on('telemetry', (msg: ITelemetryMessage) => {
+      trackTelemetrySequence(msg);
       registerNewTelemetry(msg);
     });
 
+    socket.on('telemetryBinary', (buffer: ArrayBuffer) => {
+      decodeLiveTelemetryBlock(buffer).forEach((msg) => {
+        trackTelemetrySequence(msg);
+        registerNewTelemetry(msg);
+      });
+    });
+
+    socket.on('telemetrySession', (msg: { epoch: string }) => {
+      if (telemetrySession.epoch !== msg.epoch) {
+        telemetrySession.epoch = msg.epoch;
+        telemetrySession.lastSeq = undefined;
+      }
+    });
     socket.on('telemetryHistory', (msgs: ITelemetryMessage[]) => {
+      msgs.forEach(trackTelemetrySequence);
+      registerTelemetryHistory(msgs);
+    });
+    socket.on('telemetryHistoryBinary', (buffer: ArrayBuffer) => {
+      const msgs = decodeTelemetryBlock(buffer);
+      msgs.forEach(trackTelemetrySequence);
       registerTelemetryHistory(msgs);
     });
     socket.on('config', (msg: IGaggiaConfig) => {
@@ -141,7 +304,10 @@ export const GaggiaDataContextProvider: React.FC<PropsWithChildren> = ({
     return () => {
       socket.off('connect');
       socket.off('disconnect');
+      socket.off('telemetrySession');
       socket.off('telemetryHistory');
+      socket.off('telemetryHistoryBinary');
+      socket.off('telemetryBinary');
       socket.off('config');
       socket.off('telemetry');
     };
@@ -156,6 +322,9 @@ export const GaggiaDataContextProvider: React.FC<PropsWithChildren> = ({
         setShotTimeLimit,
         setBrewSetpoint,
         setSteamSetpoint,
+        queryTelemetryHistory,
+        listShots,
+        setTelemetryDecimation,
       }}
     >
       {children}
@@ -0,0 +1,453 @@
+import argparse
+import array
+import json
+import os
+import platform
+import random
+import shelve
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gaggiaserver.py")
+RESULT_FORMAT_VERSION = 1
+DEFAULT_REGRESSION_THRESHOLD = 0.2
+SERVER_START_TIMEOUT = 30.0
+CLIENT_COUNTS = (1, 10, 100)
+
+
+def bestTime(run, repeats: int) -> float:
+    """
+    Returns the shortest wall time of repeats calls of run
+    """
+    best = None
+    for _ in range(repeats):
+        started = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best == None else min(best, elapsed)
+    return best
+
+
+def benchmarkPid(config: dict) -> dict:
+    """
+    DiscretePid.step throughput of the ctypes and native bindings. Both run the same generated code, so their
+    outputs have to match exactly.
+    """
+    import simulinkpid
+    from gaggiacontroller import P_GAIN, I_GAIN, D_GAIN, FILTER_COEFF_N, OUTPUT_UPPER_LIMIT, OUTPUT_LOWER_LIMIT
+    gains = (P_GAIN, I_GAIN, D_GAIN, FILTER_COEFF_N, OUTPUT_UPPER_LIMIT, OUTPUT_LOWER_LIMIT)
+    steps = config["steps"]
+    repeats = config["repeats"]
+    random.seed(0)
+    errors = [random.uniform(-20, 20) for _ in range(steps)]
+    sampleTimes = [random.uniform(0.45, 0.55) for _ in range(steps)]
+    errorBuffer = array.array("d", errors)
+    sampleTimeBuffer = array.array("d", sampleTimes)
+
+    results = {}
+    ctypesPid = simulinkpid.CtypesDiscretePid(*gains)
+    results["pid_step_ctypes"] = (bestTime(lambda: [ctypesPid.step(e, dt) for e, dt in zip(errors, sampleTimes)],
+                                           repeats) / steps * 1e9, "ns/step")
+    if (simulinkpid.NativeDiscretePid == None):
+        print("_pidcontroller is not built, run: python3 setup.py build_ext --inplace")
+        return results
+
+    nativePid = simulinkpid.NativeDiscretePid(*gains)
+    results["pid_step_native"] = (bestTime(lambda: [nativePid.step(e, dt) for e, dt in zip(errors, sampleTimes)],
+                                           repeats) / steps * 1e9, "ns/step")
+    results["pid_step_many_native"] = (bestTime(lambda: nativePid.step_many(errorBuffer, sampleTimeBuffer),
+                                                repeats) / steps * 1e9, "ns/step")
+
+    ctypesPid = simulinkpid.CtypesDiscretePid(*gains)
+    nativePid = simulinkpid.NativeDiscretePid(*gains)
+    expected = [ctypesPid.step(e, dt) for e, dt in zip(errors, sampleTimes)]
+    if (nativePid.step_many(errorBuffer, sampleTimeBuffer) != expected):
+        raise RuntimeError("Native PID output differs from the ctypes binding")
+    return results
+
+
+def benchmarkControlStep(config: dict) -> dict:
+    """
+    Cost of one control step that takes a sample, against the simulated boiler on a virtual clock with every
+    telemetry consumer delivered synchronously
+    """
+    from gaggiacontroller import GaggiaController, SAMPLING_INTERVAL
+    from gaggiahardware import SimulatedHardware
+    from gaggiasimulation import VirtualClock
+    from temperaturesampler import TemperatureSampler
+
+    results = {}
+    for oversample in [False, True]:
+        clock = VirtualClock()
+        hardware = SimulatedHardware(clock, None, 0.2)
+        sampler = TemperatureSampler(hardware, clock, SAMPLING_INTERVAL) if oversample else None
+        delivered = []
+        controller = GaggiaController(None, None, delivered.append, True, hardware, clock=clock, configPath=None,
+                                      registerExitHandler=False, temperatureSampler=sampler)
+        controller.start(spawnThread=False)
+        steps = config["steps"] // 20
+        elapsed = None
+        for _ in range(config["repeats"]):
+            total = 0.0
+            for _ in range(steps):
+                clock.sleep(SAMPLING_INTERVAL)
+                if (sampler != None):
+                    sampler.sampleOnce()
+                started = time.perf_counter()
+                controller.tick()
+                total += time.perf_counter() - started
+            elapsed = total if elapsed == None else min(elapsed, total)
+        if (len(delivered) != steps * config["repeats"]):
+            raise RuntimeError("Control step did not take a sample on every tick")
+        name = "control_step_oversampled" if oversample else "control_step"
+        results[name] = (elapsed / steps * 1e6, "us/sample")
+    return results
+
+
+def benchmarkSerialization(config: dict) -> dict:
+    """
+    Per-sample cost of the telemetry encodings: Socket.IO dict and its JSON text, the UDP packet, the shot
+    recorder record and the binary browser block, and of sending UDP telemetry to a local socket with the
+    legacy and the batched protocol
+    """
+    from telemetrysample import TelemetrySample, UDP_PACKET, DISK_RECORD
+    from telemetrycodec import encodeTelemetryBlock
+    from udptelemetry import UdpTelemetrySender, PROTOCOL_BATCHED, PROTOCOL_LEGACY
+
+    count = config["steps"] // 10
+    random.seed(0)
+    samples = [TelemetrySample(1.7e9 + i * 0.5, i, random.uniform(20, 150), 94.0, random.random(),
+                               random.uniform(0, 30), False, False) for i in range(count)]
+    udpBuffer = bytearray(UDP_PACKET.size)
+    recordBuffer = bytearray(DISK_RECORD.size)
+    records = [dict(s.toTelemetryData(), seq=s.sampleNumber) for s in samples]
+    repeats = config["repeats"]
+
+    def toJson():
+        for sample in samples:
+            data = sample.toTelemetryData()
+            data["seq"] = sample.sampleNumber
+            json.dumps(data)
+
+    def toBlocks():
+        # Average decimation sends a block of one record per second
+        for record in records:
+            encodeTelemetryBlock([record])
+
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    # Never read, a full receive buffer drops datagrams without slowing down the sender
+    sink.bind(("127.0.0.1", 0))
+    senders = {protocol: UdpTelemetrySender([sink.getsockname()], protocol)
+               for protocol in (PROTOCOL_LEGACY, PROTOCOL_BATCHED)}
+
+    def sendUdp(sender):
+        for sample in samples:
+            sender.send(sample)
+        sender.flush()
+
+    results = {
+        "telemetry_dict": (bestTime(lambda: [s.toTelemetryData() for s in samples], repeats) / count * 1e9,
+                           "ns/sample"),
+        "telemetry_json": (bestTime(toJson, repeats) / count * 1e9, "ns/sample"),
+        "telemetry_udp_pack": (bestTime(lambda: [s.packUdpInto(udpBuffer) for s in samples], repeats) / count * 1e9,
+                               "ns/sample"),
+        "telemetry_record_pack": (bestTime(lambda: [s.packRecordInto(recordBuffer) for s in samples],
+                                           repeats) / count * 1e9, "ns/sample"),
+        "telemetry_binary_block": (bestTime(toBlocks, repeats) / count * 1e9, "ns/sample"),
+        "telemetry_binary_block_batched": (bestTime(lambda: encodeTelemetryBlock(records), repeats) / count * 1e9,
+                                           "ns/sample"),
+    }
+    for protocol, sender in senders.items():
+        results[f"telemetry_udp_send_{protocol}"] = (bestTime(lambda: sendUdp(sender), repeats) / count * 1e9,
+                                                     "ns/sample")
+        sender.close()
+    sink.close()
+    return results
+
+
+def benchmarkConfigWrite(config: dict) -> dict:
+    """
+    Latency of a setting change as seen by the caller, of the durable write behind it, and of a write to the
+    legacy shelve for comparison
+    """
+    from configstore import ConfigStore
+    writes = 50
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        store = ConfigStore(os.path.join(directory, "config"), quietPeriod=3600)
+        started = time.perf_counter()
+        for i in range(writes):
+            store.set("brew_setpoint", 90.0 + i % 10)
+        results["config_set"] = ((time.perf_counter() - started) / writes * 1e6, "us/write")
+
+        flushTimes = []
+        for i in range(writes):
+            store.set("brew_setpoint", 90.0 + i % 10)
+            started = time.perf_counter()
+            store.flush()
+            flushTimes.append(time.perf_counter() - started)
+        store.close()
+        results["config_flush"] = (statistics.median(flushTimes) * 1e6, "us/write")
+
+        shelveTimes = []
+        for i in range(writes):
+            started = time.perf_counter()
+            with shelve.open(os.path.join(directory, "legacy")) as legacy:
+                legacy["brew_setpoint"] = 90.0 + i % 10
+            shelveTimes.append(time.perf_counter() - started)
+        results["config_shelve_write"] = (statistics.median(shelveTimes) * 1e6, "us/write")
+    return results
+
+
+class ServerProcess():
+    """
+    gaggiaserver.py against the simulated boiler on a local port, run in a temporary directory so its config
+    file does not touch the working copy
+    """
+
+    def __init__(self, port: int, extraArgs: list = []):
+        self.port = port
+        self.directory = tempfile.TemporaryDirectory()
+        self.started = time.perf_counter()
+        self.process = subprocess.Popen([sys.executable, SERVER_SCRIPT, "-s", "-d", "-l", str(port)] + extraArgs,
+                                        cwd=self.directory.name, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def waitUntilServing(self) -> float:
+        """
+        Returns the seconds from launching the process until it answered an HTTP request
+        """
+        while time.perf_counter() - self.started < SERVER_START_TIMEOUT:
+            if (self.process.poll() != None):
+                raise RuntimeError("gaggiaserver.py exited during startup")
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{self.port}/metrics", timeout=1) as response:
+                    response.read()
+                return time.perf_counter() - self.started
+            except OSError:
+                time.sleep(0.01)
+        raise RuntimeError("gaggiaserver.py did not start serving in time")
+
+    def scrapeMetrics(self) -> dict:
+        """
+        Returns the unlabelled and labelled sample values of the metrics endpoint by their full name
+        """
+        with urllib.request.urlopen(f"http://127.0.0.1:{self.port}/metrics", timeout=5) as response:
+            text = response.read().decode()
+        metrics = {}
+        for line in text.splitlines():
+            if (line.startswith("#") or " " not in line):
+                continue
+            name, value = line.rsplit(" ", 1)
+            metrics[name] = float(value)
+        return metrics
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.directory.cleanup()
+
+
+def benchmarkStartup(config: dict) -> dict:
+    """
+    Seconds from launching gaggiaserver.py until it serves HTTP, in thread and control process mode
+    """
+    results = {}
+    for name, extraArgs in [("server_startup", []), ("server_startup_control_process", ["-c"])]:
+        times = []
+        for _ in range(config["startups"]):
+            server = ServerProcess(config["port"], extraArgs)
+            try:
+                times.append(server.waitUntilServing())
+            finally:
+                server.stop()
+        results[name] = (min(times), "s")
+    return results
+
+
+def benchmarkEmit(config: dict) -> dict:
+    """
+    Telemetry fan-out with 1, 10 and 100 connected Socket.IO clients receiving every sample. Reports the
+    server side sio.emit time per sample from the metrics endpoint and the delay from taking a sample to a
+    client receiving it.
+    """
+    import socketio
+    results = {}
+    server = ServerProcess(config["port"])
+    try:
+        server.waitUntilServing()
+        for clientCount in CLIENT_COUNTS:
+            delays = []
+            clients = []
+            for _ in range(clientCount):
+                client = socketio.Client()
+
+                def onTelemetry(data):
+                    delays.append(time.time() - data["ts"] / 1000)
+
+                client.on("telemetry", onTelemetry)
+                client.connect(f"http://127.0.0.1:{config['port']}", transports=["websocket"],
+                               auth={"decimation": "full"})
+                clients.append(client)
+            # Let connection setup and history replay settle before measuring
+            time.sleep(1.0)
+            delays.clear()
+            before = server.scrapeMetrics()
+            time.sleep(config["emitduration"])
+            after = server.scrapeMetrics()
+            for client in clients:
+                client.disconnect()
+
+            emitSum = 'gaggia_sio_emit_latency_seconds_sum{event="telemetry"}'
+            emitCount = 'gaggia_sio_emit_latency_seconds_count{event="telemetry"}'
+            published = "gaggia_telemetry_published_total"
+            samples = max(1.0, after[published] - before[published])
+            emits = after[emitCount] - before[emitCount]
+            if (emits == 0 or len(delays) == 0):
+                raise RuntimeError(f"No telemetry reached {clientCount} clients")
+            results[f"emit_{clientCount}_clients"] = ((after[emitSum] - before[emitSum]) / samples * 1e6,
+                                                      "us/sample")
+            delays.sort()
+            results[f"delivery_{clientCount}_clients_median"] = (delays[len(delays) // 2] * 1e3, "ms")
+            results[f"delivery_{clientCount}_clients_p95"] = (delays[int(len(delays) * 0.95)] * 1e3, "ms")
+    finally:
+        server.stop()
+    return results
+
+
+def benchmarkAggregator(config: dict) -> dict:
+    """
+    Cost of ingesting one sample into the telemetry aggregator, from many machines sending one second batches
+    of two samples and from one machine sending full datagrams, without and with the per-machine store
+    """
+    from telemetryaggregator import TelemetryAggregator
+    from telemetrysample import TelemetrySample
+    from udptelemetry import DATAGRAM_HEADER, SAMPLE_RECORD, MAX_BATCH_SIZE, packDatagramHeader, packSampleRecord
+
+    def encode(numbers: range, sequence: int) -> bytes:
+        buffer = bytearray(DATAGRAM_HEADER.size + len(numbers) * SAMPLE_RECORD.size)
+        for i, number in enumerate(numbers):
+            packSampleRecord(buffer, DATAGRAM_HEADER.size + i * SAMPLE_RECORD.size,
+                             TelemetrySample(1.7e9 + number * 0.5, number, 93.0, 94.0, 0.5, 0.0, number % 60 < 50,
+                                             False))
+        packDatagramHeader(buffer, len(numbers), 1, sequence)
+        return bytes(buffer)
+
+    machines = 50
+    count = config["steps"] // 10
+    scenarios = {
+        "small": [(encode(range(i * 2, i * 2 + 2), i), (f"10.0.0.{machine}", 7788))
+                  for i in range(count // (2 * machines)) for machine in range(machines)],
+        "full": [(encode(range(i * MAX_BATCH_SIZE, (i + 1) * MAX_BATCH_SIZE), i), ("10.0.0.1", 7788))
+                 for i in range(count // MAX_BATCH_SIZE)],
+    }
+    results = {}
+    for name, datagrams in scenarios.items():
+        sampleCount = sum((len(data) - DATAGRAM_HEADER.size) // SAMPLE_RECORD.size for data, address in datagrams)
+        for store in [False, True]:
+            with tempfile.TemporaryDirectory() as directory:
+                def ingest():
+                    aggregator = TelemetryAggregator(directory if store else None)
+                    for data, address in datagrams:
+                        aggregator.datagram_received(data, address)
+                    aggregator.close()
+                results[f"aggregator_{name}{'_stored' if store else ''}"] = (
+                    bestTime(ingest, config["repeats"]) / sampleCount * 1e9, "ns/sample")
+    return results
+
+
+BENCHMARKS = {
+    "pid": benchmarkPid,
+    "controlstep": benchmarkControlStep,
+    "serialization": benchmarkSerialization,
+    "config": benchmarkConfigWrite,
+    "startup": benchmarkStartup,
+    "emit": benchmarkEmit,
+    "aggregator": benchmarkAggregator,
+}
+
+
+def compareWithBaseline(results: dict, baseline: dict, threshold: float) -> list:
+    """
+    Prints every result next to its baseline and returns the names that got slower by more than threshold.
+    All results are costs, lower is better.
+    """
+    regressions = []
+    for name, result in results.items():
+        if (name not in baseline):
+            print(f"{name:40s} {result['value']:12.3f} {result['unit']:10s} (no baseline)")
+            continue
+        reference = baseline[name]["value"]
+        change = (result["value"] - reference) / reference if reference > 0 else 0.0
+        flag = ""
+        if (change > threshold):
+            flag = "REGRESSION"
+            regressions.append(name)
+        print(f"{name:40s} {result['value']:12.3f} {result['unit']:10s} baseline {reference:12.3f} "
+              f"{change * 100:+7.1f}% {flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the control and telemetry hot paths against the "
+                                     "simulated boiler, no hardware needed",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("benchmarks", nargs="*",
+                        help=f"Benchmarks to run out of {', '.join(BENCHMARKS.keys())}, all if none are given")
+    parser.add_argument("-n", "--steps", action="store", type=int,
+                        help="PID steps per run, the other benchmarks scale from it", default=200000)
+    parser.add_argument("-r", "--repeats", action="store", type=int,
+                        help="Runs per measurement, the best one is reported", default=5)
+    parser.add_argument("--startups", action="store", type=int,
+                        help="Server starts per startup measurement, the fastest one is reported", default=3)
+    parser.add_argument("--emitduration", action="store", type=float,
+                        help="Seconds of telemetry measured per client count", default=5.0)
+    parser.add_argument("-p", "--port", action="store", type=int,
+                        help="Local port for the benchmarked server", default=8765)
+    parser.add_argument("-o", "--output", action="store",
+                        help="Write the results as JSON to this file, usable as a later baseline", default=None)
+    parser.add_argument("-b", "--baseline", action="store",
+                        help="Compare against results JSON written earlier with --output", default=None)
+    parser.add_argument("-t", "--threshold", action="store", type=float,
+                        help="Relative slowdown against the baseline that counts as a regression",
+                        default=DEFAULT_REGRESSION_THRESHOLD)
+    config = vars(parser.parse_args())
+    for name in config["benchmarks"]:
+        if (name not in BENCHMARKS):
+            parser.error(f"unknown benchmark {name}")
+
+    results = {}
+    for name in (config["benchmarks"] if len(config["benchmarks"]) > 0 else BENCHMARKS.keys()):
+        print(f"Running {name}...", flush=True)
+        for resultName, (value, unit) in BENCHMARKS[name](config).items():
+            results[resultName] = {"value": value, "unit": unit}
+
+    baseline = {}
+    if (config["baseline"] != None):
+        with open(config["baseline"], "r") as f:
+            baseline = json.load(f)["results"]
+    regressions = compareWithBaseline(results, baseline, config["threshold"])
+
+    if (config["output"] != None):
+        document = {"version": RESULT_FORMAT_VERSION, "timestamp": time.time(),
+                    "machine": {"platform": platform.platform(), "python": platform.python_version(),
+                                "processor": platform.machine()},
+                    "config": {key: config[key] for key in ["steps", "repeats", "startups", "emitduration"]},
+                    "results": results}
+        with open(config["output"], "w") as f:
+            json.dump(document, f, indent=1, sort_keys=True)
+    if (len(regressions) > 0):
+        print(f"{len(regressions)} regressions: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
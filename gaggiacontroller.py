@@ -1,21 +1,26 @@
 import os
-import struct
 import threading
 import time
 import warnings
-import board
-import digitalio
-import pwmio
-import adafruit_max31855
-import socket
 import simulinkpid
-import shelve
 import atexit
-import eventlet
-
-eventlet.monkey_patch()
+from typing import TYPE_CHECKING
+from configstore import ConfigStore
+from temperaturesampler import TemperatureSampler
+from telemetrybus import TelemetryBus, DROP_OLDEST, DROP_NEWEST
+from telemetrysample import TelemetrySample
+from udptelemetry import UdpTelemetrySender, PROTOCOL_LEGACY, DEFAULT_BATCH_INTERVAL, FLUSH_POLL_INTERVAL
+from telemetrydecimator import TelemetryDecimator, DECIMATE_FULL
+from fixedratescheduler import FixedRateScheduler
+from controlmetrics import LatencyHistogram, MetricsWriter
+from gaggiahardware import GaggiaHardware, BlinkaHardware, originalModule
+
+if (TYPE_CHECKING):
+    # Pulls in numpy, which the control loop does not need unless shots are recorded
+    from shotrecorder import ShotRecorder
 
 SAMPLING_INTERVAL = 0.5
+CONTROL_LOOP_INTERVAL = 0.1
 P_GAIN = 0.046
 I_GAIN = 0.0018
 D_GAIN = -0.0030
@@ -25,24 +30,11 @@ OUTPUT_LOWER_LIMIT = 0.0
 DEFAULT_STEAM_SETPOINT = 150.0
 DEFAULT_BREW_SETPOINT = 94.0
 DEFAULT_BREW_FEEDFORWARD_COMPENSATION = 0.14
-
-STEAM_PIN = board.D23
-BREW_PIN = board.D12
-PUMP_PIN = board.D26
-SPI_CS_PIN = board.D8
-HEATER_PIN = board.D4
-
-spi = board.SPI()
-cs = digitalio.DigitalInOut(SPI_CS_PIN)
-max31855 = adafruit_max31855.MAX31855(spi, cs)
-steamSwitchPin = digitalio.DigitalInOut(STEAM_PIN)
-steamSwitchPin.switch_to_input(pull=digitalio.Pull.UP)
-brewSwitchPin = digitalio.DigitalInOut(BREW_PIN)
-brewSwitchPin.switch_to_input(pull=digitalio.Pull.UP)
-pumpPin = digitalio.DigitalInOut(PUMP_PIN)
-pumpPin.switch_to_output(False)
-heaterPin = pwmio.PWMOut(HEATER_PIN, frequency=2,
-                         duty_cycle=0, variable_frequency=False)
+# The heater is turned off above this boiler temperature whatever drives it
+BOILER_SAFETY_LIMIT = 175
+CALLBACK_SINK_QUEUE_SIZE = 64
+UDP_SINK_QUEUE_SIZE = 256
+RECORDER_SINK_QUEUE_SIZE = 1024
 DISABLE_PRINTS = False
 
 
@@ -53,62 +45,123 @@ def debugPrint(text: str):
 
 
 class GaggiaController():
-    def __init__(self, sio, telemetryAddress, onTelemetryCallback, disablePrints):
-        atexit.register(self.__disableOutputsAndExit)
+    def __init__(self, sio, telemetryAddresses, onTelemetryCallback, disablePrints, hardware: GaggiaHardware = None,
+                 clock=time, configPath: str = "config", registerExitHandler: bool = True,
+                 useMeasuredSampleTime: bool = False, shotRecorder: "ShotRecorder" = None,
+                 telemetryDecimation: dict = None, temperatureSampler: TemperatureSampler = None,
+                 udpProtocol: str = PROTOCOL_LEGACY, udpBatchInterval: float = DEFAULT_BATCH_INTERVAL):
+        """
+        clock provides time(), monotonic() and sleep(), the time module by default. A configPath of None
+        keeps all settings in memory only. With useMeasuredSampleTime the PID is stepped with the measured
+        time between samples instead of the nominal SAMPLING_INTERVAL. Every sample is appended to shotRecorder
+        if one is given. onTelemetryCallback is called with TelemetrySamples. telemetryDecimation maps the
+        "udp", "callback" and "recorder" consumers to a decimation mode, consumers not in it get every sample.
+        With a temperatureSampler the control loop uses its filtered estimate instead of reading the
+        thermocouple itself. UDP telemetry goes to every (host, port) in telemetryAddresses with udpProtocol.
+        """
+        self.hardware = hardware if hardware != None else BlinkaHardware()
+        self.temperatureSampler = temperatureSampler
+        self.temperatureSource = temperatureSampler if temperatureSampler != None else self.hardware
+        self.clock = clock
+        self.useMeasuredSampleTime = useMeasuredSampleTime
+        self.scheduler = FixedRateScheduler(SAMPLING_INTERVAL, clock)
+        if (registerExitHandler):
+            atexit.register(self.__disableOutputsAndExit)
         global DISABLE_PRINTS
         self.disablePrints = disablePrints
         DISABLE_PRINTS = disablePrints
-        self.sock = None
+        self.udpSender = None
         self.sio = sio
-        if (telemetryAddress != None):
-            self.telemetryAddress = telemetryAddress
-            self.sock = socket.socket(
-                socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        # Yield to the Socket.IO server's event loop when running inside it
+        self.sleep = sio.sleep if sio != None else clock.sleep
+        if (telemetryAddresses != None and len(telemetryAddresses) > 0):
+            self.udpSender = UdpTelemetrySender(telemetryAddresses, udpProtocol, udpBatchInterval)
         self.sampleNumber = 0
         self.onTelemetryCallback = onTelemetryCallback
+        self.shotRecorder = shotRecorder
+        decimation = telemetryDecimation if telemetryDecimation != None else {}
+        # Telemetry consumers run off the control loop, each with its own bounded queue
+        self.telemetryBus = TelemetryBus()
+        if (self.udpSender != None):
+            # send() is a non-blocking UDP send, so the queue only fills up while the sink thread is starved.
+            # Samples lost then are counted in telemetry_sink_dropped_total and show up as gaps in the sample
+            # numbers on the receivers. The poll sends a partial batch once it has waited udpBatchInterval.
+            self.telemetryBus.addSink("udp", self.udpSender.send, UDP_SINK_QUEUE_SIZE, DROP_OLDEST,
+                                      TelemetryDecimator(decimation.get("udp", DECIMATE_FULL)),
+                                      self.udpSender.flushIfDue, FLUSH_POLL_INTERVAL)
+        if (self.onTelemetryCallback != None):
+            self.telemetryBus.addSink("callback", self.onTelemetryCallback, CALLBACK_SINK_QUEUE_SIZE, DROP_OLDEST,
+                                      TelemetryDecimator(decimation.get("callback", DECIMATE_FULL)))
+        if (self.shotRecorder != None):
+            # Keep the oldest samples so a stalled SD card loses the end of a gap rather than punching holes in it
+            self.telemetryBus.addSink("recorder", self.shotRecorder.append, RECORDER_SINK_QUEUE_SIZE, DROP_NEWEST,
+                                      TelemetryDecimator(decimation.get("recorder", DECIMATE_FULL)))
 
+        self.isRunning = False
         self.consecutiveReadTempFails = 0
+        self.temperatureReadFailCount = 0
         self.latestValidTemp = None
+        # Heater output of an external controller, None while the PID drives the heater
+        self.remoteOutput = None
+        # Wall time spent in the stages of a control step, always measured with the real clock
+        self.stageLatency = {"temperature_read": LatencyHistogram(), "pid_step": LatencyHistogram(),
+                             "control_step": LatencyHistogram()}
         self.steam_setpoint = DEFAULT_STEAM_SETPOINT
         self.brew_setpoint = DEFAULT_BREW_SETPOINT
         self.brew_feedforward_compensation = DEFAULT_BREW_FEEDFORWARD_COMPENSATION
         self.shot_time_limit = 0
+        self.p_gain = P_GAIN
+        self.i_gain = I_GAIN
+        self.d_gain = D_GAIN
+        self.filter_coeff_n = FILTER_COEFF_N
         self.__brewStarted = 0
         self.__brewStopped = 0
         self.__lastBrewSwitchState = False
-        with shelve.open("config", ) as cfg:
-            try:
-                self.steam_setpoint = cfg["steam_setpoint"]
-            except KeyError:
-                pass
-            try:
-                self.brew_setpoint = cfg["brew_setpoint"]
-            except KeyError:
-                pass
-            try:
-                self.shot_time_limit = cfg["shot_time_limit"]
-            except KeyError:
-                pass
-            try:
-                self.brew_feedforward_compensation = cfg["brew_feedforward_compensation"]
-            except KeyError:
-                pass
-
-        if (self.shot_time_limit == None):
-            self.shot_time_limit = 0
-        if (self.brew_setpoint == None):
-            self.brew_setpoint = DEFAULT_BREW_SETPOINT
-        if (self.steam_setpoint == None):
-            self.steam_setpoint = DEFAULT_STEAM_SETPOINT
+        # Shot timer and pump state are shared with the native switch watcher thread of edge capable backends
+        self.brewSwitchLock = originalModule("threading").Lock()
+        # Pump and shot timer react to brew switch edges immediately when the backend can report them
+        self.edgeTriggeredBrewSwitch = self.hardware.setBrewSwitchCallback(
+            self.__onBrewSwitchEdge)
+        # Settings are cached in memory and written behind on a background thread
+        self.config = ConfigStore(configPath)
+        self.__loadConfig()
 
         self.pidController = simulinkpid.DiscretePid(
-            P_GAIN, I_GAIN, D_GAIN, FILTER_COEFF_N, OUTPUT_UPPER_LIMIT, OUTPUT_LOWER_LIMIT)
-
-    def start(self):
-        self.lastSampleTimestamp = time.time()
-        self.startedTime = time.time()
+            self.p_gain, self.i_gain, self.d_gain, self.filter_coeff_n, OUTPUT_UPPER_LIMIT, OUTPUT_LOWER_LIMIT)
+        self.hardware.noteSettings(self.getSettings())
+
+    def __loadConfig(self):
+        self.steam_setpoint = self.config.get("steam_setpoint", self.steam_setpoint)
+        self.brew_setpoint = self.config.get("brew_setpoint", self.brew_setpoint)
+        self.shot_time_limit = self.config.get("shot_time_limit", self.shot_time_limit)
+        self.brew_feedforward_compensation = self.config.get(
+            "brew_feedforward_compensation", self.brew_feedforward_compensation)
+        gains = [self.config.get(key) for key in ["p_gain", "i_gain", "d_gain", "filter_coeff_n"]]
+        if (None not in gains):
+            self.p_gain, self.i_gain, self.d_gain, self.filter_coeff_n = gains
+
+    def getSettings(self) -> dict:
+        return {"brew_setpoint": self.brew_setpoint, "steam_setpoint": self.steam_setpoint,
+                "shot_time_limit": self.shot_time_limit,
+                "brew_feedforward_compensation": self.brew_feedforward_compensation,
+                "p_gain": self.p_gain, "i_gain": self.i_gain, "d_gain": self.d_gain,
+                "filter_coeff_n": self.filter_coeff_n}
+
+    def start(self, spawnThread: bool = True):
+        """
+        Starts the control loop thread. With spawnThread=False the caller drives the loop by calling tick().
+        After eventlet monkey patching the thread is green and only runs once the caller yields; the heater is
+        turned off right away either way.
+        """
+        self.scheduler.start()
+        self.startedTime = self.clock.time()
         self.isRunning = True
         self.__setHeaterDutyCycle(0)
+        if (not spawnThread):
+            return
+        if (self.temperatureSampler != None):
+            self.temperatureSampler.start()
+        self.telemetryBus.start()
         self.controlLoopThread = threading.Thread(
             target=self.__controlLoop, args=())
         self.controlLoopThread.start()
@@ -116,79 +169,103 @@ class GaggiaController():
 
     def stop(self):
         self.isRunning = False
+        if (self.temperatureSampler != None):
+            self.temperatureSampler.stop()
 
-    def __trackShotDuration(self):
-        brewSwitchState = not brewSwitchPin.value
+    def __trackShotDuration(self, brewSwitchState: bool, timestamp: float):
         if (brewSwitchState and not self.__lastBrewSwitchState):
-            self.__brewStarted = time.time()
+            self.__brewStarted = timestamp
+            if (self.shotRecorder != None):
+                self.shotRecorder.startShot(timestamp)
         if (not brewSwitchState and self.__lastBrewSwitchState and self.__brewStopped < self.__brewStarted):
-            self.__brewStopped = time.time()
+            self.__brewStopped = timestamp
+            if (self.shotRecorder != None):
+                self.shotRecorder.endShot(timestamp)
         self.__lastBrewSwitchState = brewSwitchState
 
+    def __onBrewSwitchEdge(self, brewSwitchState: bool, monotonicTimestamp: float):
+        # Convert the edge time to wall clock time, shot duration is tracked in wall clock time
+        timestamp = self.clock.time() - (self.clock.monotonic() - monotonicTimestamp)
+        with self.brewSwitchLock:
+            self.__trackShotDuration(brewSwitchState, timestamp)
+            if (not brewSwitchState or not self.__limitShotDuration()):
+                self.__setPumpEnabled(brewSwitchState)
+
+    def __readBrewSwitch(self) -> bool:
+        # With edges the debounced state is used, the raw switch would pass contact bounce on to the pump
+        if (self.edgeTriggeredBrewSwitch):
+            return self.__lastBrewSwitchState
+        return self.hardware.readBrewSwitch()
+
     def __limitShotDuration(self):
-        steamingSwitchState = not steamSwitchPin.value
+        steamingSwitchState = self.hardware.readSteamSwitch()
         isShotTimerEnabled = self.shot_time_limit != None and self.shot_time_limit > 0
         if (isShotTimerEnabled and not steamingSwitchState):
-            brewDurationSeconds = round(time.time() - self.__brewStarted, 1)
+            brewDurationSeconds = round(self.clock.time() - self.__brewStarted, 1)
             if (brewDurationSeconds >= self.shot_time_limit):
                 self.__setPumpEnabled(False)
                 if (self.__brewStopped < self.__brewStarted):
-                    self.__brewStopped = time.time()
+                    self.__brewStopped = self.clock.time()
                 return True
         return False
 
+    def tick(self):
+        """
+        Runs one iteration of the control loop
+        """
+        self.hardware.noteTick()
+        # Always feeding brew switch state to pump, also when edges are handled as they happen
+        with self.brewSwitchLock:
+            brewSwitch = self.__readBrewSwitch()
+            if (not self.edgeTriggeredBrewSwitch):
+                self.__trackShotDuration(brewSwitch, self.clock.time())
+            if (not self.__limitShotDuration()):
+                self.__setPumpEnabled(brewSwitch)
+
+        self.__controlLoopLogic()
+
     def __controlLoop(self):
         while self.isRunning:
             try:
-                # Always feeding brew switch state to pump
-                brewSwitch = not brewSwitchPin.value
-                self.__trackShotDuration()
-                if (not self.__limitShotDuration()):
-                    self.__setPumpEnabled(brewSwitch)
-
-                self.__controlLoopLogic()
+                self.tick()
             except Exception as e:
                 print(e)
                 self.__disableOutputsAndExit()
 
             try:
-                self.sio.sleep(0.1)
+                # Wake up exactly on the next sampling deadline if it is due before the next poll
+                self.sleep(min(CONTROL_LOOP_INTERVAL,
+                           self.scheduler.timeUntilDue()))
             except KeyboardInterrupt:
                 self.__disableOutputsAndExit()
 
     def __disableOutputsAndExit(self):
-        self.isRunning = False
-        self.__setHeaterDutyCycle(0)
-        self.__setPumpEnabled(False)
-        heaterPin.deinit()
-        pumpPin.deinit()
-
-        digitalio.DigitalInOut(HEATER_PIN).switch_to_input(
-            pull=digitalio.Pull.DOWN)
-        digitalio.DigitalInOut(BREW_PIN).switch_to_input(
-            pull=digitalio.Pull.DOWN)
-        digitalio.DigitalInOut(STEAM_PIN).switch_to_input(
-            pull=digitalio.Pull.DOWN)
-        digitalio.DigitalInOut(PUMP_PIN).switch_to_input(
-            pull=digitalio.Pull.DOWN)
-        digitalio.DigitalInOut(SPI_CS_PIN).switch_to_input(
-            pull=digitalio.Pull.DOWN)
+        self.stop()
+        self.hardware.shutdown()
+        self.telemetryBus.stop()
+        if (self.udpSender != None):
+            # Sends the partial batch
+            self.udpSender.close()
+        self.config.close()
+        if (self.shotRecorder != None):
+            self.shotRecorder.close()
         os._exit(1)
 
     def __controlLoopLogic(self):
-        timeSinceLastSample = time.time() - self.lastSampleTimestamp
-        if (timeSinceLastSample < SAMPLING_INTERVAL):
+        timeSinceLastSample = self.scheduler.poll()
+        if (timeSinceLastSample == None):
             return
 
-        self.lastSampleTimestamp = time.time()
         self.sampleNumber += 1
+        stepStarted = time.perf_counter()
         boilerTemperature = self.__readTemperature()
+        self.stageLatency["temperature_read"].observe(time.perf_counter() - stepStarted)
         if (boilerTemperature == None):
             self.__setHeaterDutyCycle(0)
             return
 
-        brewSwitch = not brewSwitchPin.value
-        steamingSwitch = not steamSwitchPin.value
+        brewSwitch = self.__readBrewSwitch()
+        steamingSwitch = self.hardware.readSteamSwitch()
 
         # Setpoint control
         setpoint = self.brew_setpoint
@@ -199,17 +276,25 @@ class GaggiaController():
             # Forcing type to be inferred as not None
             raise Exception("No setpoint??")
 
-        # PID Control
-        pidOutput = self.pidController.step(
-            float(setpoint - boilerTemperature), float(SAMPLING_INTERVAL))
-
-        # Brew switch feedforward compensator
-        compensatorOutput = 0.0
-        # Sanity check for cases where brew switch might be intentionally activated to reduce temperature
-        if (pumpPin.value == True and not steamingSwitch and boilerTemperature < (setpoint + 6.0)):
-            compensatorOutput = DEFAULT_BREW_FEEDFORWARD_COMPENSATION
-
-        output = pidOutput + compensatorOutput
+        if (self.remoteOutput != None):
+            output = self.remoteOutput
+        else:
+            # PID Control
+            sampleTime = SAMPLING_INTERVAL
+            if (self.useMeasuredSampleTime):
+                sampleTime = timeSinceLastSample
+            pidStarted = time.perf_counter()
+            pidOutput = self.pidController.step(
+                float(setpoint - boilerTemperature), float(sampleTime))
+            self.stageLatency["pid_step"].observe(time.perf_counter() - pidStarted)
+
+            # Brew switch feedforward compensator
+            compensatorOutput = 0.0
+            # Sanity check for cases where brew switch might be intentionally activated to reduce temperature
+            if (self.hardware.getPumpEnabled() and not steamingSwitch and boilerTemperature < (setpoint + 6.0)):
+                compensatorOutput = self.brew_feedforward_compensation
+
+            output = pidOutput + compensatorOutput
         # Clamp output
         if (output > 1):
             output = 1
@@ -219,36 +304,81 @@ class GaggiaController():
         self.__setHeaterDutyCycle(output)
 
         # Safety limit
-        if (boilerTemperature > 175):
+        if (boilerTemperature > BOILER_SAFETY_LIMIT):
             self.__setHeaterDutyCycle(0)
 
-        # Send measurements over UDP
-        self.__sendUdpTelemetry(
-            boilerTemperature, steamingSwitch, brewSwitch, self.sampleNumber, output)
-
-        self.__handleTelemetryCallback(
-            boilerTemperature, setpoint)
+        # UDP, Socket.IO and recording are handled by the telemetry bus sinks
+        self.telemetryBus.publish(TelemetrySample(self.clock.time(), self.sampleNumber, boilerTemperature, setpoint,
+                                                  output, self.__getShotDuration(), brewSwitch, steamingSwitch))
+        self.stageLatency["control_step"].observe(time.perf_counter() - stepStarted)
         return
 
-    def __handleTelemetryCallback(self, temperature: float, setpoint: float):
-        shotDuration = self.__brewStopped - self.__brewStarted
-        if (self.__brewStopped < self.__brewStarted):
-            shotDuration = time.time() - self.__brewStarted
-        telemetryData = {}
-        telemetryData["ts"] = round(time.time()*1000)
-        telemetryData["temp"] = round(temperature, 2)
-        telemetryData["set"] = round(setpoint, 1)
-        telemetryData["shotdur"] = round(shotDuration, 1)
-        if (self.onTelemetryCallback == None):
-            return
-        self.onTelemetryCallback(telemetryData)
+    def __getShotDuration(self) -> float:
+        with self.brewSwitchLock:
+            shotDuration = self.__brewStopped - self.__brewStarted
+            if (self.__brewStopped < self.__brewStarted):
+                shotDuration = self.clock.time() - self.__brewStarted
+        return shotDuration
 
-    def __sendUdpTelemetry(self, temperature: float, steamingSwitchState: int, brewSwitchState: int, msgIndex: int, output: float):
-        if (self.sock == None):
-            return
-        bytes = struct.pack("<ifbbf", int(msgIndex), temperature, int(
-            steamingSwitchState), int(brewSwitchState), float(output))
-        self.sock.sendto(bytes, self.telemetryAddress)
+    def getTelemetryStats(self) -> dict:
+        """
+        Delivered, dropped, failed and queued sample counts per telemetry sink
+        """
+        return self.telemetryBus.getStats()
+
+    def getTelemetryBacklog(self) -> int:
+        """
+        Samples waiting for the telemetry callback, i.e. for the Socket.IO emits of the web server
+        """
+        return sum(len(sink.queue) for sink in self.telemetryBus.sinks if sink.name == "callback")
+
+    def writeMetrics(self, writer: MetricsWriter):
+        """
+        Adds the control loop, thermocouple, telemetry and config metrics to a scrape. Only reads counters that
+        are kept up to date anyway.
+        """
+        writer.addHistogram("control_stage_latency_seconds", "Wall time of the control step stages",
+                            [({"stage": stage}, histogram) for stage, histogram in self.stageLatency.items()])
+        scheduler = self.scheduler
+        writer.addHistogram("loop_lateness_seconds", "Lateness of control steps after their deadline",
+                            scheduler.latenessHistogram)
+        writer.addGauge("loop_max_lateness_seconds", "Largest control step lateness", scheduler.maxLateness)
+        writer.addCounter("loop_steps_total", "Control steps taken", scheduler.cycleCount)
+        writer.addCounter("loop_late_steps_total", "Control steps later than the late threshold",
+                          scheduler.lateCount)
+        writer.addCounter("loop_missed_deadlines_total", "Control step deadlines skipped entirely",
+                          scheduler.missedCount)
+        writer.addCounter("thermocouple_read_failures_total",
+                          "Control steps without a valid temperature", self.temperatureReadFailCount)
+        if (self.temperatureSampler != None):
+            samplerStats = self.temperatureSampler.getStats()
+            writer.addCounter("thermocouple_reads_total", "Thermocouple reads by the sampler",
+                              samplerStats["reads"])
+            writer.addCounter("thermocouple_faults_total", "Faulted or implausible thermocouple reads",
+                              samplerStats["faults"])
+            writer.addCounter("thermocouple_outliers_total", "Thermocouple reads rejected as spikes",
+                              samplerStats["outliers"])
+        sinks = self.telemetryBus.sinks
+        writer.addCounter("telemetry_published_total", "Samples published on the telemetry bus",
+                          self.telemetryBus.publishedCount)
+        writer.addCounter("telemetry_bus_dropped_total", "Samples dropped before the dispatcher reached them",
+                          self.telemetryBus.droppedCount)
+        writer.addHistogram("telemetry_sink_latency_seconds", "Wall time of telemetry sink handlers",
+                            [({"sink": sink.name}, sink.latency) for sink in sinks])
+        writer.addCounter("telemetry_sink_delivered_total", "Samples delivered to telemetry sinks",
+                          [({"sink": sink.name}, sink.deliveredCount) for sink in sinks])
+        writer.addCounter("telemetry_sink_dropped_total", "Samples dropped by full telemetry sink queues",
+                          [({"sink": sink.name}, sink.droppedCount) for sink in sinks])
+        writer.addCounter("telemetry_sink_errors_total", "Failed telemetry sink handler calls",
+                          [({"sink": sink.name}, sink.errorCount) for sink in sinks])
+        writer.addGauge("telemetry_sink_queue_depth", "Samples queued per telemetry sink",
+                        [({"sink": sink.name}, len(sink.queue)) for sink in sinks])
+        if (self.udpSender != None):
+            writer.addCounter("udp_datagrams_sent_total", "UDP telemetry datagrams sent to all subscribers",
+                              self.udpSender.datagramCount)
+            writer.addCounter("udp_send_errors_total", "UDP telemetry datagrams that could not be sent",
+                              self.udpSender.sendErrorCount)
+        writer.addCounter("config_writes_total", "Config files written", self.config.writeCount)
 
     def __readTemperature(self):
         """
@@ -256,11 +386,12 @@ class GaggiaController():
         """
 
         try:
-            self.latestValidTemp = max31855.temperature
+            self.latestValidTemp = self.temperatureSource.readTemperature()
             self.consecutiveReadTempFails = 0
             return self.latestValidTemp
         except RuntimeError as e:
             self.consecutiveReadTempFails = self.consecutiveReadTempFails + 1
+            self.temperatureReadFailCount += 1
             print(
                 f"Error during readTemperature {e}. Returning latest valid temperature: {self.latestValidTemp}")
             if (self.consecutiveReadTempFails > 10):
@@ -269,11 +400,11 @@ class GaggiaController():
                     "Too many consecutive temperature read failures.", e)
 
     def __setPumpEnabled(self, state: bool):
-        pumpPin.value = state
+        self.hardware.setPumpEnabled(state)
 
     def __setHeaterDutyCycle(self, dutyCycleFraction: float):
         """
-        Sets heater pin PWM duty cycle from dutyCycleFraction between (0-1), mapping it to (0 - 65535) accordingly
+        Sets heater PWM duty cycle from dutyCycleFraction between (0-1), clamping it to that range
         """
         if (dutyCycleFraction > 1.0):
             warnings.warn(
@@ -283,49 +414,75 @@ class GaggiaController():
             warnings.warn(
                 f"setHeaterDutyCycle dutyCycleFraction should be between 0 and 1, value was {dutyCycleFraction}. Clamped to 0.")
             dutyCycleFraction = 0.0
-        heaterPin.duty_cycle = round(dutyCycleFraction * 65535)
+        self.hardware.setHeaterDutyCycle(dutyCycleFraction)
 
-    def setBrewSetpoint(self, setpoint: float):
-        if (type(setpoint) == int or type(setpoint) == float and setpoint >= 80 and setpoint <= 110):
-            self.brew_setpoint = setpoint
-            with shelve.open("config", ) as cfg:
-                cfg["brew_setpoint"] = setpoint
+    def setRemoteOutput(self, output: float):
+        """
+        Hands the heater to an external controller. output replaces the PID output from now on and is applied
+        right away rather than on the next control step, unless the loop is not running or the last
+        temperature read failed or exceeded the safety limit. None gives the heater back to the PID.
+        """
+        if (output != None):
+            output = min(1.0, max(0.0, output))
+        self.remoteOutput = output
+        if (output == None or not self.isRunning):
+            return
+        if (self.latestValidTemp == None or self.consecutiveReadTempFails > 0 or
+                self.latestValidTemp > BOILER_SAFETY_LIMIT):
+            output = 0.0
+        self.__setHeaterDutyCycle(output)
 
-            debugPrint(f"Brew setpoint set to {setpoint:.1f}")
-            return True
-        return False
+    def setBrewSetpoint(self, setpoint: float):
+        if (not self.config.set("brew_setpoint", setpoint)):
+            return False
+        self.brew_setpoint = setpoint
+        self.hardware.noteSettings(self.getSettings())
+        debugPrint(f"Brew setpoint set to {setpoint:.1f}")
+        return True
 
     def setSteamSetpoint(self, setpoint: float):
-        if (type(setpoint) == int or type(setpoint) == float and setpoint >= 120 and setpoint <= 160):
-            self.steam_setpoint = setpoint
-            with shelve.open("config", ) as cfg:
-                cfg["steam_setpoint"] = setpoint
-            debugPrint(f"Steam setpoint set to {setpoint:.1f}")
-            return True
-        return False
+        if (not self.config.set("steam_setpoint", setpoint)):
+            return False
+        self.steam_setpoint = setpoint
+        self.hardware.noteSettings(self.getSettings())
+        debugPrint(f"Steam setpoint set to {setpoint:.1f}")
+        return True
 
     def setShotTimeLimit(self, limitSeconds: float):
-        if (type(limitSeconds) == int or type(limitSeconds) == float and limitSeconds >= 0 and limitSeconds <= 45):
-            self.shot_time_limit = limitSeconds
-            with shelve.open("config", ) as cfg:
-                cfg["shot_time_limit"] = limitSeconds
-            debugPrint(f"Shot time limit set to {limitSeconds:.1f}")
-            return True
-        return False
+        if (not self.config.set("shot_time_limit", limitSeconds)):
+            return False
+        self.shot_time_limit = limitSeconds
+        self.hardware.noteSettings(self.getSettings())
+        debugPrint(f"Shot time limit set to {limitSeconds:.1f}")
+        return True
 
     def setBrewFeedForwardCompensation(self, brewCompensation: float):
-        if (type(brewCompensation) == int or type(brewCompensation) == float and brewCompensation >= 0 and brewCompensation <= 0.3):
-            self.brew_feedforward_compensation = brewCompensation
-            with shelve.open("config", ) as cfg:
-                cfg["brew_feedforward_compensation"] = brewCompensation
-            debugPrint(
-                f"Brew feedforward compensation set to {brewCompensation:.2f}")
-            return True
-        return False
+        if (not self.config.set("brew_feedforward_compensation", brewCompensation)):
+            return False
+        self.brew_feedforward_compensation = brewCompensation
+        self.hardware.noteSettings(self.getSettings())
+        debugPrint(
+            f"Brew feedforward compensation set to {brewCompensation:.2f}")
+        return True
+
+    def setPidGains(self, pGain: float, iGain: float, dGain: float, filterCoeff: float):
+        if (not self.config.update({"p_gain": pGain, "i_gain": iGain, "d_gain": dGain,
+                                    "filter_coeff_n": filterCoeff})):
+            return False
+        self.p_gain = pGain
+        self.i_gain = iGain
+        self.d_gain = dGain
+        self.filter_coeff_n = filterCoeff
+        self.pidController.setGains(
+            pGain, iGain, dGain, filterCoeff, OUTPUT_UPPER_LIMIT, OUTPUT_LOWER_LIMIT)
+        self.hardware.noteSettings(self.getSettings())
+        debugPrint(
+            f"PID gains set to P: {pGain}, I: {iGain}, D: {dGain}, N: {filterCoeff}")
+        return True
 
     def __del__(self):
         self.__setHeaterDutyCycle(0)
         self.__setPumpEnabled(False)
         self.isRunning = False
-        if (self.sock != None):
-            self.sock.close()
+        if (self.udpSender != None):
+            self.udpSender.sock.close()
@@ -0,0 +1,312 @@
+import math
+import random
+import sys
+import time
+
+STEAM_PIN_NAME = "D23"
+BREW_PIN_NAME = "D12"
+PUMP_PIN_NAME = "D26"
+SPI_CS_PIN_NAME = "D8"
+HEATER_PIN_NAME = "D4"
+
+# Gaggia Classic Pro boiler, roughly
+SIM_AMBIENT_TEMPERATURE = 22.0
+SIM_HEATER_POWER = 1370.0  # W
+SIM_HEAT_CAPACITY = 1150.0  # J/K, boiler body + water
+SIM_HEAT_LOSS_COEFF = 1.6  # W/K to ambient
+SIM_PUMP_FLOW_RATE = 2.5  # ml/s of cold water replacing brewed water
+SIM_WATER_HEAT_CAPACITY = 4.186  # J/(ml*K)
+
+SWITCH_POLL_INTERVAL = 0.002
+SWITCH_DEBOUNCE_TIME = 0.03
+
+
+def originalModule(name: str):
+    """
+    Returns the module as it was before eventlet monkey patching, so that native threads can be used for I/O
+    that must not wait on the web server's event loop
+    """
+    if ("eventlet" not in sys.modules):
+        # Nothing can have been patched
+        return __import__(name)
+    from eventlet import patcher
+    return patcher.original(name)
+
+
+class SwitchEdgeDetector():
+    """
+    Leading-edge debouncer. A change is reported as soon as it is seen, with the time it was seen, and further
+    changes are ignored for debounceTime so that contact bounce cannot toggle the pump.
+    """
+
+    def __init__(self, initialState: bool, debounceTime: float = SWITCH_DEBOUNCE_TIME):
+        self.state = initialState
+        self.debounceTime = debounceTime
+        self.lastEdgeTimestamp = None
+
+    def update(self, rawState: bool, timestamp: float) -> bool:
+        """
+        Returns True when rawState produced a debounced edge
+        """
+        if (rawState == self.state):
+            return False
+        if (self.lastEdgeTimestamp != None and timestamp - self.lastEdgeTimestamp < self.debounceTime):
+            return False
+        self.state = rawState
+        self.lastEdgeTimestamp = timestamp
+        return True
+
+
+class GaggiaHardware():
+    """
+    I/O backend interface used by GaggiaController. Switch states are logical (True = switch turned on),
+    heater duty cycle is a fraction between 0 and 1.
+    """
+
+    def readTemperature(self) -> float:
+        """
+        Returns the boiler temperature in celcius. Raises RuntimeError on a thermocouple fault.
+        """
+        raise NotImplementedError()
+
+    def readBrewSwitch(self) -> bool:
+        raise NotImplementedError()
+
+    def readSteamSwitch(self) -> bool:
+        raise NotImplementedError()
+
+    def setBrewSwitchCallback(self, callback) -> bool:
+        """
+        Registers callback(state, monotonicTimestamp) to be called on every debounced brew switch edge.
+        Returns False if the backend cannot detect edges, in which case the switch has to be polled.
+        """
+        return False
+
+    def setPumpEnabled(self, state: bool):
+        raise NotImplementedError()
+
+    def getPumpEnabled(self) -> bool:
+        raise NotImplementedError()
+
+    def setHeaterDutyCycle(self, dutyCycleFraction: float):
+        raise NotImplementedError()
+
+    def shutdown(self):
+        """
+        Turns heater and pump off and releases all pins
+        """
+        raise NotImplementedError()
+
+    def noteSettings(self, settings: dict):
+        """
+        Called by the controller with all of its settings whenever one changes. Only of interest to backends
+        that record I/O.
+        """
+        pass
+
+    def noteTick(self):
+        """
+        Called by the controller at the start of every control loop iteration, for backends that record I/O
+        """
+        pass
+
+
+class BlinkaHardware(GaggiaHardware):
+    """
+    Real Raspberry Pi backend using Adafruit Blinka and the MAX31855 thermocouple amplifier
+    """
+
+    def __init__(self):
+        # Imported here so that the rest of the controller can be imported without a Pi
+        import board
+        import digitalio
+        import pwmio
+        import adafruit_max31855
+
+        self.board = board
+        self.digitalio = digitalio
+        self.spi = board.SPI()
+        self.cs = digitalio.DigitalInOut(getattr(board, SPI_CS_PIN_NAME))
+        self.max31855 = adafruit_max31855.MAX31855(self.spi, self.cs)
+        self.steamSwitchPin = digitalio.DigitalInOut(
+            getattr(board, STEAM_PIN_NAME))
+        self.steamSwitchPin.switch_to_input(pull=digitalio.Pull.UP)
+        self.brewSwitchPin = digitalio.DigitalInOut(
+            getattr(board, BREW_PIN_NAME))
+        self.brewSwitchPin.switch_to_input(pull=digitalio.Pull.UP)
+        self.pumpPin = digitalio.DigitalInOut(getattr(board, PUMP_PIN_NAME))
+        self.pumpPin.switch_to_output(False)
+        self.heaterPin = pwmio.PWMOut(getattr(board, HEATER_PIN_NAME), frequency=2,
+                                      duty_cycle=0, variable_frequency=False)
+        self.brewSwitchCallback = None
+        self.switchWatcherThread = None
+        self.watchingSwitches = False
+
+    def readTemperature(self) -> float:
+        return self.max31855.temperature
+
+    def readBrewSwitch(self) -> bool:
+        return not self.brewSwitchPin.value
+
+    def readSteamSwitch(self) -> bool:
+        return not self.steamSwitchPin.value
+
+    def setBrewSwitchCallback(self, callback) -> bool:
+        self.brewSwitchCallback = callback
+        if (self.switchWatcherThread == None):
+            self.watchingSwitches = True
+            self.switchWatcherThread = originalModule("threading").Thread(
+                target=self.__watchSwitches, args=(), daemon=True)
+            self.switchWatcherThread.start()
+        return True
+
+    def __watchSwitches(self):
+        # Native thread: polls the brew switch every few milliseconds independently of the control loop
+        nativeTime = originalModule("time")
+        detector = SwitchEdgeDetector(self.readBrewSwitch())
+        while self.watchingSwitches:
+            try:
+                if (detector.update(self.readBrewSwitch(), nativeTime.monotonic())):
+                    self.brewSwitchCallback(
+                        detector.state, detector.lastEdgeTimestamp)
+            except Exception as e:
+                print(f"Error in brew switch watcher: {e}")
+            nativeTime.sleep(SWITCH_POLL_INTERVAL)
+
+    def setPumpEnabled(self, state: bool):
+        self.pumpPin.value = state
+
+    def getPumpEnabled(self) -> bool:
+        return self.pumpPin.value
+
+    def setHeaterDutyCycle(self, dutyCycleFraction: float):
+        self.heaterPin.duty_cycle = round(dutyCycleFraction * 65535)
+
+    def shutdown(self):
+        self.watchingSwitches = False
+        self.setHeaterDutyCycle(0)
+        self.setPumpEnabled(False)
+        self.heaterPin.deinit()
+        self.pumpPin.deinit()
+
+        for pinName in [HEATER_PIN_NAME, BREW_PIN_NAME, STEAM_PIN_NAME, PUMP_PIN_NAME, SPI_CS_PIN_NAME]:
+            self.digitalio.DigitalInOut(getattr(self.board, pinName)).switch_to_input(
+                pull=self.digitalio.Pull.DOWN)
+
+
+class BoilerModel():
+    """
+    First-order thermal model of the boiler. Heater power and the cold water pulled in by the pump
+    are held constant between updates, so each update integrates the ODE exactly.
+    """
+
+    def __init__(self, temperature: float = SIM_AMBIENT_TEMPERATURE, ambientTemperature: float = SIM_AMBIENT_TEMPERATURE,
+                 heaterPower: float = SIM_HEATER_POWER, heatCapacity: float = SIM_HEAT_CAPACITY,
+                 heatLossCoeff: float = SIM_HEAT_LOSS_COEFF, pumpFlowRate: float = SIM_PUMP_FLOW_RATE):
+        self.temperature = temperature
+        self.ambientTemperature = ambientTemperature
+        self.heaterPower = heaterPower
+        self.heatCapacity = heatCapacity
+        self.heatLossCoeff = heatLossCoeff
+        self.pumpFlowRate = pumpFlowRate
+
+    def advance(self, dt: float, heaterDutyCycle: float, pumpEnabled: bool) -> float:
+        if (dt <= 0):
+            return self.temperature
+        # C * dT/dt = P*u - k*(T - Ta) - q*cp*(T - Ta)
+        conductance = self.heatLossCoeff
+        if (pumpEnabled):
+            conductance += self.pumpFlowRate * SIM_WATER_HEAT_CAPACITY
+        equilibrium = self.ambientTemperature + \
+            self.heaterPower * heaterDutyCycle / conductance
+        decay = math.exp(-conductance / self.heatCapacity * dt)
+        self.temperature = equilibrium + \
+            (self.temperature - equilibrium) * decay
+        return self.temperature
+
+
+class SimulatedHardware(GaggiaHardware):
+    """
+    In-process backend driving a BoilerModel. Time is read from clock.monotonic(), so passing a virtual
+    clock runs the plant faster than real time.
+    """
+
+    def __init__(self, clock=time, boiler: BoilerModel = None, temperatureNoise: float = 0.0):
+        self.clock = clock
+        self.boiler = boiler if boiler != None else BoilerModel()
+        self.temperatureNoise = temperatureNoise
+        self.brewSwitch = False
+        self.steamSwitch = False
+        self.pumpEnabled = False
+        self.heaterDutyCycle = 0.0
+        self.failingReads = 0
+        self.brewSwitchCallback = None
+        # Edges go through the same debouncer as on the machine
+        self.brewSwitchDetector = SwitchEdgeDetector(False)
+        self.lastUpdateTimestamp = clock.monotonic()
+        # The plant is advanced from the control loop and from a temperature sampler thread
+        self.plantLock = originalModule("threading").Lock()
+
+    def __updatePlant(self):
+        with self.plantLock:
+            now = self.clock.monotonic()
+            self.boiler.advance(now - self.lastUpdateTimestamp,
+                                self.heaterDutyCycle, self.pumpEnabled)
+            self.lastUpdateTimestamp = now
+
+    def readTemperature(self) -> float:
+        self.__updatePlant()
+        if (self.failingReads > 0):
+            self.failingReads -= 1
+            raise RuntimeError("thermocouple not connected")
+        if (self.temperatureNoise > 0):
+            return self.boiler.temperature + random.gauss(0, self.temperatureNoise)
+        return self.boiler.temperature
+
+    def readBrewSwitch(self) -> bool:
+        return self.brewSwitch
+
+    def readSteamSwitch(self) -> bool:
+        return self.steamSwitch
+
+    def setBrewSwitchCallback(self, callback) -> bool:
+        self.brewSwitchCallback = callback
+        return True
+
+    def setPumpEnabled(self, state: bool):
+        self.__updatePlant()
+        self.pumpEnabled = bool(state)
+
+    def getPumpEnabled(self) -> bool:
+        return self.pumpEnabled
+
+    def setHeaterDutyCycle(self, dutyCycleFraction: float):
+        self.__updatePlant()
+        self.heaterDutyCycle = dutyCycleFraction
+
+    def shutdown(self):
+        self.setHeaterDutyCycle(0)
+        self.setPumpEnabled(False)
+
+    def setBrewSwitch(self, state: bool):
+        self.brewSwitch = state
+        self.__pollBrewSwitch()
+
+    def noteTick(self):
+        # Stands in for the later polls of the switch watcher thread, which report a change that was held back
+        # by the debounce time
+        self.__pollBrewSwitch()
+
+    def __pollBrewSwitch(self):
+        detector = self.brewSwitchDetector
+        if (detector.update(self.brewSwitch, self.clock.monotonic()) and self.brewSwitchCallback != None):
+            self.brewSwitchCallback(detector.state, detector.lastEdgeTimestamp)
+
+    def setSteamSwitch(self, state: bool):
+        self.steamSwitch = state
+
+    def failNextReads(self, count: int):
+        """
+        Makes the next count temperature reads raise like a faulted MAX31855
+        """
+        self.failingReads = count
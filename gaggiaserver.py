@@ -1,90 +1,323 @@
 import math
-import threading
-from time import time
-import socketio
+from time import time, perf_counter
 import argparse
-from eventlet import wsgi, listen, monkey_patch
-from gaggiacontroller import GaggiaController
 import collections
+import secrets
+import signal
+import sys
+import atexit
+from controlmetrics import LatencyHistogram, MetricsWriter, StartupTimer, CONTENT_TYPE
 
-monkey_patch()
-print(f"Monkeypatched: {threading.current_thread.__module__}")
+# Everything imported before this is counted as interpreter startup
+startupTimer = StartupTimer()
+
+from gaggiahardware import BlinkaHardware, SimulatedHardware
+from telemetrysample import TelemetrySample
+from telemetrycodec import encodeTelemetryBlock, TelemetryStreamEncoder
+from telemetrydecimator import TelemetryDecimator, DECIMATION_MODES, DECIMATE_AVERAGE, DECIMATE_FULL
+from udptelemetry import parseAddress, UDP_PROTOCOLS, PROTOCOL_LEGACY, DEFAULT_BATCH_INTERVAL
 
 
 parser = argparse.ArgumentParser(description="PID Control and SocketIO server for Gaggia Classic Pro",
                                  formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-parser.add_argument("-i", "--ip", action="store",
-                    help="Send UDP telemetry to ip address", required=False, default=None)
-parser.add_argument("-p", "--port", action="store",
+parser.add_argument("-i", "--ip", action="append",
+                    help="Send UDP telemetry to ip address or ip:port, repeat for more subscribers", required=False,
+                    default=None)
+parser.add_argument("-p", "--port", action="store", type=int,
                     help="Send UDP telemetry to port", default=7788)
+parser.add_argument("--udpprotocol", action="store", choices=UDP_PROTOCOLS,
+                    help="UDP telemetry format. legacy is the one 14 byte \"<ifbbf\" datagram per sample format of "
+                    "the Simulink model, batched the sequenced multi-sample datagram format read by "
+                    "telemetryreceiver.py", default=PROTOCOL_LEGACY)
+parser.add_argument("--udpbatchinterval", action="store", type=float,
+                    help="Longest time a sample waits for a batched UDP datagram to fill up", default=DEFAULT_BATCH_INTERVAL)
 parser.add_argument("-d", "--disableprints", action="store_true",
                     help="Disable prints", default=False)
+parser.add_argument("-s", "--simulate", action="store_true",
+                    help="Run against a simulated boiler instead of the Pi hardware", default=False)
+parser.add_argument("-l", "--listenport", action="store", type=int,
+                    help="Port for the web server", default=80)
+parser.add_argument("-m", "--measureddt", action="store_true",
+                    help="Step the PID with the measured sample period instead of the nominal one", default=False)
+parser.add_argument("-r", "--recorddir", action="store",
+                    help="Record every control sample into per-shot segment files in this directory", default=None)
+parser.add_argument("--recordio", action="store",
+                    help="Record all hardware I/O into this directory for replaying with hardwarerecording.py",
+                    default=None)
+parser.add_argument("-c", "--controlprocess", action="store_true",
+                    help="Run the control loop in a dedicated process", default=False)
+parser.add_argument("--directread", action="store_true",
+                    help="Read the thermocouple once per control step instead of oversampling it on a thread",
+                    default=False)
+parser.add_argument("--browserdecimation", action="store", choices=DECIMATION_MODES,
+                    help="Default telemetry decimation for browsers, clients can pick their own", default=DECIMATE_AVERAGE)
+parser.add_argument("--udpdecimation", action="store", choices=DECIMATION_MODES,
+                    help="Decimation of the UDP telemetry", default=DECIMATE_FULL)
 args = parser.parse_args()
 config = vars(args)
 DATA_SEND_IP = config["ip"]
 DATA_SEND_PORT = config["port"]
 DISABLE_PRINTS = config["disableprints"]
+SIMULATE_HARDWARE = config["simulate"]
+LISTEN_PORT = config["listenport"]
+USE_CONTROL_PROCESS = config["controlprocess"]
+USE_MEASURED_SAMPLE_TIME = config["measureddt"]
+RECORD_DIRECTORY = config["recorddir"]
+RECORD_IO_DIRECTORY = config["recordio"]
+BROWSER_DECIMATION = config["browserdecimation"]
+UDP_DECIMATION = config["udpdecimation"]
+UDP_PROTOCOL = config["udpprotocol"]
+UDP_BATCH_INTERVAL = config["udpbatchinterval"]
+OVERSAMPLE_TEMPERATURE = not config["directread"]
+TELEMETRY_POLL_INTERVAL = 0.1
+FRONTEND_DIRECTORY = "./frontendBuild"
 MAX_RETAINED_TELEMETRY_HISTORY = 30
-telemetryAddress = None
+telemetryAddresses = []
 if (DATA_SEND_IP != None):
-    telemetryAddress = (DATA_SEND_IP, DATA_SEND_PORT)
+    telemetryAddresses = [parseAddress(address, DATA_SEND_PORT) for address in DATA_SEND_IP]
 
-# create a Socket.IO server
-sio = socketio.Server(async_mode="eventlet", cors_allowed_origins="*")
-# wrap with a WSGI application
-app = socketio.WSGIApp(sio)
 
+def debugPrint(text: str):
+    if (DISABLE_PRINTS):
+        return
+    print(text)
 
-telemetryHistory = collections.deque(maxlen=MAX_RETAINED_TELEMETRY_HISTORY)
 
-telemetryCount = 1
+terminationRequested = False
 
 
-def sendAndStoreTelemetry(telemetryData: dict):
-    global telemetryHistory
-    global telemetryCount
-    telemetryCount = telemetryCount + 1
-    if (telemetryCount % 2 == 0):  # Skip every other telemetry for a 1 sec send interval
-        return
+def onTerminate(signum, frame):
+    # Only unwinds the web server, the controller is stopped from the main greenlet once it has returned
+    global terminationRequested
+    terminationRequested = True
+    sys.exit(0)
+
 
-    telemetryHistory.append(telemetryData)
-    sio.emit("telemetry", telemetryData)
+signal.signal(signal.SIGTERM, onTerminate)
+startupTimer.phase("arguments")
 
+# Startup brings the heater to a known off state before the web server's slow imports. The control process gets its
+# own interpreter and starts alongside the web server. The in-process control loop is a green thread that is created
+# before the web server but only runs once the main greenlet yields in wsgi.server.
+if (USE_CONTROL_PROCESS):
+    from controlprocess import ControllerProcess
+    gaggiaController = ControllerProcess(telemetryAddresses, DISABLE_PRINTS, SIMULATE_HARDWARE, USE_MEASURED_SAMPLE_TIME,
+                                         RECORD_DIRECTORY, UDP_DECIMATION, OVERSAMPLE_TEMPERATURE, RECORD_IO_DIRECTORY,
+                                         UDP_PROTOCOL, UDP_BATCH_INTERVAL)
+    atexit.register(gaggiaController.stop)
+    gaggiaController.spawn()
+else:
+    if (SIMULATE_HARDWARE):
+        hardware = SimulatedHardware()
+    else:
+        hardware = BlinkaHardware()
+    if (RECORD_IO_DIRECTORY != None):
+        from hardwarerecording import recordHardware
+        hardware = recordHardware(hardware, RECORD_IO_DIRECTORY, OVERSAMPLE_TEMPERATURE)
+startupTimer.phase("hardware")
+
+import threading
+from eventlet import wsgi, listen, monkey_patch
 
-def emitInitialDataOnConnect():
+monkey_patch()
+print(f"Monkeypatched: {threading.current_thread.__module__}")
+startupTimer.phase("eventlet")
+
+# Wall time of every telemetry sio.emit, by event
+emitLatency = {"telemetry": LatencyHistogram(), "telemetryBinary": LatencyHistogram()}
+
+
+def serveMetrics(environ, start_response):
+    """
+    Serves GET /metrics in the Prometheus text format. Everything is read from counters that are kept
+    anyway, so the control loop does no extra work unless somebody scrapes.
+    """
+    if (environ["PATH_INFO"] != "/metrics"):
+        start_response("404 Not Found", [("Content-Type", "text/plain")])
+        return [b"Not Found"]
+    writer = MetricsWriter()
+    gaggiaController.writeMetrics(writer)
+    writer.addHistogram("sio_emit_latency_seconds", "Wall time of telemetry Socket.IO emits",
+                        [({"event": event}, histogram) for event, histogram in emitLatency.items()])
+    writer.addGauge("connected_clients", "Connected Socket.IO clients", len(clientTelemetry))
+    writer.addGauge("emit_queue_depth", "Telemetry samples waiting to be emitted to clients",
+                    gaggiaController.getTelemetryBacklog())
+    startupTimer.writeMetrics(writer)
+    body = writer.render().encode()
+    start_response("200 OK", [("Content-Type", CONTENT_TYPE),
+                              ("Content-Length", str(len(body)))])
+    return [body]
+
+
+# History holds the telemetry of the default browser decimation
+telemetryHistory = collections.deque(maxlen=MAX_RETAINED_TELEMETRY_HISTORY)
+# Sequence number of the newest record that has fallen out of telemetryHistory
+telemetryHistoryFloor = 0
+
+# Telemetry sequence numbers restart with the server, clients only resume within the same epoch
+telemetryEpoch = secrets.token_hex(4)
+telemetrySequence = 0
+# Every browser is in the room of exactly one decimation mode and encoding
+browserDecimators = {mode: TelemetryDecimator(
+    mode) for mode in DECIMATION_MODES}
+# Delta state of the live stream of every binary room, reset whenever a client joins the room
+browserEncoders = {mode: TelemetryStreamEncoder() for mode in DECIMATION_MODES}
+# sid: (decimation mode, binary encoding)
+clientTelemetry = {}
+
+
+def telemetryRoom(mode: str, binary: bool) -> str:
+    return f"telemetry-{mode}-{'binary' if binary else 'json'}"
+
+
+def joinTelemetryRoom(sid, mode: str, binary: bool):
+    clientTelemetry[sid] = (mode, binary)
+    sio.enter_room(sid, telemetryRoom(mode, binary))
+    if (binary):
+        # The new client has no delta state yet, the next block of the room is a keyframe for everybody
+        browserEncoders[mode].reset()
+
+
+def sendAndStoreTelemetry(sample: TelemetrySample):
+    """
+    Takes every control loop sample. Each sample gets the next sequence number, so the records of all
+    decimation modes share one ordering even though most modes skip some of them. Binary rooms get delta
+    blocks that continue from the previous block of the room.
+    """
     global telemetryHistory
-    sio.emit("telemetryHistory", list(telemetryHistory))
+    global telemetryHistoryFloor
+    global telemetrySequence
+    telemetrySequence = telemetrySequence + 1
+    sample = sample._replace(sampleNumber=telemetrySequence)
+    # Only encode for rooms somebody is listening to
+    activeRooms = set(clientTelemetry.values())
+    for mode, decimator in browserDecimators.items():
+        records = []
+        for decimated in decimator.update(sample):
+            telemetryData = decimated.toTelemetryData()
+            telemetryData["seq"] = decimated.sampleNumber
+            records.append(telemetryData)
+            if (mode == BROWSER_DECIMATION):
+                if (len(telemetryHistory) == telemetryHistory.maxlen):
+                    telemetryHistoryFloor = telemetryHistory[0]["seq"]
+                telemetryHistory.append(telemetryData)
+        if (len(records) == 0):
+            continue
+        if ((mode, False) in activeRooms):
+            for telemetryData in records:
+                started = perf_counter()
+                sio.emit("telemetry", telemetryData,
+                         room=telemetryRoom(mode, False))
+                emitLatency["telemetry"].observe(perf_counter() - started)
+        if ((mode, True) in activeRooms):
+            started = perf_counter()
+            sio.emit("telemetryBinary", browserEncoders[mode].encode(records),
+                     room=telemetryRoom(mode, True))
+            emitLatency["telemetryBinary"].observe(perf_counter() - started)
+
+
+def emitInitialDataOnConnect(sid, auth, binary: bool):
+    """
+    Sends the connecting client the history it is missing. A client that reconnects within the same epoch
+    with the last sequence number it received only gets the newer records. Binary clients get the history
+    as one keyframe block, independent of the delta state of their live stream.
+    """
+    global telemetryHistory
+    sio.emit("telemetrySession", {"epoch": telemetryEpoch}, to=sid)
+    history = list(telemetryHistory)
+    if (type(auth) == dict and auth.get("epoch") == telemetryEpoch and type(auth.get("lastSeq")) == int):
+        lastSeq = auth["lastSeq"]
+        if (lastSeq >= telemetryHistoryFloor):
+            history = [t for t in history if t["seq"] > lastSeq]
+    if (binary):
+        sio.emit("telemetryHistoryBinary",
+                 encodeTelemetryBlock(history), to=sid)
+    else:
+        sio.emit("telemetryHistory", history, to=sid)
 
 
-gaggiaController = GaggiaController(sio,
-                                    telemetryAddress, sendAndStoreTelemetry, DISABLE_PRINTS)
+import socketio
 
-app.static_files = {
-    "/": "./frontendBuild/index.html",
-    "/static": "./frontendBuild/static"
-}
+# create a Socket.IO server, before the controller whose telemetry callback emits on it is started
+sio = socketio.Server(async_mode="eventlet", cors_allowed_origins="*")
+startupTimer.phase("socketio")
+
+if (not USE_CONTROL_PROCESS):
+    from gaggiacontroller import GaggiaController
+    from temperaturesampler import TemperatureSampler
+    shotRecorder = None
+    if (RECORD_DIRECTORY != None):
+        from shotrecorder import ShotRecorder
+        shotRecorder = ShotRecorder(RECORD_DIRECTORY)
+    temperatureSampler = None
+    if (OVERSAMPLE_TEMPERATURE):
+        temperatureSampler = TemperatureSampler(hardware)
+
+    # Not handed the Socket.IO server, the controller yields with time.sleep, which is green after monkey patching
+    gaggiaController = GaggiaController(None, telemetryAddresses, sendAndStoreTelemetry, DISABLE_PRINTS, hardware,
+                                        useMeasuredSampleTime=USE_MEASURED_SAMPLE_TIME, shotRecorder=shotRecorder,
+                                        telemetryDecimation={"udp": UDP_DECIMATION},
+                                        temperatureSampler=temperatureSampler, udpProtocol=UDP_PROTOCOL,
+                                        udpBatchInterval=UDP_BATCH_INTERVAL)
+    # Only spawns the green control loop thread, its first sample is due SAMPLING_INTERVAL later when the web
+    # server is already serving
+    gaggiaController.start()
+startupTimer.phase("controller")
+
+from staticassets import StaticAssets
 
+# wrap with a WSGI application, requests that are neither Socket.IO nor frontend files go to serveMetrics
+app = socketio.WSGIApp(sio, StaticAssets(FRONTEND_DIRECTORY, serveMetrics))
 
-def emitConfig():
+recordedHistory = None
+if (RECORD_DIRECTORY != None):
+    from telemetryquery import TelemetryHistory, DEFAULT_POINTS, METHOD_LTTB
+    recordedHistory = TelemetryHistory(RECORD_DIRECTORY)
+startupTimer.phase("frontend")
+
+
+def emitConfig(to=None):
     configData = {}
     configData["shotTimeLimit"] = gaggiaController.shot_time_limit
     configData["brewSetpoint"] = gaggiaController.brew_setpoint
     configData["steamSetpoint"] = gaggiaController.steam_setpoint
-    sio.emit("config", configData)
+    sio.emit("config", configData, to=to)
     pass
 
 
-def debugPrint(text: str):
-    if (DISABLE_PRINTS):
-        return
-    print(text)
+@sio.event
+def connect(sid, environ, auth=None):
+    debugPrint(f"New connection: {sid}")
+    decimation = BROWSER_DECIMATION
+    binary = False
+    if (type(auth) == dict):
+        if (auth.get("decimation") in DECIMATION_MODES):
+            decimation = auth["decimation"]
+        binary = auth.get("encoding") == "binary"
+    joinTelemetryRoom(sid, decimation, binary)
+    emitConfig(to=sid)
+    emitInitialDataOnConnect(sid, auth, binary)
 
 
 @sio.event
-def connect(sid, environ):
-    debugPrint(f"New connection: {sid}")
-    emitConfig()
-    emitInitialDataOnConnect()
+def disconnect(sid):
+    clientTelemetry.pop(sid, None)
+
+
+@sio.on("set_telemetry_decimation")
+def set_telemetry_decimation_handler(sid, data):
+    """
+    Switches the live telemetry of the requesting client to another decimation mode, acknowledged with the
+    mode in effect
+    """
+    if (sid not in clientTelemetry):
+        return None
+    decimation, binary = clientTelemetry[sid]
+    if (data not in DECIMATION_MODES):
+        return decimation
+    sio.leave_room(sid, telemetryRoom(decimation, binary))
+    joinTelemetryRoom(sid, data, binary)
+    return data
 
 
 @sio.on("set_brew_setpoint")
@@ -105,21 +338,60 @@ def set_shot_time_limit_handler(sid, data):
     emitConfig()
 
 
+def forwardProcessTelemetry():
+    """
+    Moves telemetry from the control process ring to Socket.IO clients without ever blocking the control process
+    """
+    while True:
+        for sample in gaggiaController.readTelemetry():
+            sendAndStoreTelemetry(sample)
+        if (gaggiaController.hasConfigChanged()):
+            emitConfig()
+        sio.sleep(TELEMETRY_POLL_INTERVAL)
+
+
+@sio.on("query_telemetry")
+def query_telemetry_handler(sid, data):
+    """
+    Returns recorded telemetry between data["start"] and data["end"] (ms) downsampled to data["points"],
+    as the acknowledgement to the requesting client only
+    """
+    if (recordedHistory == None or type(data) != dict):
+        return []
+    try:
+        return recordedHistory.query(int(data["start"]), int(data["end"]), data.get("points", DEFAULT_POINTS),
+                                     data.get("method", METHOD_LTTB))
+    except (KeyError, ValueError, TypeError) as e:
+        debugPrint(f"Invalid telemetry query {data}: {e}")
+        return []
+
+
+@sio.on("list_shots")
+def list_shots_handler(sid, data=None):
+    if (recordedHistory == None):
+        return []
+    return recordedHistory.listShots()
+
+
+@sio.on("get_telemetry_stats")
+def get_telemetry_stats_handler(sid, data=None):
+    return gaggiaController.getTelemetryStats()
+
+
 def startListening():
-    wsgi.server(listen(("", 80)), app)
+    listener = listen(("", LISTEN_PORT))
+    startupTimer.phase("listen")
+    debugPrint(f"Listening on port {LISTEN_PORT}, startup took {startupTimer.summary()}")
+    wsgi.server(listener, app)
 
 
 def mockTelemetrySender():
     sio.sleep(3)
     for i in range(1, 2000):
-        telemetryData = {}
-        telemetryData["ts"] = round(time()*1000)
-        telemetryData["temp"] = math.sin(
-            time() * (2*math.pi / 120)) * 40 + 60
-        telemetryData["set"] = 93
-        telemetryData["shotdur"] = 0
-        sendAndStoreTelemetry(telemetryData)
-        sio.sleep(1)
+        temperature = math.sin(time() * (2*math.pi / 120)) * 40 + 60
+        sendAndStoreTelemetry(TelemetrySample(
+            time(), i, temperature, 93, 0, 0, False, False))
+        sio.sleep(0.5)
 
 
 if __name__ == "__main__":
@@ -127,6 +399,17 @@ if __name__ == "__main__":
     #     target=mockTelemetrySender, args=(), daemon=True)
     # testSignalsThread.start()
 
-    gaggiaController.start()
+    if (USE_CONTROL_PROCESS):
+        gaggiaController.waitUntilReady()
+        startupTimer.phase("control_process")
+        sio.start_background_task(forwardProcessTelemetry)
     startListening()
-    gaggiaController.controlLoopThread.join()
+    if (terminationRequested):
+        # Let the control loop finish and the exit handlers run, they turn the outputs off and flush
+        # pending config writes
+        gaggiaController.stop()
+        sys.exit(0)
+    if (USE_CONTROL_PROCESS):
+        gaggiaController.join()
+    else:
+        gaggiaController.controlLoopThread.join()
@@ -0,0 +1,167 @@
+import argparse
+import csv
+import time
+from gaggiacontroller import GaggiaController, CONTROL_LOOP_INTERVAL
+from gaggiahardware import BoilerModel, SimulatedHardware
+from shotrecorder import ShotRecorder
+from telemetrysample import TelemetrySample
+from temperaturesampler import TemperatureSampler
+
+
+class VirtualClock():
+    """
+    Drop-in replacement for the time module that only advances when sleep() is called.
+    Elapsed time is kept in integer microseconds so that sampling intervals stay exact.
+    """
+
+    def __init__(self, startTime: float = None):
+        if (startTime == None):
+            startTime = float(int(time.time()))
+        self.startTime = startTime
+        self.elapsedMicros = 0
+
+    def time(self) -> float:
+        return self.startTime + self.elapsedMicros / 1e6
+
+    def monotonic(self) -> float:
+        return self.elapsedMicros / 1e6
+
+    def sleep(self, seconds: float):
+        self.elapsedMicros += round(seconds * 1e6)
+
+
+class GaggiaSimulation():
+    """
+    Runs the real GaggiaController control loop against a SimulatedHardware boiler on a VirtualClock.
+    Every controller sample is collected into samples as (elapsed, temperature, setpoint, output, brewing).
+    """
+
+    def __init__(self, boiler: BoilerModel = None, brewSetpoint: float = None, steamSetpoint: float = None,
+                 brewFeedForwardCompensation: float = None, pidGains: tuple = None, temperatureNoise: float = 0.0,
+                 shotRecorder: ShotRecorder = None, oversample: bool = False):
+        self.clock = VirtualClock()
+        self.hardware = SimulatedHardware(
+            self.clock, boiler, temperatureNoise)
+        self.samples = []
+        # Sampled at the control loop interval, which is also the thermocouple conversion time
+        self.temperatureSampler = None
+        if (oversample):
+            self.temperatureSampler = TemperatureSampler(
+                self.hardware, self.clock, CONTROL_LOOP_INTERVAL)
+        self.controller = GaggiaController(None, None, self.__onTelemetry, True, self.hardware,
+                                           clock=self.clock, configPath=None, registerExitHandler=False,
+                                           shotRecorder=shotRecorder, temperatureSampler=self.temperatureSampler)
+        if (brewSetpoint != None):
+            self.controller.brew_setpoint = brewSetpoint
+        if (steamSetpoint != None):
+            self.controller.steam_setpoint = steamSetpoint
+        if (brewFeedForwardCompensation != None):
+            self.controller.brew_feedforward_compensation = brewFeedForwardCompensation
+        if (pidGains != None):
+            self.controller.setPidGains(*pidGains)
+        self.controller.start(spawnThread=False)
+
+    def __onTelemetry(self, sample: TelemetrySample):
+        self.samples.append((self.clock.monotonic(), self.hardware.boiler.temperature,
+                            sample.setpoint, self.hardware.heaterDutyCycle, self.hardware.brewSwitch))
+
+    def elapsed(self) -> float:
+        return self.clock.monotonic()
+
+    def run(self, seconds: float):
+        """
+        Advances the simulation by seconds of virtual time
+        """
+        endMicros = self.clock.elapsedMicros + round(seconds * 1e6)
+        while self.clock.elapsedMicros < endMicros:
+            if (self.temperatureSampler != None):
+                self.temperatureSampler.sampleOnce()
+            self.controller.tick()
+            self.clock.sleep(CONTROL_LOOP_INTERVAL)
+
+    def pullShot(self, duration: float):
+        self.hardware.setBrewSwitch(True)
+        self.run(duration)
+        self.hardware.setBrewSwitch(False)
+
+    def steam(self, duration: float):
+        self.hardware.setSteamSwitch(True)
+        self.run(duration)
+        self.hardware.setSteamSwitch(False)
+
+
+def runWarmupAndShots(simulation: GaggiaSimulation, warmup: float, shots: int, shotDuration: float, shotInterval: float):
+    """
+    Standard scenario: cold start, warm-up, then shots pulled at a fixed interval.
+    Returns (start, end) elapsed times of each shot.
+    """
+    simulation.run(warmup)
+    shotTimes = []
+    for i in range(shots):
+        shotStart = simulation.elapsed()
+        simulation.pullShot(shotDuration)
+        shotTimes.append((shotStart, simulation.elapsed()))
+        simulation.run(shotInterval)
+    return shotTimes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Faster than real time closed-loop simulation of the Gaggia controller",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-w", "--warmup", action="store", type=float,
+                        help="Warm-up duration in seconds", default=1800)
+    parser.add_argument("-n", "--shots", action="store", type=int,
+                        help="Number of shots after warm-up", default=3)
+    parser.add_argument("--shotduration", action="store", type=float,
+                        help="Shot duration in seconds", default=30)
+    parser.add_argument("--shotinterval", action="store", type=float,
+                        help="Seconds between shots", default=120)
+    parser.add_argument("--gains", action="store", type=float, nargs=4, metavar=("P", "I", "D", "N"),
+                        help="PID gains and filter coefficient, controller defaults if omitted", default=None)
+    parser.add_argument("--noise", action="store", type=float,
+                        help="Thermocouple noise standard deviation", default=0.0)
+    parser.add_argument("--oversample", action="store_true",
+                        help="Feed the controller through the oversampling TemperatureSampler", default=False)
+    parser.add_argument("-o", "--output", action="store",
+                        help="Write samples to csv file", default=None)
+    parser.add_argument("-r", "--recorddir", action="store",
+                        help="Also record the run with ShotRecorder into this directory", default=None)
+    config = vars(parser.parse_args())
+
+    shotRecorder = None
+    if (config["recorddir"] != None):
+        shotRecorder = ShotRecorder(config["recorddir"])
+    wallStarted = time.perf_counter()
+    simulation = GaggiaSimulation(
+        pidGains=config["gains"], temperatureNoise=config["noise"], shotRecorder=shotRecorder,
+        oversample=config["oversample"])
+    shotTimes = runWarmupAndShots(
+        simulation, config["warmup"], config["shots"], config["shotduration"], config["shotinterval"])
+    if (shotRecorder != None):
+        shotRecorder.close()
+    wallElapsed = time.perf_counter() - wallStarted
+
+    print(f"Simulated {simulation.elapsed():.0f} s in {wallElapsed * 1000:.0f} ms "
+          f"({simulation.elapsed() / wallElapsed:.0f}x real time), {len(simulation.samples)} samples")
+    warmupSamples = [s for s in simulation.samples if s[0] <= config["warmup"]]
+    if (len(warmupSamples) > 0):
+        print(f"Warm-up: max {max(s[1] for s in warmupSamples):.2f} C, "
+              f"end {warmupSamples[-1][1]:.2f} C, setpoint {warmupSamples[-1][2]:.1f} C")
+    for i, (shotStart, shotEnd) in enumerate(shotTimes):
+        shotSamples = [s for s in simulation.samples if shotStart <=
+                       s[0] <= shotEnd + config["shotinterval"]]
+        if (len(shotSamples) == 0):
+            continue
+        print(f"Shot {i + 1}: start {shotSamples[0][1]:.2f} C, min {min(s[1] for s in shotSamples):.2f} C, "
+              f"max {max(s[1] for s in shotSamples):.2f} C")
+
+    if (config["output"] != None):
+        with open(config["output"], "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(
+                ["elapsed", "temperature", "setpoint", "output", "brewing"])
+            writer.writerows(simulation.samples)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,415 @@
+import collections
+import math
+import os
+import struct
+import time
+from gaggiahardware import GaggiaHardware, originalModule
+
+FILE_MAGIC = b"GGIO"
+FILE_VERSION = 1
+# magic, version, oversampled flag, monotonic start (s), wall clock start (s)
+FILE_HEADER = struct.Struct("<4sHBxdd")
+# microseconds since the previous event, event kind, value
+EVENT_RECORD = struct.Struct("<IBd")
+# numpy layout of EVENT_RECORD, numpy is only imported for loading so recording stays cheap to start
+EVENT_FIELDS = [("dt", "<u4"), ("kind", "u1"), ("value", "<f8")]
+MAX_EVENT_GAP_MICROS = 0xFFFFFFFF
+# Not .bin so recordings can share a directory with shot segments
+FILE_EXTENSION = ".gio"
+
+EVENT_GAP = 0  # only advances time, for gaps longer than fit in one record
+EVENT_TICK = 1  # start of a controller tick
+EVENT_TEMPERATURE = 2  # NaN for a faulted read
+EVENT_BREW_SWITCH = 3
+EVENT_STEAM_SWITCH = 4
+EVENT_BREW_EDGE = 5
+EVENT_PUMP = 6
+EVENT_HEATER = 7
+EVENT_EDGE_SUPPORT = 8
+EVENT_SETTING = 16  # + index into SETTING_KEYS
+SETTING_KEYS = ("brew_setpoint", "steam_setpoint", "shot_time_limit", "brew_feedforward_compensation",
+                "p_gain", "i_gain", "d_gain", "filter_coeff_n")
+
+DEFAULT_TOLERANCE = 1e-6
+
+
+class RecordingHardware(GaggiaHardware):
+    """
+    Wraps another backend and logs controller ticks, input reads, output writes, brew switch edges and
+    controller setting changes to path with monotonic timestamps. Switch reads and pump writes are only logged
+    when they change, which is all a replay needs. oversampled tells the replay that the controller reads the
+    thermocouple through a TemperatureSampler.
+    """
+
+    def __init__(self, hardware: GaggiaHardware, path: str, clock=time, oversampled: bool = False):
+        self.hardware = hardware
+        self.clock = clock
+        # Native lock, reads also come from the sampler and switch watcher threads
+        self.lock = originalModule("threading").Lock()
+        self.file = open(path, "wb")
+        self.lastTimestampMicros = round(clock.monotonic() * 1e6)
+        self.file.write(FILE_HEADER.pack(FILE_MAGIC, FILE_VERSION, oversampled,
+                        self.lastTimestampMicros / 1e6, clock.time()))
+        self.lastValues = {}
+        self.settings = {}
+
+    def __log(self, kind: int, value: float, onlyChanges: bool = False):
+        with self.lock:
+            if (self.file == None or (onlyChanges and self.lastValues.get(kind) == value)):
+                return
+            self.lastValues[kind] = value
+            timestampMicros = max(round(self.clock.monotonic() * 1e6), self.lastTimestampMicros)
+            gap = timestampMicros - self.lastTimestampMicros
+            while gap > MAX_EVENT_GAP_MICROS:
+                self.file.write(EVENT_RECORD.pack(MAX_EVENT_GAP_MICROS, EVENT_GAP, 0.0))
+                gap -= MAX_EVENT_GAP_MICROS
+            self.file.write(EVENT_RECORD.pack(gap, kind, value))
+            self.lastTimestampMicros = timestampMicros
+
+    def readTemperature(self) -> float:
+        try:
+            temperature = self.hardware.readTemperature()
+        except RuntimeError:
+            self.__log(EVENT_TEMPERATURE, math.nan)
+            raise
+        self.__log(EVENT_TEMPERATURE, temperature)
+        return temperature
+
+    def readBrewSwitch(self) -> bool:
+        state = self.hardware.readBrewSwitch()
+        self.__log(EVENT_BREW_SWITCH, float(state), True)
+        return state
+
+    def readSteamSwitch(self) -> bool:
+        state = self.hardware.readSteamSwitch()
+        self.__log(EVENT_STEAM_SWITCH, float(state), True)
+        return state
+
+    def setBrewSwitchCallback(self, callback) -> bool:
+        def onEdge(state: bool, monotonicTimestamp: float):
+            self.__log(EVENT_BREW_EDGE, float(state))
+            callback(state, monotonicTimestamp)
+
+        supported = self.hardware.setBrewSwitchCallback(onEdge)
+        self.__log(EVENT_EDGE_SUPPORT, float(supported))
+        return supported
+
+    def setPumpEnabled(self, state: bool):
+        self.hardware.setPumpEnabled(state)
+        self.__log(EVENT_PUMP, float(state), True)
+
+    def getPumpEnabled(self) -> bool:
+        return self.hardware.getPumpEnabled()
+
+    def setHeaterDutyCycle(self, dutyCycleFraction: float):
+        self.hardware.setHeaterDutyCycle(dutyCycleFraction)
+        self.__log(EVENT_HEATER, dutyCycleFraction)
+
+    def noteSettings(self, settings: dict):
+        for index, key in enumerate(SETTING_KEYS):
+            if (key in settings and settings[key] != self.settings.get(key)):
+                self.settings[key] = settings[key]
+                self.__log(EVENT_SETTING + index, settings[key])
+
+    def noteTick(self):
+        self.__log(EVENT_TICK, 0.0)
+        self.hardware.noteTick()
+
+    def shutdown(self):
+        self.hardware.shutdown()
+        self.close()
+
+    def close(self):
+        with self.lock:
+            if (self.file != None):
+                self.file.close()
+                self.file = None
+
+
+def recordHardware(hardware: GaggiaHardware, directory: str, oversampled: bool) -> RecordingHardware:
+    """
+    Wraps hardware in a RecordingHardware writing to a new file in directory named by the wall clock start
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{round(time.time() * 1000)}{FILE_EXTENSION}")
+    return RecordingHardware(hardware, path, oversampled=oversampled)
+
+
+def loadRecording(path: str) -> tuple:
+    """
+    Returns (header, timestamps, kinds, values) of a recording. header has startMonotonic, startWallTime and
+    oversampled, timestamps are monotonic seconds. A partially written trailing event is ignored.
+    """
+    import numpy as np
+    with open(path, "rb") as f:
+        data = f.read()
+    if (len(data) < FILE_HEADER.size):
+        raise ValueError(f"{path} is not a hardware I/O recording")
+    magic, version, oversampled, startMonotonic, startWallTime = FILE_HEADER.unpack_from(data, 0)
+    if (magic != FILE_MAGIC or version != FILE_VERSION):
+        raise ValueError(f"{path} is not a hardware I/O recording")
+    count = (len(data) - FILE_HEADER.size) // EVENT_RECORD.size
+    events = np.frombuffer(data, dtype=np.dtype(EVENT_FIELDS), count=count, offset=FILE_HEADER.size)
+    # Summed in integer microseconds so long recordings do not drift
+    timestampMicros = round(startMonotonic * 1e6) + np.cumsum(events["dt"], dtype=np.int64)
+    keep = events["kind"] != EVENT_GAP
+    header = {"startMonotonic": startMonotonic, "startWallTime": startWallTime, "oversampled": bool(oversampled)}
+    return header, timestampMicros[keep] / 1e6, events["kind"][keep], events["value"][keep]
+
+
+class ReplayClock():
+    """
+    Clock that is moved to recorded timestamps by the replay
+    """
+
+    def __init__(self, startMonotonic: float, startWallTime: float):
+        self.startMonotonic = startMonotonic
+        self.startWallTime = startWallTime
+        self.now = startMonotonic
+
+    def time(self) -> float:
+        return self.startWallTime + (self.now - self.startMonotonic)
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.now += seconds
+
+    def advanceTo(self, timestamp: float):
+        self.now = max(self.now, timestamp)
+
+
+class ReplayHardware(GaggiaHardware):
+    """
+    Serves recorded input reads in the order they were recorded and keeps the outputs written to it. The replay
+    feeds the reads of one tick before running it, reads beyond the recorded ones repeat the latest value since
+    unchanged switch reads are not recorded.
+    """
+
+    def __init__(self, edgeSupport: bool):
+        self.edgeSupport = edgeSupport
+        self.inputs = {EVENT_TEMPERATURE: collections.deque(), EVENT_BREW_SWITCH: collections.deque(),
+                       EVENT_STEAM_SWITCH: collections.deque()}
+        self.latestInputs = {EVENT_TEMPERATURE: math.nan, EVENT_BREW_SWITCH: 0.0, EVENT_STEAM_SWITCH: 0.0}
+        self.pumpEnabled = False
+        self.heaterDutyCycle = 0.0
+        self.brewSwitchCallback = None
+
+    def feedInput(self, kind: int, value: float):
+        self.inputs[kind].append(value)
+
+    def discardInputs(self):
+        """
+        Drops reads that were recorded but not replayed, so a diverging replay stays aligned with the ticks
+        """
+        for kind, queue in self.inputs.items():
+            if (len(queue) > 0):
+                self.latestInputs[kind] = queue[-1]
+                queue.clear()
+
+    def __readInput(self, kind: int) -> float:
+        queue = self.inputs[kind]
+        if (len(queue) > 0):
+            self.latestInputs[kind] = queue.popleft()
+        return self.latestInputs[kind]
+
+    def readTemperature(self) -> float:
+        temperature = self.__readInput(EVENT_TEMPERATURE)
+        if (math.isnan(temperature)):
+            raise RuntimeError("recorded thermocouple fault")
+        return temperature
+
+    def readBrewSwitch(self) -> bool:
+        return self.__readInput(EVENT_BREW_SWITCH) != 0
+
+    def readSteamSwitch(self) -> bool:
+        return self.__readInput(EVENT_STEAM_SWITCH) != 0
+
+    def setBrewSwitchCallback(self, callback) -> bool:
+        self.brewSwitchCallback = callback
+        return self.edgeSupport
+
+    def setPumpEnabled(self, state: bool):
+        self.pumpEnabled = bool(state)
+
+    def getPumpEnabled(self) -> bool:
+        return self.pumpEnabled
+
+    def setHeaterDutyCycle(self, dutyCycleFraction: float):
+        self.heaterDutyCycle = dutyCycleFraction
+
+    def shutdown(self):
+        self.setHeaterDutyCycle(0)
+        self.setPumpEnabled(False)
+
+
+def replayRecording(path: str, oversample: bool = None, speed: float = None,
+                    tolerance: float = DEFAULT_TOLERANCE) -> dict:
+    """
+    Feeds a recording through a fresh GaggiaController at the recorded tick times and compares its heater and
+    pump outputs with the recorded ones after every tick. oversample overrides whether the thermocouple is read
+    through a TemperatureSampler as recorded. With speed the replay is paced to speed times real time,
+    otherwise it runs as fast as possible.
+
+    Events that other threads logged while a tick was running (setting changes, brew switch edges, sampler
+    reads) are replayed right after that tick.
+    """
+    from gaggiacontroller import GaggiaController
+    from temperaturesampler import TemperatureSampler
+
+    header, timestamps, kinds, values = loadRecording(path)
+    if (oversample == None):
+        oversample = header["oversampled"]
+    edgeSupport = values[kinds == EVENT_EDGE_SUPPORT]
+    clock = ReplayClock(header["startMonotonic"], header["startWallTime"])
+    hardware = ReplayHardware(len(edgeSupport) > 0 and edgeSupport[0] != 0)
+    sampler = TemperatureSampler(hardware, clock) if oversample else None
+    controller = GaggiaController(None, None, None, True, hardware, clock=clock, configPath=None,
+                                  registerExitHandler=False, temperatureSampler=sampler)
+    setters = {"brew_setpoint": controller.setBrewSetpoint, "steam_setpoint": controller.setSteamSetpoint,
+               "shot_time_limit": controller.setShotTimeLimit,
+               "brew_feedforward_compensation": controller.setBrewFeedForwardCompensation}
+    gains = {"p_gain": controller.p_gain, "i_gain": controller.i_gain,
+             "d_gain": controller.d_gain, "filter_coeff_n": controller.filter_coeff_n}
+    tickInputs = (EVENT_BREW_SWITCH, EVENT_STEAM_SWITCH) if oversample else (
+        EVENT_TEMPERATURE, EVENT_BREW_SWITCH, EVENT_STEAM_SWITCH)
+
+    # Latest outputs in the recording as of the replayed event
+    recorded = {EVENT_HEATER: 0.0, EVENT_PUMP: 0.0}
+
+    def replayEvent(kind: int, timestamp: float, value: float):
+        clock.advanceTo(timestamp)
+        if (kind in recorded):
+            recorded[kind] = value
+        elif (kind >= EVENT_SETTING):
+            key = SETTING_KEYS[kind - EVENT_SETTING]
+            if (key in setters):
+                setters[key](value)
+            elif (gains[key] != value):
+                gains[key] = value
+                controller.setPidGains(gains["p_gain"], gains["i_gain"], gains["d_gain"], gains["filter_coeff_n"])
+        elif (kind == EVENT_BREW_EDGE):
+            if (hardware.brewSwitchCallback != None):
+                hardware.brewSwitchCallback(value != 0, timestamp)
+        elif (kind == EVENT_TEMPERATURE):
+            hardware.feedInput(EVENT_TEMPERATURE, value)
+            sampler.sampleOnce()
+
+    divergences = []
+    maxHeaterDifference = 0.0
+    tickCount = 0
+    started = False
+    # Recorded start time of the tick whose inputs are being collected and the time its sample was taken
+    tickTimestamp = None
+    sampleTimestamp = None
+    deferredEvents = []
+    wallStarted = time.perf_counter()
+    firstTimestamp = None
+
+    def finishTick():
+        nonlocal tickCount, maxHeaterDifference
+        clock.advanceTo(sampleTimestamp if sampleTimestamp != None else tickTimestamp)
+        controller.tick()
+        hardware.discardInputs()
+        tickCount += 1
+        # By now the recording holds everything the production tick wrote
+        elapsed = tickTimestamp - header["startMonotonic"]
+        difference = abs(recorded[EVENT_HEATER] - hardware.heaterDutyCycle)
+        maxHeaterDifference = max(maxHeaterDifference, difference)
+        if (difference > tolerance):
+            divergences.append((elapsed, "heater", recorded[EVENT_HEATER], hardware.heaterDutyCycle))
+        if ((recorded[EVENT_PUMP] != 0) != hardware.pumpEnabled):
+            divergences.append((elapsed, "pump", recorded[EVENT_PUMP] != 0, hardware.pumpEnabled))
+        for event in deferredEvents:
+            replayEvent(*event)
+        deferredEvents.clear()
+        if (speed != None):
+            delay = (tickTimestamp - firstTimestamp) / speed - (time.perf_counter() - wallStarted)
+            if (delay > 0):
+                time.sleep(delay)
+
+    for kind, timestamp, value in zip(kinds.tolist(), timestamps.tolist(), values.tolist()):
+        if (kind == EVENT_TICK):
+            if (tickTimestamp != None):
+                finishTick()
+            if (started):
+                tickTimestamp = timestamp
+                sampleTimestamp = None
+        elif (kind in tickInputs):
+            hardware.feedInput(kind, value)
+        elif (kind in recorded and len(deferredEvents) > 0):
+            # Written in response to a deferred event rather than by the tick
+            deferredEvents.append((kind, timestamp, value))
+        elif (kind == EVENT_HEATER):
+            recorded[kind] = value
+            if (not started):
+                # Production wrote heater 0 right after starting its scheduler, start at the same instant
+                clock.advanceTo(timestamp)
+                controller.start(spawnThread=False)
+                started = True
+                firstTimestamp = timestamp
+            elif (tickTimestamp != None and sampleTimestamp == None):
+                # The scheduler was polled before the heater write, a replay tick at this time takes the sample too
+                sampleTimestamp = timestamp
+        elif (kind == EVENT_PUMP):
+            recorded[kind] = value
+        elif (kind == EVENT_EDGE_SUPPORT):
+            pass
+        elif (tickTimestamp != None):
+            deferredEvents.append((kind, timestamp, value))
+        else:
+            replayEvent(kind, timestamp, value)
+    if (tickTimestamp != None):
+        finishTick()
+
+    return {"path": path, "ticks": tickCount, "oversample": oversample,
+            "recordedSeconds": 0.0 if firstTimestamp == None else timestamps[-1] - firstTimestamp,
+            "replaySeconds": time.perf_counter() - wallStarted,
+            "divergences": divergences, "maxHeaterDifference": maxHeaterDifference}
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Replays hardware I/O recordings through the current controller "
+                                     "and reports every divergence from the recorded outputs",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("recordings", nargs="+",
+                        help="Recording files or directories of them")
+    parser.add_argument("--oversample", action="store_true", default=None,
+                        help="Read the thermocouple through a TemperatureSampler, as recorded if neither flag is given")
+    parser.add_argument("--directread", action="store_false", dest="oversample",
+                        help="Read the thermocouple once per tick")
+    parser.add_argument("--speed", action="store", type=float,
+                        help="Pace the replay to this multiple of real time", default=None)
+    parser.add_argument("--tolerance", action="store", type=float,
+                        help="Largest heater duty cycle difference that is not reported", default=DEFAULT_TOLERANCE)
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="Print every divergence", default=False)
+    config = vars(parser.parse_args())
+
+    paths = []
+    for path in config["recordings"]:
+        if (os.path.isdir(path)):
+            paths += sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(FILE_EXTENSION))
+        else:
+            paths.append(path)
+
+    totalDivergences = 0
+    for path in paths:
+        result = replayRecording(path, config["oversample"], config["speed"], config["tolerance"])
+        divergences = result["divergences"]
+        totalDivergences += len(divergences)
+        if (result["ticks"] == 0):
+            print(f"{path}: no controller ticks recorded")
+            continue
+        print(f"{path}: {result['ticks']} ticks, {result['recordedSeconds']:.0f} s replayed in "
+              f"{result['replaySeconds']:.2f} s, {len(divergences)} divergences, "
+              f"max heater difference {result['maxHeaterDifference']:.3g}")
+        for elapsed, output, recorded, replayed in (divergences if config["verbose"] else divergences[:10]):
+            print(f"  {elapsed:10.3f} s {output}: recorded {recorded}, replayed {replayed}")
+    raise SystemExit(1 if totalDivergences > 0 else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+import argparse
+import itertools
+import math
+import multiprocessing
+import os
+import time
+from gaggiasimulation import GaggiaSimulation
+from configstore import ConfigStore
+
+SETTLING_BAND = 0.5
+DEFAULT_WEIGHTS = (1.0, 0.5, 1.0)  # overshoot, settling minutes, shot temperature drop
+
+
+def linspace(start: float, stop: float, count: int) -> list:
+    if (count <= 1):
+        return [start]
+    return [start + (stop - start) * i / (count - 1) for i in range(count)]
+
+
+def scoreRun(samples: list, setpoint: float, warmupEnd: float, shotStart: float, recoveryEnd: float, weights: tuple) -> dict:
+    """
+    Scores a GaggiaSimulation sample list (elapsed, temperature, setpoint, output, brewing) on warm-up overshoot,
+    warm-up settling time into the +-SETTLING_BAND band and the temperature drop during and after a shot
+    """
+    warmup = [s for s in samples if s[0] <= warmupEnd]
+    shot = [s for s in samples if shotStart <= s[0] <= recoveryEnd]
+    overshoot = max(0.0, max(s[1] for s in warmup) - setpoint)
+    settlingTime = warmupEnd
+    for s in reversed(warmup):
+        if (abs(s[1] - setpoint) > SETTLING_BAND):
+            break
+        settlingTime = s[0]
+    shotDrop = max(0.0, setpoint - min(s[1] for s in shot))
+    shotOvershoot = max(0.0, max(s[1] for s in shot) - setpoint)
+    overshootWeight, settlingWeight, dropWeight = weights
+    cost = overshootWeight * (overshoot + shotOvershoot) + \
+        settlingWeight * settlingTime / 60 + dropWeight * shotDrop
+    return {"overshoot": overshoot, "settlingTime": settlingTime, "shotDrop": shotDrop,
+            "shotOvershoot": shotOvershoot, "cost": cost}
+
+
+def evaluateCandidate(job: tuple) -> tuple:
+    """
+    Process pool worker: runs a warm-up and one shot for a (pGain, iGain, dGain, filterCoeff, feedforward)
+    candidate and returns it with its score
+    """
+    candidate, setpoint, warmup, shotDuration, recovery, weights = job
+    pGain, iGain, dGain, filterCoeff, feedforward = candidate
+    simulation = GaggiaSimulation(brewSetpoint=setpoint, brewFeedForwardCompensation=feedforward,
+                                  pidGains=(pGain, iGain, dGain, filterCoeff))
+    simulation.run(warmup)
+    shotStart = simulation.elapsed()
+    simulation.pullShot(shotDuration)
+    simulation.run(recovery)
+    score = scoreRun(simulation.samples, setpoint, warmup,
+                     shotStart, simulation.elapsed(), weights)
+    if (not math.isfinite(score["cost"])):
+        # Unstable derivative filter, output went to NaN
+        return candidate, None
+    return candidate, score
+
+
+def saveGains(configPath: str, candidate: tuple):
+    pGain, iGain, dGain, filterCoeff, feedforward = candidate
+    config = ConfigStore(configPath)
+    if (not config.update({"p_gain": pGain, "i_gain": iGain, "d_gain": dGain, "filter_coeff_n": filterCoeff,
+                           "brew_feedforward_compensation": feedforward})):
+        raise ValueError(f"Gains {candidate} are outside the allowed config ranges")
+    config.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweeps PID gains against the simulated boiler on all cores",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--p", action="store", type=float, nargs=3, metavar=("MIN", "MAX", "COUNT"),
+                        help="Proportional gain range", default=[0.02, 0.08, 7])
+    parser.add_argument("--i", action="store", type=float, nargs=3, metavar=("MIN", "MAX", "COUNT"),
+                        help="Integral gain range", default=[0.0005, 0.004, 8])
+    parser.add_argument("--d", action="store", type=float, nargs=3, metavar=("MIN", "MAX", "COUNT"),
+                        help="Derivative gain range", default=[-0.006, 0.0, 4])
+    parser.add_argument("--n", action="store", type=float, nargs=3, metavar=("MIN", "MAX", "COUNT"),
+                        help="Derivative filter coefficient range", default=[1.0, 3.5, 3])
+    parser.add_argument("--ff", action="store", type=float, nargs=3, metavar=("MIN", "MAX", "COUNT"),
+                        help="Brew feedforward compensation range", default=[0.0, 0.3, 4])
+    parser.add_argument("--setpoint", action="store", type=float,
+                        help="Brew setpoint to tune at", default=94.0)
+    parser.add_argument("--warmup", action="store", type=float,
+                        help="Simulated warm-up seconds", default=900)
+    parser.add_argument("--shotduration", action="store", type=float,
+                        help="Simulated shot seconds", default=30)
+    parser.add_argument("--recovery", action="store", type=float,
+                        help="Simulated seconds after the shot included in scoring", default=90)
+    parser.add_argument("--weights", action="store", type=float, nargs=3, metavar=("OVERSHOOT", "SETTLING", "DROP"),
+                        help="Cost weights for overshoot (C), settling time (min) and shot temperature drop (C)",
+                        default=list(DEFAULT_WEIGHTS))
+    parser.add_argument("-j", "--jobs", action="store", type=int,
+                        help="Worker processes", default=os.cpu_count())
+    parser.add_argument("-t", "--top", action="store", type=int,
+                        help="Number of best candidates to print", default=5)
+    parser.add_argument("-c", "--config", action="store",
+                        help="Shelve config to write the best gains into", default="config")
+    parser.add_argument("-w", "--write", action="store_true",
+                        help="Write the best candidate into the config", default=False)
+    config = vars(parser.parse_args())
+
+    ranges = [linspace(r[0], r[1], int(r[2])) for r in (
+        config["p"], config["i"], config["d"], config["n"], config["ff"])]
+    candidates = list(itertools.product(*ranges))
+    jobs = [(c, config["setpoint"], config["warmup"], config["shotduration"], config["recovery"],
+             tuple(config["weights"])) for c in candidates]
+    print(
+        f"Evaluating {len(candidates)} candidates on {config['jobs']} processes")
+
+    started = time.perf_counter()
+    results = []
+    with multiprocessing.Pool(config["jobs"]) as pool:
+        chunkSize = max(1, len(jobs) // (config["jobs"] * 8))
+        for candidate, score in pool.imap_unordered(evaluateCandidate, jobs, chunkSize):
+            if (score != None):
+                results.append((score["cost"], candidate, score))
+    results.sort(key=lambda r: r[0])
+    print(
+        f"Done in {time.perf_counter() - started:.1f} s, {len(candidates) - len(results)} unstable candidates")
+
+    for cost, candidate, score in results[:config["top"]]:
+        pGain, iGain, dGain, filterCoeff, feedforward = candidate
+        print(f"cost {cost:7.3f} | P {pGain:.4f} I {iGain:.5f} D {dGain:.4f} N {filterCoeff:.3f} FF {feedforward:.2f} | "
+              f"overshoot {score['overshoot']:.2f} C, settling {score['settlingTime']:.0f} s, "
+              f"shot drop {score['shotDrop']:.2f} C")
+
+    if (config["write"] and len(results) > 0):
+        saveGains(config["config"], results[0][1])
+        print(f"Best candidate written to {config['config']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+import argparse
+import asyncio
+import collections
+import math
+import os
+import signal
+import socket
+import struct
+import time
+from controlmetrics import LatencyHistogram
+from telemetrysample import TelemetrySample
+from udptelemetry import DATAGRAM_HEADER, SAMPLE_RECORD, PROTOCOL_LEGACY, UDP_PROTOCOLS, \
+    DEFAULT_PORT, packDatagramHeader, packSampleRecord, parseAddress
+
+COMMAND_TIMEOUT = 3.0
+# Sample number being answered, heater duty cycle (0-1)
+COMMAND = struct.Struct("<If")
+# Bare heater duty cycle as sent by the Simulink model, answers the latest sample
+LEGACY_COMMAND = struct.Struct("<f")
+# Sample number, temperature, steam switch, brew switch, the layout simulinkEspresso.py sends
+LEGACY_SAMPLE = struct.Struct("<ifbb")
+# Samples whose send time is kept for matching round trips
+MAX_PENDING_SAMPLES = 64
+DISABLE_PRINTS = False
+
+
+def debugPrint(text: str):
+    if (DISABLE_PRINTS):
+        return
+    print(text)
+
+
+class RemoteControl(asyncio.DatagramProtocol):
+    """
+    Closes the heater loop through an external controller over UDP. sendSample() is a telemetry bus sink that
+    sends every control sample to address the moment it is taken. A command from the host of address sets the
+    heater output as soon as it arrives, and its round trip is measured from the send time of the sample it
+    answers. A watchdog timer on the event loop turns the heater off exactly commandTimeout after the last
+    command.
+    """
+
+    def __init__(self, controller, address: tuple, protocol: str = PROTOCOL_LEGACY,
+                 commandTimeout: float = COMMAND_TIMEOUT):
+        if (protocol not in UDP_PROTOCOLS):
+            raise ValueError(f"Unknown UDP telemetry protocol {protocol}")
+        self.controller = controller
+        self.address = address
+        self.protocol = protocol
+        self.commandTimeout = commandTimeout
+        self.transport = None
+        self.loop = None
+        self.watchdog = None
+        self.timedOut = False
+        self.session = int.from_bytes(os.urandom(4), "little")
+        self.sequence = 0
+        self.datagram = bytearray(DATAGRAM_HEADER.size + SAMPLE_RECORD.size)
+        # sample number: perf_counter() when it was sent
+        self.sendTimes = collections.OrderedDict()
+        self.latestSampleNumber = None
+        self.roundTrip = LatencyHistogram()
+        self.lastRoundTrip = None
+        self.maxRoundTrip = 0.0
+        self.commandCount = 0
+        self.invalidCommandCount = 0
+        self.unknownSenderCount = 0
+        self.sendErrorCount = 0
+        self.timeoutCount = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.loop = asyncio.get_running_loop()
+        # Nothing may heat before the external controller has said so
+        self.controller.setRemoteOutput(0.0)
+        self.__armWatchdog()
+
+    def connection_lost(self, exc):
+        self.transport = None
+        if (self.watchdog != None):
+            self.watchdog.cancel()
+            self.watchdog = None
+
+    def error_received(self, exc):
+        # ICMP errors for earlier datagrams, e.g. while the controller is not listening yet
+        self.sendErrorCount += 1
+
+    def sendSample(self, sample: TelemetrySample):
+        if (self.transport == None):
+            return
+        if (self.protocol == PROTOCOL_LEGACY):
+            data = LEGACY_SAMPLE.pack(sample.sampleNumber, sample.temperature, sample.steamSwitch, sample.brewSwitch)
+        else:
+            packSampleRecord(self.datagram, DATAGRAM_HEADER.size, sample)
+            packDatagramHeader(self.datagram, 1, self.session, self.sequence)
+            self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+            data = self.datagram
+        self.transport.sendto(data, self.address)
+        self.sendTimes[sample.sampleNumber] = time.perf_counter()
+        if (len(self.sendTimes) > MAX_PENDING_SAMPLES):
+            self.sendTimes.popitem(last=False)
+        self.latestSampleNumber = sample.sampleNumber
+        roundTrip = f"{self.lastRoundTrip * 1000:.2f} ms" if self.lastRoundTrip != None else "-"
+        debugPrint(f"Sample {sample.sampleNumber}: {sample.temperature:.1f} C, heater {sample.output:.2f}, "
+                   f"round trip {roundTrip}")
+
+    def datagram_received(self, data: bytes, address):
+        received = time.perf_counter()
+        if (address[0] != self.address[0]):
+            self.unknownSenderCount += 1
+            return
+        if (len(data) == COMMAND.size):
+            sampleNumber, output = COMMAND.unpack(data)
+        elif (len(data) == LEGACY_COMMAND.size):
+            output, = LEGACY_COMMAND.unpack(data)
+            sampleNumber = self.latestSampleNumber
+        else:
+            self.invalidCommandCount += 1
+            return
+        if (not math.isfinite(output)):
+            self.invalidCommandCount += 1
+            return
+        self.controller.setRemoteOutput(output)
+        self.__armWatchdog()
+        self.commandCount += 1
+        sent = self.sendTimes.pop(sampleNumber, None)
+        if (sent != None):
+            self.lastRoundTrip = received - sent
+            self.maxRoundTrip = max(self.maxRoundTrip, self.lastRoundTrip)
+            self.roundTrip.observe(self.lastRoundTrip)
+        if (self.timedOut):
+            self.timedOut = False
+            print("Heater commands resumed")
+
+    def __armWatchdog(self):
+        if (self.watchdog != None):
+            self.watchdog.cancel()
+        self.watchdog = self.loop.call_later(self.commandTimeout, self.__onWatchdog)
+
+    def __onWatchdog(self):
+        self.watchdog = None
+        self.controller.setRemoteOutput(0.0)
+        self.lastRoundTrip = None
+        if (not self.timedOut):
+            self.timedOut = True
+            self.timeoutCount += 1
+            print("Heater safety shutdown due to command timeout")
+
+    def getStats(self) -> dict:
+        meanRoundTrip = self.roundTrip.sum / self.roundTrip.count if self.roundTrip.count > 0 else None
+        return {"commands": self.commandCount, "invalidCommands": self.invalidCommandCount,
+                "unknownSenders": self.unknownSenderCount, "sendErrors": self.sendErrorCount,
+                "timeouts": self.timeoutCount, "roundTrips": self.roundTrip.count,
+                "meanRoundTrip": meanRoundTrip, "maxRoundTrip": self.maxRoundTrip}
+
+
+async def runRemoteControl(controller, remote: RemoteControl, localAddress: tuple):
+    """
+    Drives the controller from the event loop, so that samples, commands and the watchdog never wait on
+    another thread
+    """
+    from gaggiacontroller import CONTROL_LOOP_INTERVAL
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    transport, protocol = await loop.create_datagram_endpoint(lambda: remote, local_addr=localAddress)
+    # The bus is never started, so sinks run synchronously within tick()
+    controller.telemetryBus.addSink("remote", remote.sendSample)
+    controller.start(spawnThread=False)
+    if (controller.temperatureSampler != None):
+        controller.temperatureSampler.start()
+    try:
+        while controller.isRunning:
+            controller.tick()
+            await asyncio.sleep(min(CONTROL_LOOP_INTERVAL, controller.scheduler.timeUntilDue()))
+    finally:
+        controller.stop()
+        transport.close()
+
+
+def main():
+    global DISABLE_PRINTS
+    parser = argparse.ArgumentParser(description="Runs the Gaggia control loop with the heater driven by an external "
+                                     "controller over UDP, e.g. a Simulink model on a PC",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-i", "--ip", action="store", required=True,
+                        help="Address of the external controller, ip or ip:port")
+    parser.add_argument("-p", "--port", action="store", type=int,
+                        help="Port of the external controller", default=DEFAULT_PORT)
+    parser.add_argument("-l", "--listenport", action="store", type=int,
+                        help="Local UDP port that samples are sent from and commands are received on",
+                        default=DEFAULT_PORT)
+    parser.add_argument("--protocol", action="store", choices=UDP_PROTOCOLS,
+                        help="Sample format, legacy is the 10 byte simulinkEspresso.py layout, batched the sequenced "
+                        "datagram format of telemetryreceiver.py", default=PROTOCOL_LEGACY)
+    parser.add_argument("-t", "--timeout", action="store", type=float,
+                        help="Turn the heater off when no command has arrived for this many seconds",
+                        default=COMMAND_TIMEOUT)
+    parser.add_argument("-s", "--simulate", action="store_true",
+                        help="Run against a simulated boiler instead of the Pi hardware", default=False)
+    parser.add_argument("--directread", action="store_true",
+                        help="Read the thermocouple once per control step instead of oversampling it on a thread",
+                        default=False)
+    parser.add_argument("-d", "--disableprints", action="store_true",
+                        help="Disable prints", default=False)
+    config = vars(parser.parse_args())
+    DISABLE_PRINTS = config["disableprints"]
+
+    # The heater pin is driven low before the rest of the controller is set up
+    from gaggiahardware import BlinkaHardware, SimulatedHardware
+    hardware = SimulatedHardware() if config["simulate"] else BlinkaHardware()
+    from gaggiacontroller import GaggiaController
+    from temperaturesampler import TemperatureSampler
+    temperatureSampler = None
+    if (not config["directread"]):
+        temperatureSampler = TemperatureSampler(hardware)
+    controller = GaggiaController(None, None, None, config["disableprints"], hardware,
+                                  temperatureSampler=temperatureSampler)
+    host, port = parseAddress(config["ip"], config["port"])
+    # Commands are matched against the resolved address they arrive from
+    remote = RemoteControl(controller, (socket.gethostbyname(host), port), config["protocol"], config["timeout"])
+    try:
+        asyncio.run(runRemoteControl(controller, remote, ("0.0.0.0", config["listenport"])))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+    print(remote.getStats())
+
+
+if __name__ == "__main__":
+    main()
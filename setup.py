@@ -0,0 +1,14 @@
+from setuptools import setup, Extension
+
+# Builds the native PID binding next to the sources:
+# python3 setup.py build_ext --inplace
+setup(
+    name="EspressoRaspberryPi",
+    ext_modules=[
+        Extension("_pidcontroller",
+                  sources=["CodegenPid/pidcontrollermodule.c",
+                           "CodegenPid/PIDController.c"],
+                  include_dirs=["CodegenPid"],
+                  extra_compile_args=["-O2"]),
+    ],
+)
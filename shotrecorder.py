@@ -0,0 +1,126 @@
+import collections
+import mmap
+import os
+import struct
+import numpy as np
+from telemetrysample import TelemetrySample, DISK_RECORD
+
+FILE_MAGIC = b"GGTS"
+FILE_VERSION = 1
+# magic, version, record size, segment start (ms), reserved
+FILE_HEADER = struct.Struct("<4sHHq8x")
+RECORD = DISK_RECORD
+RECORD_DTYPE = np.dtype([("ts", "<f8"), ("temp", "<f4"), ("set", "<f4"), ("out", "<f4"), ("shotdur", "<f4"),
+                         ("brew", "u1"), ("steam", "u1"), ("pad", "V2")])
+assert RECORD_DTYPE.itemsize == RECORD.size
+
+SEGMENT_IDLE = "idle"
+SEGMENT_SHOT = "shot"
+DEFAULT_BATCH_SIZE = 20
+MAX_IDLE_SEGMENT_DURATION = 3600
+
+
+class ShotRecorder():
+    """
+    Appends every control sample to fixed-width binary segment files, one segment per shot and one per idle
+    period in between. Records are buffered in memory and written in batches of batchSize to spare the SD card.
+    """
+
+    def __init__(self, directory: str, batchSize: int = DEFAULT_BATCH_SIZE):
+        self.directory = directory
+        self.batchSize = batchSize
+        os.makedirs(directory, exist_ok=True)
+        self.file = None
+        self.segmentKind = None
+        self.segmentStarted = 0
+        self.buffer = bytearray(batchSize * RECORD.size)
+        self.bufferedCount = 0
+        # (segment kind, timestamp) of shot starts and ends not reached by append() yet, a quick flick of the
+        # brew switch can start and end a shot between two samples
+        self.pendingBoundaries = collections.deque()
+
+    def startShot(self, timestamp: float):
+        # Only noted here, the segment is switched by the first append at or after timestamp so that all file
+        # access stays on the appending thread
+        self.pendingBoundaries.append((SEGMENT_SHOT, timestamp))
+
+    def endShot(self, timestamp: float):
+        self.pendingBoundaries.append((SEGMENT_IDLE, timestamp))
+
+    def append(self, sample: TelemetrySample):
+        timestamp = sample.timestamp
+        openedSegment = False
+        while (len(self.pendingBoundaries) > 0 and timestamp >= self.pendingBoundaries[0][1]):
+            kind, boundaryTimestamp = self.pendingBoundaries.popleft()
+            self.__openSegment(kind, boundaryTimestamp)
+            openedSegment = True
+        if (not openedSegment and (self.file == None or (self.segmentKind == SEGMENT_IDLE and
+                                   timestamp - self.segmentStarted >= MAX_IDLE_SEGMENT_DURATION))):
+            self.__openSegment(SEGMENT_IDLE, timestamp)
+
+        sample.packRecordInto(self.buffer, self.bufferedCount * RECORD.size)
+        self.bufferedCount += 1
+        if (self.bufferedCount >= self.batchSize):
+            self.flush()
+
+    def flush(self):
+        if (self.file == None or self.bufferedCount == 0):
+            return
+        with memoryview(self.buffer) as view:
+            self.file.write(view[:self.bufferedCount * RECORD.size])
+        self.file.flush()
+        self.bufferedCount = 0
+
+    def close(self):
+        self.flush()
+        if (self.file != None):
+            self.file.close()
+            self.file = None
+
+    def __openSegment(self, kind: str, timestamp: float):
+        self.close()
+        startMillis = round(timestamp * 1000)
+        path = os.path.join(self.directory, f"{startMillis}-{kind}.bin")
+        self.file = open(path, "ab")
+        if (self.file.tell() == 0):
+            self.file.write(FILE_HEADER.pack(
+                FILE_MAGIC, FILE_VERSION, RECORD.size, startMillis))
+        self.segmentKind = kind
+        self.segmentStarted = timestamp
+
+
+def listSegments(directory: str) -> list:
+    """
+    Returns (startMillis, kind, path) of every recorded segment, oldest first
+    """
+    segments = []
+    if (not os.path.isdir(directory)):
+        return segments
+    for name in os.listdir(directory):
+        stem, extension = os.path.splitext(name)
+        if (extension != ".bin" or "-" not in stem):
+            continue
+        startMillis, kind = stem.split("-", 1)
+        if (not startMillis.isdigit()):
+            continue
+        segments.append((int(startMillis), kind, os.path.join(directory, name)))
+    segments.sort()
+    return segments
+
+
+def loadSegment(path: str) -> np.ndarray:
+    """
+    Memory-maps a segment file and returns its records as a read-only structured array without copying them.
+    A partially written trailing record is ignored.
+    """
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if (size < FILE_HEADER.size + RECORD.size):
+            return np.zeros(0, dtype=RECORD_DTYPE)
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, recordSize, startMillis = FILE_HEADER.unpack_from(
+        mapped, 0)
+    if (magic != FILE_MAGIC or recordSize != RECORD.size):
+        raise ValueError(f"{path} is not a telemetry segment")
+    count = (size - FILE_HEADER.size) // RECORD.size
+    return np.frombuffer(mapped, dtype=RECORD_DTYPE, count=count, offset=FILE_HEADER.size)
@@ -1,14 +1,21 @@
 from ctypes import *
+import numbers
 import os.path
 
 dll_name = "DiscretePid.so"
 dllabspath = os.path.dirname(
     os.path.abspath(__file__)) + os.path.sep + dll_name
-libc = CDLL(dllabspath)
+libc = None
 
-# Rename main functions for readability
-cPID_Initialize = libc.PIDController_initialize
-cPID_Step = libc.PIDController_step
+
+def loadLibrary() -> CDLL:
+    """
+    Loads DiscretePid.so on first use, so the module imports without it when the native extension is built
+    """
+    global libc
+    if (libc == None):
+        libc = CDLL(dllabspath)
+    return libc
 
 # Create both ctypes structures of both state variables
 
@@ -25,8 +32,16 @@ class RT_MODEL_PIDController_T(Structure):
                 ("dwork", POINTER(DW_PIDController_T))]
 
 
-class DiscretePid():
+class CtypesDiscretePid():
+    """
+    Binding of DiscretePid.so built by compilepid.sh. Used when the _pidcontroller extension has not been built.
+    """
+
     def __init__(self, pGain: float, iGain: float, dGain: float, filterCoeff: float, upperLimit: float, lowerLimit: float) -> None:
+        library = loadLibrary()
+        # Rename main functions for readability
+        cPID_Initialize = library.PIDController_initialize
+        self.cPID_Step = library.PIDController_step
         self.DW_PIDController_T = DW_PIDController_T()
         self.RT_MODEL_PIDController_T = RT_MODEL_PIDController_T()
         self.RT_MODEL_PIDController_T.dwork = pointer(self.DW_PIDController_T)
@@ -66,9 +81,26 @@ class DiscretePid():
         self.sampleTime.value = sampleTime
 
         #print(f"Calling PID with err: {self.error}, p: {self.pGain}, i: {self.iGain}, d: {self.dGain}, N: {self.filterCoeff}, iState: {self.integratorState}, fState: {self.filterState}, upperLimit: {self.upperLimit} , lowerLimit: {self.lowerLimit}, Ts: {self.sampleTime}")
-        cPID_Step(self.ptr_RT_MODEL_PIDController_T, self.error, self.pGain, self.iGain, self.dGain, self.filterCoeff,
+        self.cPID_Step(self.ptr_RT_MODEL_PIDController_T, self.error, self.pGain, self.iGain, self.dGain, self.filterCoeff,
                   self.integratorState, self.filterState, self.upperLimit, self.lowerLimit, self.sampleTime, self.ptr_output)
         #print(f"Out: {self.output}")
         self.filterState.value = self.RT_MODEL_PIDController_T.dwork.contents.Filter_DSTATE
         self.integratorState.value = self.RT_MODEL_PIDController_T.dwork.contents.Integrator_DSTATE
         return self.output.value
+
+    def step_many(self, errors, dts) -> list:
+        """
+        Steps once per error, dts is either one sample time for all steps or one per step
+        """
+        if (isinstance(dts, numbers.Real)):
+            return [self.step(error, dts) for error in errors]
+        return [self.step(error, dt) for error, dt in zip(errors, dts)]
+
+
+try:
+    # Native extension built with: python3 setup.py build_ext --inplace
+    from _pidcontroller import PidController as NativeDiscretePid
+except ImportError:
+    NativeDiscretePid = None
+
+DiscretePid = NativeDiscretePid if NativeDiscretePid != None else CtypesDiscretePid
@@ -0,0 +1,270 @@
+import email.utils
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+from gaggiahardware import originalModule
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ENCODING_IDENTITY = "identity"
+ENCODING_GZIP = "gzip"
+ENCODING_BROTLI = "br"
+# Preferred first when a client accepts several
+COMPRESSED_ENCODINGS = (ENCODING_BROTLI, ENCODING_GZIP)
+# Variants up to this size are served from memory, larger ones are streamed from disk
+MEMORY_LIMIT = 512 * 1024
+CHUNK_SIZE = 64 * 1024
+# Smaller files are not worth a Content-Encoding
+MIN_COMPRESS_SIZE = 512
+# A compressed variant has to save at least this fraction to be kept
+MIN_COMPRESSION_SAVING = 0.1
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "application/manifest+json",
+                      "image/svg+xml", "image/x-icon", "image/vnd.microsoft.icon")
+# Build tools put a content hash in the names of assets that never change under the same name
+HASHED_NAME = re.compile(r"\.[0-9a-f]{8,}\.")
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "no-cache"
+DEFAULT_CACHE_DIRECTORY = ".compressed"
+MAX_NEGOTIATION_CACHE_SIZE = 64
+
+mimetypes.add_type("application/javascript", ".js")
+mimetypes.add_type("application/manifest+json", ".webmanifest")
+mimetypes.add_type("application/json", ".map")
+
+
+class StaticVariant():
+    """
+    One encoding of a static asset with its prebuilt response headers. body is None when the variant is
+    streamed from path.
+    """
+
+    def __init__(self, body: bytes, path: str, size: int, headers: list):
+        self.body = body
+        self.path = path
+        self.size = size
+        self.headers = headers
+
+
+class StaticAsset():
+    def __init__(self, path: str, urlPath: str):
+        self.path = path
+        with open(path, "rb") as f:
+            data = f.read()
+        stat = os.stat(path)
+        self.tag = hashlib.sha256(data).hexdigest()[:20]
+        self.size = len(data)
+        contentType = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        if (contentType.startswith("text/") or contentType in ("application/javascript", "application/json")):
+            contentType += "; charset=utf-8"
+        self.contentType = contentType
+        self.compressible = self.size >= MIN_COMPRESS_SIZE and contentType.startswith(COMPRESSIBLE_TYPES)
+        self.lastModified = int(stat.st_mtime)
+        self.cacheControl = IMMUTABLE_CACHE_CONTROL if HASHED_NAME.search(
+            os.path.basename(urlPath)) else REVALIDATE_CACHE_CONTROL
+        self.commonHeaders = [("Cache-Control", self.cacheControl),
+                              ("Last-Modified", email.utils.formatdate(self.lastModified, usegmt=True))]
+        if (self.compressible):
+            self.commonHeaders.append(("Vary", "Accept-Encoding"))
+        self.notModifiedHeaders = [("ETag", f'"{self.tag}"')] + self.commonHeaders
+        # Replaced as a whole when compressed variants become available
+        self.variants = {ENCODING_IDENTITY: self.createVariant(
+            ENCODING_IDENTITY, data if self.size <= MEMORY_LIMIT else None, path, self.size)}
+
+    def createVariant(self, encoding: str, body: bytes, path: str, size: int) -> StaticVariant:
+        etag = f'"{self.tag}"' if encoding == ENCODING_IDENTITY else f'"{self.tag}-{encoding}"'
+        headers = [("Content-Type", self.contentType), ("Content-Length", str(size)), ("ETag", etag)]
+        if (encoding != ENCODING_IDENTITY):
+            headers.append(("Content-Encoding", encoding))
+        return StaticVariant(body, path, size, headers + self.commonHeaders)
+
+    def matchesETags(self, ifNoneMatch: str) -> bool:
+        """
+        Weak comparison against If-None-Match, any encoding of the same content matches
+        """
+        for etag in ifNoneMatch.split(","):
+            etag = etag.strip()
+            if (etag == "*"):
+                return True
+            if (etag.startswith("W/")):
+                etag = etag[2:]
+            if (etag.strip('"').split("-", 1)[0] == self.tag):
+                return True
+        return False
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    if (encoding == ENCODING_BROTLI):
+        return brotli.compress(data, quality=11)
+    # Fixed mtime so the same content always compresses to the same bytes
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+def readChunks(path: str):
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if (len(chunk) == 0):
+                return
+            yield chunk
+
+
+def parseAcceptEncoding(header: str) -> tuple:
+    """
+    Returns the compressed encodings the header accepts, in our order of preference
+    """
+    accepted = {}
+    for part in header.split(","):
+        fields = part.strip().split(";")
+        name = fields[0].strip().lower()
+        quality = 1.0
+        for parameter in fields[1:]:
+            key, _, value = parameter.strip().partition("=")
+            if (key.strip() == "q"):
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[name] = quality
+    wildcard = accepted.get("*", 0.0)
+    return tuple(encoding for encoding in COMPRESSED_ENCODINGS if accepted.get(encoding, wildcard) > 0)
+
+
+class StaticAssets():
+    """
+    WSGI app serving every file below root, and root/index.html at "/". Files are read and hashed once at
+    startup; responses carry strong ETags, revalidation or immutable caching for hashed build output and
+    gzip/brotli variants that are compressed once on a native thread and cached in root/cacheDirectory by
+    content hash. Requests for other paths go to fallback.
+    """
+
+    def __init__(self, root: str, fallback=None, cacheDirectory: str = DEFAULT_CACHE_DIRECTORY,
+                 compressInBackground: bool = True):
+        self.root = root
+        self.fallback = fallback
+        self.cacheDirectory = os.path.join(root, cacheDirectory) if cacheDirectory != None else None
+        self.assets = {}
+        self.negotiated = {}
+        for directory, subdirectories, files in os.walk(root):
+            # Skips the compression cache and other hidden directories
+            subdirectories[:] = [name for name in subdirectories if not name.startswith(".")]
+            for name in files:
+                path = os.path.join(directory, name)
+                urlPath = "/" + os.path.relpath(path, root).replace(os.sep, "/")
+                self.assets[urlPath] = StaticAsset(path, urlPath)
+        if ("/index.html" in self.assets):
+            self.assets["/"] = self.assets["/index.html"]
+        if (compressInBackground):
+            originalModule("threading").Thread(target=self.compressAll, args=(), daemon=True).start()
+        else:
+            self.compressAll()
+
+    def compressAll(self):
+        encodings = [ENCODING_GZIP] + ([ENCODING_BROTLI] if brotli != None else [])
+        if (len(self.assets) == 0):
+            return
+        if (self.cacheDirectory != None):
+            os.makedirs(self.cacheDirectory, exist_ok=True)
+        cached = set()
+        for asset in set(self.assets.values()):
+            if (not asset.compressible):
+                continue
+            for encoding in encodings:
+                try:
+                    cachedPath = self.__compressAsset(asset, encoding)
+                except OSError as e:
+                    print(f"Could not compress {asset.path}: {e}")
+                    continue
+                if (cachedPath != None):
+                    cached.add(cachedPath)
+        self.__removeStaleCacheFiles(cached)
+
+    def __compressAsset(self, asset: StaticAsset, encoding: str) -> str:
+        """
+        Adds the encoding variant of asset unless it does not save enough. Returns its cache file, if any.
+        """
+        cachedPath = None
+        body = None
+        if (self.cacheDirectory != None):
+            cachedPath = os.path.join(self.cacheDirectory, f"{asset.tag}.{encoding}")
+            if (os.path.exists(cachedPath)):
+                with open(cachedPath, "rb") as f:
+                    body = f.read()
+        if (body == None):
+            with open(asset.path, "rb") as f:
+                body = compress(f.read(), encoding)
+            if (cachedPath != None):
+                temporaryPath = cachedPath + ".tmp"
+                with open(temporaryPath, "wb") as f:
+                    f.write(body)
+                os.replace(temporaryPath, cachedPath)
+        if (len(body) > asset.size * (1 - MIN_COMPRESSION_SAVING)):
+            return cachedPath
+        if (len(body) > MEMORY_LIMIT and cachedPath != None):
+            variant = asset.createVariant(encoding, None, cachedPath, len(body))
+        else:
+            variant = asset.createVariant(encoding, body, None, len(body))
+        asset.variants = dict(asset.variants, **{encoding: variant})
+        return cachedPath
+
+    def __removeStaleCacheFiles(self, cached: set):
+        if (self.cacheDirectory == None):
+            return
+        for name in os.listdir(self.cacheDirectory):
+            path = os.path.join(self.cacheDirectory, name)
+            if (path not in cached):
+                os.remove(path)
+
+    def __negotiate(self, header: str) -> tuple:
+        encodings = self.negotiated.get(header)
+        if (encodings == None):
+            if (len(self.negotiated) >= MAX_NEGOTIATION_CACHE_SIZE):
+                self.negotiated.clear()
+            encodings = parseAcceptEncoding(header)
+            self.negotiated[header] = encodings
+        return encodings
+
+    def __call__(self, environ, start_response):
+        asset = self.assets.get(environ.get("PATH_INFO", ""))
+        if (asset == None):
+            if (self.fallback != None):
+                return self.fallback(environ, start_response)
+            start_response("404 Not Found", [("Content-Type", "text/plain")])
+            return [b"Not Found"]
+        method = environ.get("REQUEST_METHOD", "GET")
+        if (method not in ("GET", "HEAD")):
+            start_response("405 Method Not Allowed", [("Allow", "GET, HEAD")])
+            return []
+
+        ifNoneMatch = environ.get("HTTP_IF_NONE_MATCH")
+        if (ifNoneMatch != None):
+            notModified = asset.matchesETags(ifNoneMatch)
+        else:
+            ifModifiedSince = environ.get("HTTP_IF_MODIFIED_SINCE")
+            notModified = False
+            if (ifModifiedSince != None):
+                try:
+                    notModified = email.utils.parsedate_to_datetime(
+                        ifModifiedSince).timestamp() >= asset.lastModified
+                except (TypeError, ValueError):
+                    notModified = False
+        if (notModified):
+            start_response("304 Not Modified", asset.notModifiedHeaders)
+            return []
+
+        variants = asset.variants
+        variant = variants[ENCODING_IDENTITY]
+        for encoding in self.__negotiate(environ.get("HTTP_ACCEPT_ENCODING", "")):
+            if (encoding in variants):
+                variant = variants[encoding]
+                break
+        start_response("200 OK", variant.headers)
+        if (method == "HEAD"):
+            return []
+        if (variant.body != None):
+            return [variant.body]
+        return readChunks(variant.path)
@@ -0,0 +1,345 @@
+import argparse
+import asyncio
+import json
+import os
+import re
+import signal
+import socket
+import time
+import urllib.parse
+import numpy as np
+from controlmetrics import MetricsWriter, CONTENT_TYPE
+from shotrecorder import ShotRecorder
+from telemetryquery import TelemetryHistory, DEFAULT_POINTS, METHOD_LTTB
+from telemetryreceiver import LossTracker, SAMPLE_DTYPE, decodeDatagram
+from telemetrysample import TelemetrySample
+from udptelemetry import DEFAULT_PORT
+
+DEFAULT_HTTP_PORT = 8080
+# 10 minutes at the 2 Hz control rate
+DEFAULT_RING_CAPACITY = 1200
+# One minute of samples per write at 2 Hz
+STORE_BATCH_SIZE = 120
+STORE_FLUSH_INTERVAL = 10.0
+RECEIVE_BUFFER_SIZE = 4 << 20
+SUBSCRIBER_QUEUE_SIZE = 256
+# A machine that has sent nothing for this long is reported offline
+OFFLINE_TIMEOUT = 10.0
+MAX_REQUEST_HEADERS = 100
+UNSAFE_NAME_CHARACTERS = re.compile(r"[^A-Za-z0-9_.-]")
+
+
+class SampleRing():
+    """
+    The latest capacity samples of one machine in a fixed structured array. Whole datagrams are written with
+    one fancy-indexed assignment.
+    """
+
+    def __init__(self, capacity: int):
+        self.samples = np.zeros(capacity, dtype=SAMPLE_DTYPE)
+        self.writtenCount = 0
+
+    def write(self, samples: np.ndarray):
+        capacity = len(self.samples)
+        if (len(samples) > capacity):
+            self.writtenCount += len(samples) - capacity
+            samples = samples[-capacity:]
+        positions = (self.writtenCount + np.arange(len(samples))) % capacity
+        self.samples[positions] = samples
+        self.writtenCount += len(samples)
+
+    def latest(self, count: int) -> np.ndarray:
+        count = max(0, min(count, self.writtenCount, len(self.samples)))
+        positions = (self.writtenCount - count + np.arange(count)) % len(self.samples)
+        return self.samples[positions]
+
+
+class MachineTelemetry():
+    """
+    Everything the aggregator keeps for one machine: a ring buffer of recent samples, loss counters and,
+    with a store directory, a ShotRecorder writing every sample into per-shot segments below it.
+    """
+
+    def __init__(self, name: str, address: str, ringCapacity: int, storeDirectory: str = None):
+        self.name = name
+        self.address = address
+        self.ring = SampleRing(ringCapacity)
+        self.lossTracker = LossTracker()
+        self.lastSeen = None
+        self.recorder = None
+        self.history = None
+        self.brewing = False
+        if (storeDirectory != None):
+            directory = os.path.join(storeDirectory, UNSAFE_NAME_CHARACTERS.sub("_", name))
+            self.recorder = ShotRecorder(directory, STORE_BATCH_SIZE)
+            self.history = TelemetryHistory(directory)
+
+    def add(self, datagram, now: float):
+        self.lossTracker.track(datagram)
+        self.lastSeen = now
+        samples = datagram.samples
+        if (len(samples) == 0):
+            return
+        self.ring.write(samples)
+        if (self.recorder == None):
+            return
+        # Record fields are in TelemetrySample order
+        for record in samples.tolist():
+            sample = TelemetrySample._make(record)
+            if (bool(sample.brewSwitch) != self.brewing):
+                self.brewing = bool(sample.brewSwitch)
+                if (self.brewing):
+                    self.recorder.startShot(sample.timestamp)
+                else:
+                    self.recorder.endShot(sample.timestamp)
+            self.recorder.append(sample)
+
+    def flush(self):
+        if (self.recorder != None):
+            self.recorder.flush()
+
+    def close(self):
+        if (self.recorder != None):
+            self.recorder.close()
+
+    def describe(self, now: float) -> dict:
+        latest = self.ring.latest(1)
+        return dict(self.lossTracker.getStats(), name=self.name, address=self.address,
+                    online=self.lastSeen != None and now - self.lastSeen < OFFLINE_TIMEOUT,
+                    latest=toTelemetryData(latest)[0] if len(latest) > 0 else None)
+
+
+def toTelemetryData(samples: np.ndarray) -> list:
+    """
+    Samples in the Socket.IO telemetry format of gaggiaserver.py, with the sample number as seq
+    """
+    return [{"ts": round(timestamp * 1000), "temp": round(temperature, 2), "set": round(setpoint, 1),
+             "shotdur": round(shotDuration, 1), "seq": sampleNumber}
+            for timestamp, sampleNumber, temperature, setpoint, shotDuration in zip(
+                samples["timestamp"].tolist(), samples["sampleNumber"].tolist(), samples["temperature"].tolist(),
+                samples["setpoint"].tolist(), samples["shotDuration"].tolist())]
+
+
+class TelemetryAggregator(asyncio.DatagramProtocol):
+    """
+    Ingests batched UDP telemetry from any number of gaggiaserver.py instances on one asyncio loop. Machines
+    are told apart by source address and named with names, or by that address. Every datagram is decoded
+    without copying, written to the machine's ring buffer and store and passed to the dashboard subscribers,
+    each of which has its own bounded queue that drops its oldest events when the client cannot keep up.
+    """
+
+    def __init__(self, storeDirectory: str = None, ringCapacity: int = DEFAULT_RING_CAPACITY, names: dict = None,
+                 clock=time):
+        self.storeDirectory = storeDirectory
+        self.ringCapacity = ringCapacity
+        self.names = names if names != None else {}
+        self.clock = clock
+        self.machines = {}
+        self.subscribers = []
+        self.datagramCount = 0
+        self.invalidCount = 0
+        self.droppedEventCount = 0
+
+    def connection_made(self, transport):
+        sock = transport.get_extra_info("socket")
+        if (sock != None):
+            # Room for replayed bursts while the loop is busy with HTTP clients
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER_SIZE)
+
+    def datagram_received(self, data: bytes, address):
+        try:
+            datagram = decodeDatagram(data)
+        except ValueError:
+            self.invalidCount += 1
+            return
+        self.datagramCount += 1
+        host = address[0]
+        machine = self.machines.get(host)
+        if (machine == None):
+            machine = MachineTelemetry(self.names.get(host, host), host, self.ringCapacity, self.storeDirectory)
+            self.machines[host] = machine
+        machine.add(datagram, self.clock.monotonic())
+        if (len(self.subscribers) > 0 and len(datagram.samples) > 0):
+            self.__publish({"machine": machine.name, "telemetry": toTelemetryData(datagram.samples)})
+
+    def __publish(self, event: dict):
+        message = f"event: telemetry\ndata: {json.dumps(event)}\n\n".encode()
+        for queue in self.subscribers:
+            if (queue.full()):
+                queue.get_nowait()
+                self.droppedEventCount += 1
+            queue.put_nowait(message)
+
+    def findMachine(self, name: str) -> MachineTelemetry:
+        for machine in self.machines.values():
+            if (machine.name == name or machine.address == name):
+                return machine
+        return None
+
+    def flush(self):
+        for machine in self.machines.values():
+            machine.flush()
+
+    def close(self):
+        for machine in self.machines.values():
+            machine.close()
+
+    def writeMetrics(self, writer: MetricsWriter):
+        machines = list(self.machines.values())
+        writer.addCounter("aggregator_datagrams_total", "Valid telemetry datagrams received", self.datagramCount)
+        writer.addCounter("aggregator_invalid_datagrams_total", "Datagrams that were not telemetry",
+                          self.invalidCount)
+        writer.addGauge("aggregator_subscribers", "Connected dashboard feed clients", len(self.subscribers))
+        writer.addCounter("aggregator_dropped_events_total", "Feed events dropped for slow dashboard clients",
+                          self.droppedEventCount)
+        writer.addCounter("aggregator_samples_total", "Samples received per machine",
+                          [({"machine": m.name}, m.lossTracker.sampleCount) for m in machines])
+        writer.addCounter("aggregator_lost_datagrams_total", "Datagrams lost per machine",
+                          [({"machine": m.name}, m.lossTracker.lostDatagramCount) for m in machines])
+        writer.addCounter("aggregator_missing_samples_total", "Gaps in the sample numbers per machine",
+                          [({"machine": m.name}, m.lossTracker.missingSampleCount) for m in machines])
+        writer.addCounter("aggregator_restarts_total", "Sender restarts seen per machine",
+                          [({"machine": m.name}, m.lossTracker.restartCount) for m in machines])
+
+    async def flushPeriodically(self, interval: float = STORE_FLUSH_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            self.flush()
+
+    async def handleHttp(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Serves the dashboard feed:
+        /machines - every machine with its loss counters and latest sample
+        /telemetry?machine=&count= - the latest samples of a machine from its ring buffer
+        /history?machine=&start=&end=&points=&method= - downsampled recorded telemetry of a machine, times in ms
+        /stream - a Server-Sent Events stream of the telemetry of all machines
+        /metrics - Prometheus metrics
+        """
+        try:
+            requestLine = await reader.readline()
+            for _ in range(MAX_REQUEST_HEADERS):
+                line = await reader.readline()
+                if (line in (b"\r\n", b"\n", b"")):
+                    break
+            parts = requestLine.decode("latin-1").split()
+            if (len(parts) < 2):
+                return
+            if (parts[0] != "GET"):
+                self.__respond(writer, "405 Method Not Allowed", "text/plain", b"Method Not Allowed")
+                return
+            url = urllib.parse.urlsplit(parts[1])
+            query = dict(urllib.parse.parse_qsl(url.query))
+            if (url.path == "/stream"):
+                await self.__stream(writer)
+                return
+            self.__route(writer, url.path, query)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def __route(self, writer: asyncio.StreamWriter, path: str, query: dict):
+        now = self.clock.monotonic()
+        if (path == "/metrics"):
+            metrics = MetricsWriter()
+            self.writeMetrics(metrics)
+            self.__respond(writer, "200 OK", CONTENT_TYPE, metrics.render().encode())
+            return
+        if (path == "/machines"):
+            self.__respondJson(writer, [machine.describe(now) for machine in self.machines.values()])
+            return
+        if (path not in ("/telemetry", "/history")):
+            self.__respond(writer, "404 Not Found", "text/plain", b"Not Found")
+            return
+        machine = self.findMachine(query.get("machine", ""))
+        if (machine == None):
+            self.__respond(writer, "404 Not Found", "text/plain", b"Unknown machine")
+            return
+        try:
+            if (path == "/telemetry"):
+                count = int(query.get("count", self.ringCapacity))
+                self.__respondJson(writer, toTelemetryData(machine.ring.latest(count)))
+            elif (machine.history == None):
+                self.__respondJson(writer, [])
+            else:
+                machine.flush()
+                self.__respondJson(writer, machine.history.query(
+                    int(query["start"]), int(query["end"]), int(query.get("points", DEFAULT_POINTS)),
+                    query.get("method", METHOD_LTTB)))
+        except (KeyError, ValueError) as e:
+            self.__respond(writer, "400 Bad Request", "text/plain", str(e).encode())
+
+    async def __stream(self, writer: asyncio.StreamWriter):
+        queue = asyncio.Queue(SUBSCRIBER_QUEUE_SIZE)
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n"
+                     b"Access-Control-Allow-Origin: *\r\nConnection: close\r\n\r\n")
+        self.subscribers.append(queue)
+        try:
+            while True:
+                writer.write(await queue.get())
+                await writer.drain()
+        finally:
+            self.subscribers.remove(queue)
+
+    def __respondJson(self, writer: asyncio.StreamWriter, data):
+        self.__respond(writer, "200 OK", "application/json", json.dumps(data).encode())
+
+    def __respond(self, writer: asyncio.StreamWriter, status: str, contentType: str, body: bytes):
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {contentType}\r\nContent-Length: {len(body)}\r\n"
+                     f"Access-Control-Allow-Origin: *\r\nConnection: close\r\n\r\n".encode() + body)
+
+
+def parseNames(names: list) -> dict:
+    """
+    ["name=address", ...] to {address: name}
+    """
+    parsed = {}
+    for entry in names if names != None else []:
+        name, separator, address = entry.partition("=")
+        if (separator == "" or name == "" or address == ""):
+            raise ValueError(f"Machine names are name=address, not {entry}")
+        parsed[address] = name
+    return parsed
+
+
+async def serve(config: dict):
+    loop = asyncio.get_running_loop()
+    # Unwinds through the finally below so the stores are flushed
+    loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    aggregator = TelemetryAggregator(config["store"], config["ring"], parseNames(config["name"]))
+    transport, protocol = await loop.create_datagram_endpoint(lambda: aggregator,
+                                                              local_addr=("0.0.0.0", config["port"]))
+    server = await asyncio.start_server(aggregator.handleHttp, "0.0.0.0", config["listenport"])
+    print(f"Receiving telemetry on UDP port {config['port']}, dashboard feed on port {config['listenport']}")
+    try:
+        await asyncio.gather(server.serve_forever(), aggregator.flushPeriodically())
+    finally:
+        transport.close()
+        server.close()
+        aggregator.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Collects batched UDP telemetry from many gaggiaserver.py "
+                                     "--udpprotocol batched instances and serves one dashboard feed for all of them",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-p", "--port", action="store", type=int,
+                        help="UDP port to receive telemetry on", default=DEFAULT_PORT)
+    parser.add_argument("-l", "--listenport", action="store", type=int,
+                        help="Port of the HTTP dashboard feed", default=DEFAULT_HTTP_PORT)
+    parser.add_argument("-s", "--store", action="store",
+                        help="Record every sample into per-machine shot segments below this directory", default=None)
+    parser.add_argument("-r", "--ring", action="store", type=int,
+                        help="Recent samples kept in memory per machine", default=DEFAULT_RING_CAPACITY)
+    parser.add_argument("-n", "--name", action="append",
+                        help="Name a machine as name=address, may be repeated", default=None)
+    config = vars(parser.parse_args())
+    try:
+        asyncio.run(serve(config))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+import collections
+import threading
+import time
+from controlmetrics import LatencyHistogram
+from telemetrydecimator import TelemetryDecimator
+
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+DEFAULT_SINK_QUEUE_SIZE = 64
+MAX_PENDING = 256
+# How long stop() waits for each thread to hand out the remaining samples
+STOP_TIMEOUT = 1.0
+
+
+class TelemetrySink():
+    """
+    A consumer of the telemetry bus with its own bounded queue. When the queue is full the drop policy
+    decides whether the oldest queued or the incoming sample is discarded. An optional TelemetryDecimator
+    thins out the samples before they are queued. An optional poll is called on the sink thread after every
+    delivery and at least every pollInterval seconds.
+    """
+
+    def __init__(self, name: str, handler, maxQueueSize: int = DEFAULT_SINK_QUEUE_SIZE, dropPolicy: str = DROP_OLDEST,
+                 decimator: TelemetryDecimator = None, poll=None, pollInterval: float = None):
+        if (dropPolicy not in (DROP_OLDEST, DROP_NEWEST)):
+            raise ValueError(f"Unknown drop policy {dropPolicy}")
+        self.name = name
+        self.handler = handler
+        self.maxQueueSize = maxQueueSize
+        self.dropPolicy = dropPolicy
+        self.decimator = decimator
+        self.poll = poll
+        self.pollInterval = pollInterval if poll != None else None
+        # A bounded deque evicts the oldest sample within append(), so the drain thread can never empty the
+        # queue between a length check and an explicit pop
+        self.queue = collections.deque(maxlen=maxQueueSize if dropPolicy == DROP_OLDEST else None)
+        self.wakeup = threading.Event()
+        self.droppedCount = 0
+        self.deliveredCount = 0
+        self.errorCount = 0
+        self.latency = LatencyHistogram()
+
+    def offer(self, sample):
+        if (self.decimator == None):
+            self.__enqueue(sample)
+            return
+        for decimated in self.decimator.update(sample):
+            self.__enqueue(decimated)
+
+    def __enqueue(self, sample):
+        if (len(self.queue) >= self.maxQueueSize):
+            self.droppedCount += 1
+            if (self.dropPolicy == DROP_NEWEST):
+                return
+        self.queue.append(sample)
+        self.wakeup.set()
+
+    def deliverQueued(self):
+        while len(self.queue) > 0:
+            sample = self.queue.popleft()
+            started = time.perf_counter()
+            try:
+                self.handler(sample)
+                self.deliveredCount += 1
+                self.latency.observe(time.perf_counter() - started)
+            except Exception as e:
+                self.errorCount += 1
+                print(f"Telemetry sink {self.name} failed: {e}")
+
+
+class TelemetryBus():
+    """
+    Decouples the control loop from telemetry consumers. publish() is a single deque append; a dispatcher
+    thread fans samples out to the sinks, and every sink is drained by its own thread so a slow consumer
+    only ever fills its own queue. Samples the dispatcher falls more than maxPending behind on are dropped
+    and counted in droppedCount. Before start() is called samples are delivered synchronously on publish,
+    stop() delivers everything published up to then before the threads exit.
+    """
+
+    def __init__(self, maxPending: int = MAX_PENDING):
+        self.pending = collections.deque(maxlen=maxPending)
+        self.wakeup = threading.Event()
+        self.sinks = []
+        self.running = False
+        self.dispatchThread = None
+        self.sinkThreads = []
+        self.publishedCount = 0
+        self.droppedCount = 0
+
+    def addSink(self, name: str, handler, maxQueueSize: int = DEFAULT_SINK_QUEUE_SIZE,
+                dropPolicy: str = DROP_OLDEST, decimator: TelemetryDecimator = None, poll=None,
+                pollInterval: float = None) -> TelemetrySink:
+        sink = TelemetrySink(name, handler, maxQueueSize, dropPolicy, decimator, poll, pollInterval)
+        self.sinks.append(sink)
+        if (self.running):
+            self.__startSinkThread(sink)
+        return sink
+
+    def publish(self, sample):
+        self.publishedCount += 1
+        if (not self.running):
+            for sink in self.sinks:
+                sink.offer(sample)
+                sink.deliverQueued()
+            return
+        if (len(self.pending) == self.pending.maxlen):
+            self.droppedCount += 1
+        self.pending.append(sample)
+        self.wakeup.set()
+
+    def start(self):
+        self.running = True
+        self.dispatchThread = threading.Thread(target=self.__dispatch, args=(), daemon=True)
+        self.dispatchThread.start()
+        for sink in self.sinks:
+            self.__startSinkThread(sink)
+
+    def stop(self, timeout: float = STOP_TIMEOUT):
+        if (not self.running):
+            return
+        self.running = False
+        # The dispatcher hands out the pending samples first so the sink threads find them when they wake up
+        self.wakeup.set()
+        self.dispatchThread.join(timeout)
+        for sink in self.sinks:
+            sink.wakeup.set()
+        for thread in self.sinkThreads:
+            thread.join(timeout)
+
+    def getStats(self) -> dict:
+        return {sink.name: {"delivered": sink.deliveredCount, "dropped": sink.droppedCount,
+                            "errors": sink.errorCount, "queued": len(sink.queue)} for sink in self.sinks}
+
+    def __startSinkThread(self, sink: TelemetrySink):
+        thread = threading.Thread(target=self.__drainSink, args=(sink,), daemon=True)
+        self.sinkThreads.append(thread)
+        thread.start()
+
+    def __dispatch(self):
+        while self.running:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            self.__dispatchPending()
+        self.__dispatchPending()
+
+    def __dispatchPending(self):
+        while len(self.pending) > 0:
+            sample = self.pending.popleft()
+            for sink in self.sinks:
+                sink.offer(sample)
+
+    def __drainSink(self, sink: TelemetrySink):
+        while self.running:
+            sink.wakeup.wait(sink.pollInterval)
+            sink.wakeup.clear()
+            sink.deliverQueued()
+            if (sink.poll != None):
+                sink.poll()
+        sink.deliverQueued()
@@ -0,0 +1,116 @@
+# A keyframe block is encoded against all zeros, a delta block against the last record of the previous block
+# of the same stream
+BLOCK_KEYFRAME = 1
+BLOCK_DELTA = 2
+BLOCK_VERSION = BLOCK_KEYFRAME
+# Fixed-point scale of each field of the Socket.IO telemetry format, in block order
+FIELDS = (("seq", 1), ("ts", 1), ("temp", 100), ("set", 10), ("shotdur", 10))
+
+
+def encodeTelemetryBlock(records: list) -> bytes:
+    """
+    Packs Socket.IO telemetry dicts into one binary block: a kind byte and the record count, followed by
+    every field of every record as the difference to the same field of the previous record. Fields are fixed
+    point integers and differences are zigzag encoded LEB128 varints, so a typical live sample is one or two
+    bytes per field. The first record is encoded against all zeros, which makes this a keyframe.
+    """
+    block = bytearray([BLOCK_KEYFRAME])
+    encodeRecords(block, records, [0] * len(FIELDS))
+    return bytes(block)
+
+
+def decodeTelemetryBlock(block: bytes) -> list:
+    """
+    Inverse of encodeTelemetryBlock, only accepts keyframes
+    """
+    if (len(block) == 0 or block[0] != BLOCK_KEYFRAME):
+        raise ValueError("Unsupported telemetry block")
+    return decodeRecords(block, [0] * len(FIELDS))
+
+
+class TelemetryStreamEncoder():
+    """
+    Encodes consecutive blocks of one live stream. Every block after the first is a delta block that continues
+    from the last record of the previous one, so the absolute timestamp and sequence number are only sent in
+    keyframes. reset() makes the next block a keyframe, call it whenever a client joins the stream.
+    """
+
+    def __init__(self):
+        self.previous = None
+
+    def reset(self):
+        self.previous = None
+
+    def encode(self, records: list) -> bytes:
+        if (self.previous == None):
+            self.previous = [0] * len(FIELDS)
+            block = bytearray([BLOCK_KEYFRAME])
+        else:
+            block = bytearray([BLOCK_DELTA])
+        encodeRecords(block, records, self.previous)
+        return bytes(block)
+
+
+class TelemetryStreamDecoder():
+    """
+    Client side of TelemetryStreamEncoder. Delta blocks received before the first keyframe cannot be decoded
+    and raise ValueError.
+    """
+
+    def __init__(self):
+        self.previous = None
+
+    def decode(self, block: bytes) -> list:
+        if (len(block) == 0 or block[0] not in (BLOCK_KEYFRAME, BLOCK_DELTA)):
+            raise ValueError("Unsupported telemetry block")
+        if (block[0] == BLOCK_KEYFRAME):
+            self.previous = [0] * len(FIELDS)
+        elif (self.previous == None):
+            raise ValueError("Telemetry delta block without a keyframe")
+        return decodeRecords(block, self.previous)
+
+
+def encodeRecords(block: bytearray, records: list, previous: list):
+    """
+    Appends the record count and the records, previous holds the fixed-point values the first record is
+    encoded against and is left at those of the last record
+    """
+    appendVarint(block, len(records))
+    for record in records:
+        for i, (key, scale) in enumerate(FIELDS):
+            value = round(record.get(key, 0) * scale)
+            delta = value - previous[i]
+            previous[i] = value
+            appendVarint(block, (delta << 1) if delta >= 0 else ((-delta << 1) - 1))
+
+
+def decodeRecords(block: bytes, previous: list) -> list:
+    count, offset = readVarint(block, 1)
+    records = []
+    for _ in range(count):
+        record = {}
+        for i, (key, scale) in enumerate(FIELDS):
+            zigzag, offset = readVarint(block, offset)
+            previous[i] += (zigzag >> 1) if (zigzag & 1) == 0 else -((zigzag + 1) >> 1)
+            record[key] = previous[i] / scale if scale != 1 else previous[i]
+        records.append(record)
+    return records
+
+
+def appendVarint(block: bytearray, value: int):
+    while value >= 0x80:
+        block.append((value & 0x7F) | 0x80)
+        value >>= 7
+    block.append(value)
+
+
+def readVarint(block: bytes, offset: int):
+    value = 0
+    shift = 0
+    while True:
+        byte = block[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if (byte < 0x80):
+            return value, offset
+        shift += 7
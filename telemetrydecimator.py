@@ -0,0 +1,82 @@
+from telemetrysample import TelemetrySample
+
+DECIMATE_FULL = "full"
+DECIMATE_AVERAGE = "average"
+DECIMATE_MINMAX = "minmax"
+DECIMATE_ONCHANGE = "onchange"
+DECIMATION_MODES = (DECIMATE_FULL, DECIMATE_AVERAGE,
+                    DECIMATE_MINMAX, DECIMATE_ONCHANGE)
+DEFAULT_FACTOR = 2
+ONCHANGE_TEMPERATURE_DELTA = 0.2
+ONCHANGE_HEARTBEAT_INTERVAL = 10.0
+
+
+class TelemetryDecimator():
+    """
+    Reduces the control loop sample rate for one telemetry consumer. update() takes every sample and returns
+    the samples to pass on:
+    full - every sample
+    average - one sample per factor samples with temperature and heater output averaged
+    minmax - the lowest and highest temperature sample of every 2 * factor samples, so peaks survive
+    onchange - only samples where temperature moved by temperatureDelta, setpoint or switches changed, or
+    heartbeatInterval passed
+    With highRateWhileBrewing every sample is passed on while the brew switch is on.
+    """
+
+    def __init__(self, mode: str = DECIMATE_FULL, factor: int = DEFAULT_FACTOR, highRateWhileBrewing: bool = True,
+                 temperatureDelta: float = ONCHANGE_TEMPERATURE_DELTA,
+                 heartbeatInterval: float = ONCHANGE_HEARTBEAT_INTERVAL):
+        if (mode not in DECIMATION_MODES):
+            raise ValueError(f"Unknown decimation mode {mode}")
+        self.mode = mode
+        self.factor = max(1, int(factor))
+        self.highRateWhileBrewing = highRateWhileBrewing
+        self.temperatureDelta = temperatureDelta
+        self.heartbeatInterval = heartbeatInterval
+        self.window = []
+        self.lastPassed = None
+
+    def update(self, sample: TelemetrySample) -> list:
+        if (self.mode == DECIMATE_FULL):
+            return [sample]
+        if (self.highRateWhileBrewing and sample.brewSwitch):
+            # Close the partial window so the shot starts with nothing held back
+            passed = self.__flushWindow() + [sample]
+            self.lastPassed = sample
+            return passed
+
+        if (self.mode == DECIMATE_ONCHANGE):
+            if (not self.__hasChanged(sample)):
+                return []
+            self.lastPassed = sample
+            return [sample]
+
+        self.window.append(sample)
+        windowSize = self.factor if self.mode == DECIMATE_AVERAGE else 2 * self.factor
+        if (len(self.window) < windowSize):
+            return []
+        passed = self.__flushWindow()
+        self.lastPassed = passed[-1]
+        return passed
+
+    def __hasChanged(self, sample: TelemetrySample) -> bool:
+        last = self.lastPassed
+        return (last == None or abs(sample.temperature - last.temperature) >= self.temperatureDelta
+                or sample.setpoint != last.setpoint or sample.brewSwitch != last.brewSwitch
+                or sample.steamSwitch != last.steamSwitch or sample.shotDuration != last.shotDuration
+                or sample.timestamp - last.timestamp >= self.heartbeatInterval)
+
+    def __flushWindow(self) -> list:
+        window = self.window
+        if (len(window) == 0):
+            return []
+        self.window = []
+        if (self.mode == DECIMATE_AVERAGE):
+            # Averages are reported at the newest sample of the window, everything else is taken from it as is
+            return [window[-1]._replace(temperature=sum(s.temperature for s in window) / len(window),
+                                        output=sum(s.output for s in window) / len(window))]
+        low = min(window, key=lambda s: s.temperature)
+        high = max(window, key=lambda s: s.temperature)
+        if (low is high):
+            return [low]
+        return [low, high] if low.timestamp <= high.timestamp else [high, low]
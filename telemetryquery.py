@@ -0,0 +1,132 @@
+import collections
+import os
+import numpy as np
+import shotrecorder
+
+METHOD_LTTB = "lttb"
+METHOD_MINMAX = "minmax"
+DEFAULT_POINTS = 300
+MAX_POINTS = 5000
+CACHE_SIZE = 64
+
+
+def lttbIndices(x: np.ndarray, y: np.ndarray, threshold: int) -> np.ndarray:
+    """
+    Largest-triangle-three-buckets downsampling. Returns the indices of the threshold points that best keep
+    the visual shape of y(x). The first and last point are always kept.
+    """
+    count = len(x)
+    if (threshold >= count or threshold < 3):
+        return np.arange(count)
+    edges = np.linspace(1, count - 1, threshold - 1).astype(np.int64)
+    indices = np.empty(threshold, dtype=np.int64)
+    indices[0] = 0
+    indices[-1] = count - 1
+    selected = 0
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], max(edges[bucket + 1], edges[bucket] + 1)
+        nextStart = edges[bucket + 1]
+        nextEnd = edges[bucket + 2] if bucket + 2 < len(edges) else count
+        nextEnd = max(nextEnd, nextStart + 1)
+        averageX = x[nextStart:nextEnd].mean()
+        averageY = y[nextStart:nextEnd].mean()
+        areas = np.abs((x[selected] - averageX) * (y[start:end] - y[selected]) -
+                       (x[selected] - x[start:end]) * (averageY - y[selected]))
+        selected = start + int(np.argmax(areas))
+        indices[bucket + 1] = selected
+    return indices
+
+
+def minMaxIndices(y: np.ndarray, threshold: int) -> np.ndarray:
+    """
+    Keeps the minimum and maximum of each of threshold / 2 equally sized buckets, so that no peak is lost
+    """
+    count = len(y)
+    if (threshold >= count or threshold < 2):
+        return np.arange(count)
+    edges = np.linspace(0, count, threshold // 2 + 1).astype(np.int64)
+    indices = []
+    for start, end in zip(edges[:-1], edges[1:]):
+        if (end <= start):
+            continue
+        bucket = y[start:end]
+        low = start + int(np.argmin(bucket))
+        high = start + int(np.argmax(bucket))
+        indices += [low, high] if low <= high else [high, low]
+    return np.unique(np.array(indices, dtype=np.int64))
+
+
+class TelemetryHistory():
+    """
+    Range queries over ShotRecorder segments with server-side downsampling. Results are cached per range,
+    point budget and method; the cache key includes the size of every segment read so growing segments
+    are never served stale.
+    """
+
+    def __init__(self, directory: str, cacheSize: int = CACHE_SIZE):
+        self.directory = directory
+        self.cacheSize = cacheSize
+        self.cache = collections.OrderedDict()
+
+    def __overlappingSegments(self, startMillis: int, endMillis: int) -> list:
+        segments = shotrecorder.listSegments(self.directory)
+        overlapping = []
+        for i, (segmentStart, kind, path) in enumerate(segments):
+            segmentEnd = segments[i + 1][0] if i + \
+                1 < len(segments) else None
+            if (segmentStart > endMillis or (segmentEnd != None and segmentEnd < startMillis)):
+                continue
+            overlapping.append((path, os.path.getsize(path)))
+        return overlapping
+
+    def listShots(self) -> list:
+        """
+        Returns [{"start": ms, "end": ms}] for every recorded shot
+        """
+        segments = shotrecorder.listSegments(self.directory)
+        shots = []
+        for i, (segmentStart, kind, path) in enumerate(segments):
+            if (kind != shotrecorder.SEGMENT_SHOT):
+                continue
+            segmentEnd = segments[i + 1][0] if i + 1 < len(segments) else None
+            shots.append({"start": segmentStart, "end": segmentEnd})
+        return shots
+
+    def query(self, startMillis: int, endMillis: int, points: int = DEFAULT_POINTS, method: str = METHOD_LTTB) -> list:
+        """
+        Returns at most points telemetry dicts in the Socket.IO telemetry format between startMillis and endMillis
+        """
+        points = max(3, min(int(points), MAX_POINTS))
+        segments = self.__overlappingSegments(startMillis, endMillis)
+        key = (startMillis, endMillis, points, method, tuple(segments))
+        if (key in self.cache):
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        result = self.__query(startMillis, endMillis, points, method, segments)
+        self.cache[key] = result
+        if (len(self.cache) > self.cacheSize):
+            self.cache.popitem(last=False)
+        return result
+
+    def __query(self, startMillis: int, endMillis: int, points: int, method: str, segments: list) -> list:
+        arrays = [shotrecorder.loadSegment(path) for path, size in segments]
+        arrays = [a for a in arrays if len(a) > 0]
+        if (len(arrays) == 0):
+            return []
+        records = np.concatenate(arrays)
+        timestamps = records["ts"]
+        inRange = (timestamps >= startMillis / 1000) & (timestamps <= endMillis / 1000)
+        records = records[inRange]
+        if (len(records) == 0):
+            return []
+
+        if (method == METHOD_MINMAX):
+            indices = minMaxIndices(records["temp"], points)
+        else:
+            indices = lttbIndices(records["ts"], records["temp"], points)
+        selected = records[indices]
+        return [{"ts": round(ts * 1000), "temp": round(float(temp), 2), "set": round(float(setpoint), 1),
+                 "shotdur": round(float(shotdur), 1)}
+                for ts, temp, setpoint, shotdur in zip(selected["ts"], selected["temp"], selected["set"],
+                                                       selected["shotdur"])]
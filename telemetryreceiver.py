@@ -0,0 +1,177 @@
+import argparse
+import collections
+import socket
+import numpy as np
+from udptelemetry import DATAGRAM_HEADER, SAMPLE_RECORD, PROTOCOL_MAGIC, PROTOCOL_VERSION, MAX_DATAGRAM_SIZE, \
+    DEFAULT_PORT
+
+SAMPLE_FIELDS = ["timestamp", "sampleNumber", "temperature", "setpoint", "output", "shotDuration", "brewSwitch",
+                 "steamSwitch"]
+SAMPLE_FORMATS = ["<f8", "<u4", "<f4", "<f4", "<f4", "<f4", "u1", "u1"]
+SAMPLE_OFFSETS = [0, 8, 12, 16, 20, 24, 28, 29]
+SAMPLE_DTYPE = np.dtype({"names": SAMPLE_FIELDS, "formats": SAMPLE_FORMATS, "offsets": SAMPLE_OFFSETS,
+                         "itemsize": SAMPLE_RECORD.size})
+RECEIVE_BUFFER_SIZE = 1 << 20
+
+
+class TelemetryDatagram(collections.namedtuple("TelemetryDatagram", ["session", "sequence", "samples"])):
+    """
+    One decoded datagram. samples is a structured array with the fields of SAMPLE_DTYPE that views the
+    datagram's buffer, samples["temperature"] and the other fields are arrays without any copying.
+    """
+    __slots__ = ()
+
+
+def sampleDtype(recordSize: int) -> np.dtype:
+    """
+    SAMPLE_DTYPE for records of recordSize bytes, so fields appended by newer senders are skipped
+    """
+    if (recordSize == SAMPLE_RECORD.size):
+        return SAMPLE_DTYPE
+    return np.dtype({"names": SAMPLE_FIELDS, "formats": SAMPLE_FORMATS, "offsets": SAMPLE_OFFSETS,
+                     "itemsize": recordSize})
+
+
+def decodeDatagram(data) -> TelemetryDatagram:
+    """
+    Decodes a batched telemetry datagram from any buffer. Raises ValueError for anything else.
+    """
+    if (len(data) < DATAGRAM_HEADER.size):
+        raise ValueError("Datagram is shorter than the header")
+    magic, version, recordSize, count, session, sequence = DATAGRAM_HEADER.unpack_from(data, 0)
+    if (magic != PROTOCOL_MAGIC):
+        raise ValueError("Not a telemetry datagram")
+    if (version != PROTOCOL_VERSION):
+        raise ValueError(f"Unsupported telemetry protocol version {version}")
+    if (recordSize < SAMPLE_RECORD.size or DATAGRAM_HEADER.size + count * recordSize > len(data)):
+        raise ValueError("Truncated telemetry datagram")
+    samples = np.frombuffer(data, dtype=sampleDtype(recordSize), count=count, offset=DATAGRAM_HEADER.size)
+    return TelemetryDatagram(session, sequence, samples)
+
+
+class LossTracker():
+    """
+    Counts lost datagrams and samples of one sender. Loss is detected from gaps in the datagram sequence
+    numbers; gaps in the sample numbers also count samples the sender dropped or decimated before they were
+    sent. A new session id means the sender restarted.
+    """
+
+    def __init__(self):
+        self.session = None
+        self.nextSequence = None
+        self.nextSampleNumber = None
+        self.datagramCount = 0
+        self.sampleCount = 0
+        self.lostDatagramCount = 0
+        self.missingSampleCount = 0
+        self.reorderedCount = 0
+        self.restartCount = 0
+
+    def track(self, datagram: TelemetryDatagram):
+        if (datagram.session != self.session):
+            if (self.session != None):
+                self.restartCount += 1
+            self.session = datagram.session
+            self.nextSequence = None
+            self.nextSampleNumber = None
+        if (self.nextSequence != None):
+            gap = (datagram.sequence - self.nextSequence) & 0xFFFFFFFF
+            if (gap >= 0x80000000):
+                self.reorderedCount += 1
+            else:
+                self.lostDatagramCount += gap
+        self.nextSequence = (datagram.sequence + 1) & 0xFFFFFFFF
+        self.datagramCount += 1
+        samples = datagram.samples
+        self.sampleCount += len(samples)
+        if (len(samples) == 0):
+            return
+        sampleNumbers = samples["sampleNumber"]
+        if (self.nextSampleNumber != None and int(sampleNumbers[0]) > self.nextSampleNumber):
+            self.missingSampleCount += int(sampleNumbers[0]) - self.nextSampleNumber
+        self.missingSampleCount += int(np.sum(np.diff(sampleNumbers.astype(np.int64)) - 1))
+        self.nextSampleNumber = int(sampleNumbers[-1]) + 1
+
+    def getStats(self) -> dict:
+        return {"datagrams": self.datagramCount, "samples": self.sampleCount,
+                "lostDatagrams": self.lostDatagramCount, "missingSamples": self.missingSampleCount,
+                "reordered": self.reorderedCount, "restarts": self.restartCount}
+
+
+class TelemetryReceiver():
+    """
+    Receives batched UDP telemetry of one sender on port and keeps count of lost datagrams and samples
+    """
+
+    def __init__(self, port: int = DEFAULT_PORT, host: str = ""):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER_SIZE)
+        self.sock.bind((host, port))
+        self.lossTracker = LossTracker()
+        self.invalidCount = 0
+
+    def receive(self, timeout: float = None) -> TelemetryDatagram:
+        """
+        Blocks for the next valid datagram, None when timeout passes first
+        """
+        self.sock.settimeout(timeout)
+        while True:
+            try:
+                data, address = self.sock.recvfrom(MAX_DATAGRAM_SIZE)
+            except socket.timeout:
+                return None
+            try:
+                datagram = decodeDatagram(data)
+            except ValueError:
+                self.invalidCount += 1
+                continue
+            self.lossTracker.track(datagram)
+            return datagram
+
+    def getStats(self) -> dict:
+        return dict(self.lossTracker.getStats(), invalid=self.invalidCount)
+
+    def close(self):
+        self.sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Receives batched UDP telemetry from gaggiaserver.py "
+                                     "--udpprotocol batched",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-p", "--port", action="store", type=int,
+                        help="Port to receive telemetry on", default=DEFAULT_PORT)
+    parser.add_argument("-o", "--output", action="store",
+                        help="Append every sample to this CSV file", default=None)
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="Print a line for every datagram", default=False)
+    config = vars(parser.parse_args())
+
+    receiver = TelemetryReceiver(config["port"])
+    output = None
+    if (config["output"] != None):
+        output = open(config["output"], "a")
+        if (output.tell() == 0):
+            output.write(",".join(SAMPLE_FIELDS) + "\n")
+    try:
+        while True:
+            datagram = receiver.receive()
+            samples = datagram.samples
+            if (output != None):
+                np.savetxt(output, samples, fmt=["%.3f", "%d", "%.2f", "%.1f", "%.4f", "%.1f", "%d", "%d"],
+                           delimiter=",")
+                output.flush()
+            if (config["verbose"]):
+                print(f"{datagram.sequence}: {len(samples)} samples, {samples['temperature'][-1]:.2f} C, "
+                      f"{receiver.lossTracker.lostDatagramCount} datagrams lost")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if (output != None):
+            output.close()
+        receiver.close()
+    print(receiver.getStats())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+import collections
+import struct
+
+# Legacy UDP telemetry datagram: sample number, temperature, steam switch, brew switch, heater output
+UDP_PACKET = struct.Struct("<ifbbf")
+# Shot recorder record: timestamp (s), temperature, setpoint, heater output, shot duration, brew switch, steam switch
+DISK_RECORD = struct.Struct("<dffffBBxx")
+
+
+class TelemetrySample(collections.namedtuple("TelemetrySample", [
+        "timestamp", "sampleNumber", "temperature", "setpoint", "output", "shotDuration", "brewSwitch", "steamSwitch"])):
+    """
+    One control loop sample as published on the telemetry bus. Immutable and without a per-instance dict;
+    every wire format is packed straight from the fields. timestamp is wall clock time in seconds.
+    """
+    __slots__ = ()
+
+    def packUdpInto(self, buffer, offset: int = 0):
+        UDP_PACKET.pack_into(buffer, offset, self.sampleNumber, self.temperature, self.steamSwitch,
+                             self.brewSwitch, self.output)
+
+    def packRecordInto(self, buffer, offset: int = 0):
+        DISK_RECORD.pack_into(buffer, offset, self.timestamp, self.temperature, self.setpoint, self.output,
+                              self.shotDuration, self.brewSwitch, self.steamSwitch)
+
+    def toTelemetryData(self) -> dict:
+        """
+        Socket.IO telemetry message
+        """
+        return {"ts": round(self.timestamp * 1000), "temp": round(self.temperature, 2),
+                "set": round(self.setpoint, 1), "shotdur": round(self.shotDuration, 1)}
@@ -0,0 +1,114 @@
+import collections
+import math
+import time
+from gaggiahardware import GaggiaHardware, originalModule
+
+# The MAX31855 finishes a conversion roughly every 100 ms, reading faster only returns the same value
+MAX31855_CONVERSION_TIME = 0.1
+DEFAULT_MEDIAN_WINDOW = 5
+DEFAULT_SMOOTHING = 0.5
+DEFAULT_OUTLIER_THRESHOLD = 5.0
+DEFAULT_MAX_AGE = 1.0
+# Readings outside this range are open or shorted thermocouple garbage rather than boiler temperatures
+PLAUSIBLE_TEMPERATURE_RANGE = (-20.0, 300.0)
+
+
+class TemperatureSampler():
+    """
+    Reads the thermocouple at its conversion rate on a native thread and publishes a filtered estimate, so the
+    control loop never waits on SPI. Fault reads and implausible values are dropped, readings further than
+    outlierThreshold from the median of the last medianWindow accepted readings are rejected as spikes
+    (unless they persist for a whole window), and the median is smoothed with a first-order IIR filter.
+    Without start() the owner drives sampling by calling sampleOnce(), e.g. on a virtual clock.
+    """
+
+    def __init__(self, hardware: GaggiaHardware, clock=time, interval: float = MAX31855_CONVERSION_TIME,
+                 medianWindow: int = DEFAULT_MEDIAN_WINDOW, smoothing: float = DEFAULT_SMOOTHING,
+                 outlierThreshold: float = DEFAULT_OUTLIER_THRESHOLD, maxAge: float = DEFAULT_MAX_AGE):
+        self.hardware = hardware
+        self.clock = clock
+        self.interval = interval
+        self.smoothing = smoothing
+        self.outlierThreshold = outlierThreshold
+        self.maxAge = maxAge
+        self.window = collections.deque(maxlen=medianWindow)
+        self.consecutiveOutliers = 0
+        self.estimate = None
+        # (temperature, monotonic timestamp), replaced as a whole so readers never see a torn update
+        self.latest = None
+        self.lastError = None
+        self.readCount = 0
+        self.faultCount = 0
+        self.outlierCount = 0
+        self.running = False
+        self.samplerThread = None
+
+    def start(self):
+        self.running = True
+        self.samplerThread = originalModule("threading").Thread(
+            target=self.__sample, args=(), daemon=True)
+        self.samplerThread.start()
+
+    def stop(self):
+        self.running = False
+
+    def __sample(self):
+        nativeTime = originalModule("time")
+        nextRead = nativeTime.monotonic()
+        while self.running:
+            self.sampleOnce()
+            nextRead += self.interval
+            delay = nextRead - nativeTime.monotonic()
+            if (delay > 0):
+                nativeTime.sleep(delay)
+            else:
+                nextRead = nativeTime.monotonic()
+
+    def sampleOnce(self):
+        """
+        Takes one reading and updates the published estimate
+        """
+        timestamp = self.clock.monotonic()
+        self.readCount += 1
+        try:
+            temperature = self.hardware.readTemperature()
+        except RuntimeError as e:
+            self.faultCount += 1
+            self.lastError = e
+            return
+        low, high = PLAUSIBLE_TEMPERATURE_RANGE
+        if (temperature == None or not math.isfinite(temperature) or temperature < low or temperature > high):
+            self.faultCount += 1
+            self.lastError = RuntimeError(
+                f"implausible thermocouple reading {temperature}")
+            return
+
+        if (len(self.window) > 0 and abs(temperature - sorted(self.window)[len(self.window) // 2]) > self.outlierThreshold):
+            self.consecutiveOutliers += 1
+            if (self.consecutiveOutliers < self.window.maxlen):
+                self.outlierCount += 1
+                return
+            # Not a spike but a real jump, start over from here
+            self.window.clear()
+            self.estimate = None
+        self.consecutiveOutliers = 0
+        self.window.append(temperature)
+
+        median = sorted(self.window)[len(self.window) // 2]
+        if (self.estimate == None):
+            self.estimate = median
+        else:
+            self.estimate += self.smoothing * (median - self.estimate)
+        self.latest = (self.estimate, timestamp)
+
+    def readTemperature(self) -> float:
+        """
+        Returns the latest estimate. Raises RuntimeError if there has been no valid reading for maxAge seconds.
+        """
+        latest = self.latest
+        if (latest == None or self.clock.monotonic() - latest[1] > self.maxAge):
+            raise RuntimeError("no recent thermocouple reading", self.lastError)
+        return latest[0]
+
+    def getStats(self) -> dict:
+        return {"reads": self.readCount, "faults": self.faultCount, "outliers": self.outlierCount}
@@ -0,0 +1,114 @@
+import json
+import os
+import shelve
+import time
+from configstore import ConfigStore, isValidSetting
+
+
+def testSettingsAreValidated():
+    assert isValidSetting("brew_setpoint", 94)
+    assert not isValidSetting("brew_setpoint", 200)
+    assert not isValidSetting("brew_setpoint", "94")
+    assert not isValidSetting("brew_setpoint", True)
+    assert not isValidSetting("steam_setpoint", float("nan"))
+    assert not isValidSetting("unknown", 1.0)
+    assert isValidSetting("p_gain", -5.0)
+
+
+def testUpdateIsAllOrNothing(tmp_path):
+    store = ConfigStore(str(tmp_path / "config"))
+    assert not store.update({"brew_setpoint": 93.0, "steam_setpoint": 500.0})
+    assert store.get("brew_setpoint") == None
+    store.close()
+
+
+def testFlushWritesAtomically(tmp_path):
+    basePath = str(tmp_path / "config")
+    store = ConfigStore(basePath, quietPeriod=3600)
+    assert store.set("brew_setpoint", 93.5)
+    store.flush()
+    with open(basePath + ".json") as f:
+        assert json.load(f) == {"brew_setpoint": 93.5}
+    # Nothing is left behind by the temp file and rename
+    assert sorted(os.listdir(tmp_path)) == ["config.json"]
+    assert store.writeCount == 1
+    store.flush()
+    assert store.writeCount == 1
+    store.close()
+    assert ConfigStore(basePath).get("brew_setpoint") == 93.5
+
+
+def testChangesAreCoalescedWithinTheQuietPeriod(tmp_path):
+    store = ConfigStore(str(tmp_path / "config"), quietPeriod=0.2)
+    for setpoint in range(85, 95):
+        store.set("brew_setpoint", setpoint)
+    time.sleep(0.6)
+    assert store.writeCount == 1
+    store.close()
+
+
+def testSteadyChangesAreWrittenWithinMaxDelay(tmp_path):
+    store = ConfigStore(str(tmp_path / "config"), quietPeriod=0.2, maxDelay=0.5)
+    started = time.monotonic()
+    while time.monotonic() - started < 1.2:
+        store.set("brew_setpoint", 90.0 + time.monotonic() - started)
+        time.sleep(0.05)
+    assert store.writeCount >= 2
+    store.close()
+
+
+def testLegacyShelveIsMigrated(tmp_path):
+    basePath = str(tmp_path / "config")
+    with shelve.open(basePath) as cfg:
+        cfg["brew_setpoint"] = 92.0
+        cfg["steam_setpoint"] = 1000.0
+    store = ConfigStore(basePath)
+    assert store.get("brew_setpoint") == 92.0
+    # Invalid legacy values are dropped rather than carried over
+    assert store.get("steam_setpoint") == None
+    # Only written along with the first flush
+    assert not os.path.exists(basePath + ".json")
+    store.close()
+    with open(basePath + ".json") as f:
+        assert json.load(f) == {"brew_setpoint": 92.0}
+
+
+def testUnreadableConfigIsIgnored(tmp_path):
+    basePath = str(tmp_path / "config")
+    with open(basePath + ".json", "w") as f:
+        f.write("{not json")
+    assert ConfigStore(basePath).get("brew_setpoint") == None
+
+
+def testMemoryOnlyStoreWritesNothing(tmp_path):
+    store = ConfigStore(None)
+    assert store.set("brew_setpoint", 95.0)
+    store.close()
+    assert store.writeCount == 0
+
+
+def testOpeningAStoreWritesNothing(tmp_path):
+    basePath = str(tmp_path / "config")
+    with open(basePath + ".json", "w") as f:
+        json.dump({"brew_setpoint": 93.0}, f)
+    modified = os.stat(basePath + ".json").st_mtime_ns
+    store = ConfigStore(basePath)
+    assert store.get("brew_setpoint") == 93.0
+    store.close()
+    assert store.writeCount == 0
+    assert os.stat(basePath + ".json").st_mtime_ns == modified
+
+
+def testFlushKeepsKeysWrittenByAnotherStore(tmp_path):
+    basePath = str(tmp_path / "config")
+    controller = ConfigStore(basePath, quietPeriod=3600)
+    controller.set("brew_setpoint", 94.0)
+    controller.flush()
+    # The autotuner stores its gains while the controller keeps running with its own copy of the settings
+    autotuner = ConfigStore(basePath, quietPeriod=3600)
+    autotuner.update({"p_gain": 2.5, "i_gain": 0.1})
+    autotuner.close()
+    controller.set("steam_setpoint", 140.0)
+    controller.close()
+    with open(basePath + ".json") as f:
+        assert json.load(f) == {"brew_setpoint": 94.0, "steam_setpoint": 140.0, "p_gain": 2.5, "i_gain": 0.1}
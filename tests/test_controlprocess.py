@@ -0,0 +1,109 @@
+import threading
+import pytest
+from controlprocess import TelemetryRing, CommandChannel, ControllerState, TELEMETRY_RECORD, HEADER_SIZE, \
+    STATE_VERSION, CMD_SET_BREW_SETPOINT, CMD_SET_STEAM_SETPOINT
+from telemetrysample import TelemetrySample
+
+
+@pytest.fixture
+def release():
+    segments = []
+    yield segments.append
+    for shm in segments:
+        shm.close()
+        shm.unlink()
+
+
+def sample(number: int) -> TelemetrySample:
+    return TelemetrySample(1700000000.0 + number, number, 90.0 + number, 94.0, 0.5, 0.0, False, True)
+
+
+def testRingDeliversEverySampleOnce(release):
+    ring = TelemetryRing.create(4)
+    release(ring.shm)
+    reader = TelemetryRing(ring.shm)
+    for number in range(1, 4):
+        ring.write(sample(number))
+    assert [s.temperature for s in reader.readNew()] == [91.0, 92.0, 93.0]
+    assert reader.readNew() == []
+    # Wraps around the end of the ring
+    for number in range(4, 8):
+        ring.write(sample(number))
+    assert [s.sampleNumber for s in reader.readNew()] == [4, 5, 6, 7]
+    assert reader.droppedCount == 0
+
+
+def testRingOverrunSkipsOverwrittenSamples(release):
+    ring = TelemetryRing.create(4)
+    release(ring.shm)
+    reader = TelemetryRing(ring.shm)
+    for number in range(1, 11):
+        ring.write(sample(number))
+    assert [s.sampleNumber for s in reader.readNew()] == [7, 8, 9, 10]
+    assert reader.droppedCount == 6
+
+
+def testRingRejectsTornRecords(release):
+    ring = TelemetryRing.create(4)
+    release(ring.shm)
+    reader = TelemetryRing(ring.shm)
+    ring.write(sample(1))
+    ring.write(sample(2))
+    # The trailing seq of record 2 still holds an older value, as while the producer is rewriting it
+    offset = HEADER_SIZE + TELEMETRY_RECORD.size * 2 - 8
+    ring.buffer[offset:offset + 8] = (99).to_bytes(8, "little")
+    assert [s.sampleNumber for s in reader.readNew()] == [1]
+    assert reader.droppedCount == 1
+
+
+def testCommandChannelFullAndEmpty(release):
+    channel = CommandChannel.create(2)
+    release(channel.shm)
+    consumer = CommandChannel(channel.shm)
+    assert consumer.popAll() == []
+    assert channel.push(CMD_SET_BREW_SETPOINT, 93.0)
+    assert channel.push(CMD_SET_STEAM_SETPOINT, 140.0)
+    assert not channel.push(CMD_SET_BREW_SETPOINT, 95.0)
+    assert consumer.popAll() == [(CMD_SET_BREW_SETPOINT, 93.0), (CMD_SET_STEAM_SETPOINT, 140.0)]
+    assert consumer.popAll() == []
+    # Room again once the consumer has caught up, across the end of the buffer
+    assert channel.push(CMD_SET_BREW_SETPOINT, 95.0)
+    assert consumer.popAll() == [(CMD_SET_BREW_SETPOINT, 95.0)]
+
+
+def testStateReadsAreNeverTorn(release):
+    state = ControllerState.create()
+    release(state.shm)
+    reader = ControllerState(state.shm)
+    done = threading.Event()
+
+    def publishContinuously():
+        value = 0.0
+        while not done.is_set():
+            value += 1.0
+            state.publish(value, value, value, value)
+
+    writer = threading.Thread(target=publishContinuously)
+    writer.start()
+    try:
+        versions = set()
+        for _ in range(20000):
+            version, *values = reader.read()
+            assert version % 2 == 0
+            assert len(set(values)) == 1
+            versions.add(version)
+    finally:
+        done.set()
+        writer.join()
+    assert len(versions) > 1
+
+
+def testStateReadGivesUpOnAStuckWriter(release):
+    state = ControllerState.create()
+    release(state.shm)
+    reader = ControllerState(state.shm)
+    state.publish(93.0, 140.0, 25.0, 0.1)
+    assert reader.read() == (2, 93.0, 140.0, 25.0, 0.1)
+    # A writer that died between marking the write and finishing it
+    STATE_VERSION.pack_into(state.buffer, 0, 3)
+    assert reader.read() == (2, 93.0, 140.0, 25.0, 0.1)
@@ -0,0 +1,57 @@
+import pytest
+from fixedratescheduler import FixedRateScheduler
+
+
+class FakeClock():
+    def __init__(self, now: float = 100.0):
+        self.now = now
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+def testFiresOnAbsoluteDeadlines():
+    clock = FakeClock()
+    scheduler = FixedRateScheduler(0.5, clock)
+    scheduler.start()
+    assert scheduler.timeUntilDue() == 0.5
+    clock.now = 100.25
+    assert scheduler.poll() == None
+    clock.now = 100.625
+    assert scheduler.poll() == 0.625
+    # A late cycle does not push back the next deadline
+    assert scheduler.nextDeadline == 101.0
+    assert scheduler.timeUntilDue() == 0.375
+    clock.now = 101.0
+    assert scheduler.poll() == 0.375
+    assert scheduler.poll() == None
+    assert (scheduler.cycleCount, scheduler.lateCount, scheduler.missedCount) == (2, 1, 0)
+    assert scheduler.maxLateness == 0.125
+
+
+def testSkipsDeadlinesThatPassedEntirely():
+    clock = FakeClock()
+    scheduler = FixedRateScheduler(0.5, clock)
+    scheduler.start()
+    clock.now = 101.75
+    assert scheduler.poll() == 1.75
+    assert scheduler.missedCount == 2
+    assert scheduler.nextDeadline == 102.0
+    # Lateness is measured from the latest deadline that was reached, not the first one that was missed
+    assert scheduler.maxLateness == 0.25
+    assert scheduler.lateCount == 1
+
+
+def testLatenessHistogram():
+    clock = FakeClock()
+    scheduler = FixedRateScheduler(0.5, clock, lateThreshold=0.01)
+    scheduler.start()
+    for lateness in [0.0, 0.0078125, 0.03125, 0.25]:
+        clock.now = scheduler.nextDeadline + lateness
+        scheduler.poll()
+    stats = scheduler.getStats()
+    assert stats["cycles"] == 4 and stats["late"] == 2
+    histogram = stats["jitterHistogram"]
+    assert sum(histogram.values()) == 4
+    assert histogram["0.001"] == 1 and histogram["0.01"] == 1 and histogram["0.05"] == 1 and histogram["0.5"] == 1
+    assert stats["maxLateness"] == pytest.approx(0.25)
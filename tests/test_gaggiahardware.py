@@ -0,0 +1,76 @@
+from gaggiacontroller import GaggiaController
+from gaggiahardware import SwitchEdgeDetector, SimulatedHardware, SWITCH_DEBOUNCE_TIME
+
+
+class FakeClock():
+    def __init__(self):
+        self.now = 50.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def time(self) -> float:
+        return 1700000000.0 + self.now
+
+    def sleep(self, seconds: float):
+        self.now += seconds
+
+
+def testDetectorReportsLeadingEdgesWithTheirTime():
+    detector = SwitchEdgeDetector(False)
+    assert not detector.update(False, 1.0)
+    assert detector.update(True, 1.5)
+    assert (detector.state, detector.lastEdgeTimestamp) == (True, 1.5)
+    assert not detector.update(True, 1.6)
+    assert detector.update(False, 2.0)
+    assert (detector.state, detector.lastEdgeTimestamp) == (False, 2.0)
+
+
+def testDetectorSuppressesBounce():
+    detector = SwitchEdgeDetector(False, debounceTime=0.03)
+    assert detector.update(True, 1.0)
+    # Contact bounce right after the edge
+    for offset, state in [(0.002, False), (0.004, True), (0.01, False), (0.02, True)]:
+        assert not detector.update(state, 1.0 + offset)
+    assert detector.state and detector.lastEdgeTimestamp == 1.0
+    assert detector.update(False, 1.5)
+
+
+def testDetectorReportsAChangeHeldBackByTheDebounceTimeOnALaterPoll():
+    detector = SwitchEdgeDetector(False, debounceTime=0.03)
+    assert detector.update(True, 1.0)
+    assert not detector.update(False, 1.01)
+    assert detector.update(False, 1.04)
+    assert (detector.state, detector.lastEdgeTimestamp) == (False, 1.04)
+
+
+def testSimulatedSwitchGoesThroughTheDebouncer():
+    clock = FakeClock()
+    hardware = SimulatedHardware(clock)
+    edges = []
+    assert hardware.setBrewSwitchCallback(lambda state, timestamp: edges.append((state, timestamp)))
+    hardware.setBrewSwitch(True)
+    clock.now += SWITCH_DEBOUNCE_TIME / 3
+    hardware.setBrewSwitch(False)
+    assert edges == [(True, 50.0)]
+    clock.now += SWITCH_DEBOUNCE_TIME
+    hardware.noteTick()
+    assert edges == [(True, 50.0), (False, clock.now)]
+
+
+def testBounceDoesNotReachThePump():
+    clock = FakeClock()
+    hardware = SimulatedHardware(clock)
+    controller = GaggiaController(None, None, None, True, hardware, clock=clock, configPath=None,
+                                  registerExitHandler=False)
+    controller.start(spawnThread=False)
+    hardware.setBrewSwitch(True)
+    assert hardware.pumpEnabled
+    clock.now += 0.005
+    hardware.setBrewSwitch(False)
+    # The bounce is inside the debounce time, neither the edge nor the tick turn the pump off
+    controller.tick()
+    assert hardware.pumpEnabled
+    clock.now += 0.1
+    controller.tick()
+    assert not hardware.pumpEnabled
@@ -0,0 +1,66 @@
+import math
+import pytest
+from gaggiacontroller import GaggiaController, CONTROL_LOOP_INTERVAL
+from gaggiahardware import SimulatedHardware
+from gaggiasimulation import VirtualClock
+from hardwarerecording import RecordingHardware, replayRecording, loadRecording, FILE_HEADER, EVENT_RECORD, \
+    EVENT_HEATER
+from temperaturesampler import TemperatureSampler
+
+
+def recordRun(path: str, oversample: bool = False) -> int:
+    """
+    Records a warm-up, a shot, a setpoint change and a steam session on a virtual clock, returns the tick count
+    """
+    clock = VirtualClock(1700000000.0)
+    simulated = SimulatedHardware(clock, temperatureNoise=0.05)
+    hardware = RecordingHardware(simulated, path, clock, oversampled=oversample)
+    sampler = TemperatureSampler(hardware, clock, CONTROL_LOOP_INTERVAL) if oversample else None
+    controller = GaggiaController(None, None, None, True, hardware, clock=clock, configPath=None,
+                                  registerExitHandler=False, temperatureSampler=sampler)
+    controller.start(spawnThread=False)
+    ticks = 0
+    for step in range(3000):
+        if (step == 1500):
+            simulated.setBrewSwitch(True)
+        elif (step == 1750):
+            simulated.setBrewSwitch(False)
+        elif (step == 2000):
+            controller.setBrewSetpoint(92.0)
+        elif (step == 2500):
+            simulated.setSteamSwitch(True)
+        if (sampler != None):
+            sampler.sampleOnce()
+        controller.tick()
+        ticks += 1
+        clock.sleep(CONTROL_LOOP_INTERVAL)
+    hardware.close()
+    return ticks
+
+
+@pytest.mark.parametrize("oversample", [False, True])
+def testReplayReproducesEveryOutput(tmp_path, oversample):
+    path = str(tmp_path / "run.gio")
+    ticks = recordRun(path, oversample)
+    result = replayRecording(path)
+    assert result["oversample"] == oversample
+    assert result["ticks"] == ticks
+    assert result["divergences"] == []
+    assert result["maxHeaterDifference"] == 0.0
+
+
+def testReplayReportsAChangedHeaterOutput(tmp_path):
+    path = str(tmp_path / "run.gio")
+    recordRun(path)
+    header, timestamps, kinds, values = loadRecording(path)
+    heaterEvents = [i for i, kind in enumerate(kinds.tolist()) if kind == EVENT_HEATER]
+    # Well after start, where the heater is driven by the PID. A short run has no gap events, so event
+    # indices are record indices in the file.
+    tampered = heaterEvents[len(heaterEvents) // 2]
+    with open(path, "r+b") as f:
+        f.seek(FILE_HEADER.size + tampered * EVENT_RECORD.size + EVENT_RECORD.size - 8)
+        f.write(EVENT_RECORD.pack(0, 0, values[tampered] + 0.25)[-8:])
+    result = replayRecording(path)
+    assert len(result["divergences"]) >= 1
+    assert result["divergences"][0][1] == "heater"
+    assert math.isclose(result["maxHeaterDifference"], 0.25, rel_tol=1e-6)
@@ -0,0 +1,128 @@
+import asyncio
+import pytest
+import remotecontrol
+from remotecontrol import RemoteControl, COMMAND, LEGACY_COMMAND, LEGACY_SAMPLE
+from telemetryreceiver import decodeDatagram
+from telemetrysample import TelemetrySample
+from udptelemetry import PROTOCOL_BATCHED, PROTOCOL_LEGACY
+
+CONTROLLER_ADDRESS = ("10.0.0.9", 7788)
+TIMEOUT = 0.3
+
+
+class FakeTransport():
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, address):
+        self.sent.append((bytes(data), address))
+
+
+class FakeController():
+    def __init__(self):
+        self.outputs = []
+
+    def setRemoteOutput(self, output: float):
+        self.outputs.append(output)
+
+
+@pytest.fixture(autouse=True)
+def quiet(monkeypatch):
+    monkeypatch.setattr(remotecontrol, "DISABLE_PRINTS", True)
+
+
+def sample(number: int) -> TelemetrySample:
+    return TelemetrySample(1700000000.0 + number * 0.5, number, 93.25, 94.0, 0.5, 0.0, True, False)
+
+
+def runConnected(test, protocol: str = PROTOCOL_LEGACY):
+    """
+    Runs test(remote, controller, transport) on an event loop with the remote connected to a fake transport
+    """
+    async def run():
+        controller = FakeController()
+        transport = FakeTransport()
+        remote = RemoteControl(controller, CONTROLLER_ADDRESS, protocol, TIMEOUT)
+        remote.connection_made(transport)
+        try:
+            await test(remote, controller, transport)
+        finally:
+            remote.connection_lost(None)
+    asyncio.run(run())
+
+
+def testLegacyIsTheDefaultProtocol():
+    assert RemoteControl(FakeController(), CONTROLLER_ADDRESS).protocol == PROTOCOL_LEGACY
+
+
+def testSamplesAreSentInTheChosenFormat():
+    async def legacy(remote, controller, transport):
+        remote.sendSample(sample(5))
+        data, address = transport.sent[0]
+        assert address == CONTROLLER_ADDRESS
+        assert LEGACY_SAMPLE.unpack(data) == (5, 93.25, 0, 1)
+
+    async def batched(remote, controller, transport):
+        remote.sendSample(sample(5))
+        remote.sendSample(sample(6))
+        decoded = [decodeDatagram(data) for data, address in transport.sent]
+        assert [d.samples["sampleNumber"].tolist() for d in decoded] == [[5], [6]]
+        assert [d.sequence for d in decoded] == [0, 1]
+
+    runConnected(legacy)
+    runConnected(batched, PROTOCOL_BATCHED)
+
+
+def testCommandsSetTheHeaterAndMeasureTheRoundTrip():
+    async def test(remote, controller, transport):
+        # Nothing heats before the first command
+        assert controller.outputs == [0.0]
+        remote.sendSample(sample(1))
+        remote.sendSample(sample(2))
+        remote.datagram_received(COMMAND.pack(1, 0.75), (CONTROLLER_ADDRESS[0], 5000))
+        assert controller.outputs[-1] == 0.75
+        # A legacy command answers the latest sample
+        remote.datagram_received(LEGACY_COMMAND.pack(0.5), CONTROLLER_ADDRESS)
+        assert controller.outputs[-1] == 0.5
+        # Answers to samples that were never sent still set the heater but have no round trip
+        remote.datagram_received(COMMAND.pack(99, 0.25), CONTROLLER_ADDRESS)
+        stats = remote.getStats()
+        assert stats["commands"] == 3 and stats["roundTrips"] == 2
+        assert 0 <= stats["meanRoundTrip"] <= stats["maxRoundTrip"]
+
+    runConnected(test)
+
+
+def testForeignAndMalformedCommandsAreIgnored():
+    async def test(remote, controller, transport):
+        remote.datagram_received(COMMAND.pack(1, 1.0), ("10.0.0.10", 7788))
+        remote.datagram_received(b"\x00" * 3, CONTROLLER_ADDRESS)
+        remote.datagram_received(LEGACY_COMMAND.pack(float("nan")), CONTROLLER_ADDRESS)
+        assert controller.outputs == [0.0]
+        stats = remote.getStats()
+        assert (stats["unknownSenders"], stats["invalidCommands"], stats["commands"]) == (1, 2, 0)
+
+    runConnected(test)
+
+
+def testWatchdogTurnsTheHeaterOffWithoutCommands():
+    async def test(remote, controller, transport):
+        # Commands within the timeout keep the heater on
+        for _ in range(3):
+            remote.datagram_received(LEGACY_COMMAND.pack(0.875), CONTROLLER_ADDRESS)
+            await asyncio.sleep(TIMEOUT / 4)
+        assert controller.outputs == [0.0, 0.875, 0.875, 0.875]
+        assert remote.timeoutCount == 0
+
+        await asyncio.sleep(TIMEOUT * 1.5)
+        assert controller.outputs[-1] == 0.0
+        assert remote.timedOut and remote.timeoutCount == 1
+        # Still silent, the heater stays off and the timeout is counted once
+        await asyncio.sleep(TIMEOUT * 1.5)
+        assert remote.timeoutCount == 1
+
+        remote.datagram_received(LEGACY_COMMAND.pack(0.375), CONTROLLER_ADDRESS)
+        assert controller.outputs[-1] == 0.375
+        assert not remote.timedOut
+
+    runConnected(test)
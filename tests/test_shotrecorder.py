@@ -0,0 +1,49 @@
+from shotrecorder import ShotRecorder, listSegments, loadSegment, SEGMENT_IDLE, SEGMENT_SHOT
+from telemetrysample import TelemetrySample
+
+
+def sample(timestamp: float, number: int, brew: bool = False) -> TelemetrySample:
+    return TelemetrySample(timestamp, number, 93.0 + number * 0.1, 94.0, 0.5, 0.0, brew, False)
+
+
+def testShotStartsAndEndsOnTheFirstAppendAtOrAfterTheBoundary(tmp_path):
+    recorder = ShotRecorder(str(tmp_path), batchSize=1)
+    recorder.append(sample(100.0, 0))
+    recorder.startShot(100.25)
+    recorder.append(sample(100.5, 1, True))
+    recorder.append(sample(101.0, 2, True))
+    recorder.endShot(101.25)
+    recorder.append(sample(101.5, 3))
+    recorder.close()
+
+    segments = listSegments(str(tmp_path))
+    assert [(start, kind) for start, kind, path in segments] == [
+        (100000, SEGMENT_IDLE), (100250, SEGMENT_SHOT), (101250, SEGMENT_IDLE)]
+    assert [len(loadSegment(path)) for start, kind, path in segments] == [1, 2, 1]
+
+
+def testShotStartedAndEndedBetweenTwoAppendsIsKept(tmp_path):
+    recorder = ShotRecorder(str(tmp_path), batchSize=1)
+    recorder.append(sample(100.0, 0))
+    recorder.startShot(100.1)
+    recorder.endShot(100.3)
+    recorder.append(sample(100.5, 1))
+    recorder.close()
+
+    segments = listSegments(str(tmp_path))
+    assert [(start, kind) for start, kind, path in segments] == [
+        (100000, SEGMENT_IDLE), (100100, SEGMENT_SHOT), (100300, SEGMENT_IDLE)]
+    assert len(loadSegment(segments[1][2])) == 0
+    assert list(loadSegment(segments[2][2])["ts"]) == [100.5]
+
+
+def testBoundaryAfterTheSampleWaitsForALaterAppend(tmp_path):
+    recorder = ShotRecorder(str(tmp_path), batchSize=1)
+    recorder.startShot(100.75)
+    recorder.append(sample(100.5, 0))
+    recorder.append(sample(101.0, 1, True))
+    recorder.close()
+
+    segments = listSegments(str(tmp_path))
+    assert [(start, kind) for start, kind, path in segments] == [(100500, SEGMENT_IDLE), (100750, SEGMENT_SHOT)]
+    assert list(loadSegment(segments[1][2])["ts"]) == [101.0]
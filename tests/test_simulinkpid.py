@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+import simulinkpid
+
+GAINS = (0.046, 0.0018, -0.0030, 3.168544, 1.0, 0.0)
+ERRORS = [60.0, 60.0, 5.0, -2.0, 0.5, -30.0]
+
+
+def ctypesPid():
+    try:
+        return simulinkpid.CtypesDiscretePid(*GAINS)
+    except OSError:
+        pytest.skip("DiscretePid.so is not built")
+
+
+def nativePid():
+    if (simulinkpid.NativeDiscretePid == None):
+        pytest.skip("The _pidcontroller extension is not built")
+    return simulinkpid.NativeDiscretePid(*GAINS)
+
+
+@pytest.mark.parametrize("createPid", [ctypesPid, nativePid], ids=["ctypes", "native"])
+@pytest.mark.parametrize("sampleTime", [0.5, np.float64(0.5), np.float32(0.5), np.array([0.5])[0]],
+                         ids=["float", "float64", "float32", "element"])
+def testStepManyAcceptsAnyScalarSampleTime(createPid, sampleTime):
+    expected = createPid().step_many(ERRORS, [0.5] * len(ERRORS))
+    assert createPid().step_many(ERRORS, sampleTime) == expected
+    assert createPid().step_many(np.array(ERRORS), sampleTime) == expected
+
+
+@pytest.mark.parametrize("createPid", [ctypesPid, nativePid], ids=["ctypes", "native"])
+def testStepManyWithOneSampleTimePerStep(createPid):
+    sampleTimes = np.linspace(0.45, 0.55, len(ERRORS))
+    pid = createPid()
+    expected = [pid.step(error, float(sampleTime)) for error, sampleTime in zip(ERRORS, sampleTimes)]
+    assert createPid().step_many(ERRORS, sampleTimes) == expected
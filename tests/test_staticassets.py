@@ -0,0 +1,144 @@
+import gzip
+import os
+import pytest
+from staticassets import (StaticAssets, parseAcceptEncoding, IMMUTABLE_CACHE_CONTROL, REVALIDATE_CACHE_CONTROL,
+                          MEMORY_LIMIT, DEFAULT_CACHE_DIRECTORY)
+
+INDEX = b"<!doctype html><html><body>" + b"<div class=\"shot\">espresso</div>" * 200 + b"</body></html>"
+SCRIPT = b"const shots = [];\n" * 300
+
+
+def request(app, path: str, method: str = "GET", **headers):
+    environ = {"PATH_INFO": path, "REQUEST_METHOD": method}
+    environ.update({"HTTP_" + key.upper(): value for key, value in headers.items()})
+    response = {}
+
+    def start_response(status, responseHeaders):
+        response["status"] = status
+        response["headers"] = dict(responseHeaders)
+
+    body = b"".join(app(environ, start_response))
+    return response["status"], response["headers"], body
+
+
+@pytest.fixture
+def root(tmp_path):
+    (tmp_path / "index.html").write_bytes(INDEX)
+    (tmp_path / "static").mkdir()
+    (tmp_path / "static" / "main.3f9a0b1c.js").write_bytes(SCRIPT)
+    (tmp_path / "favicon.png").write_bytes(os.urandom(2048))
+    (tmp_path / "robots.txt").write_bytes(b"User-agent: *\n")
+    return tmp_path
+
+
+def testIndexIsServedAtTheRoot(root):
+    app = StaticAssets(str(root), compressInBackground=False)
+    status, headers, body = request(app, "/")
+    assert status == "200 OK"
+    assert body == INDEX
+    assert headers["Content-Type"] == "text/html; charset=utf-8"
+    assert headers["Content-Length"] == str(len(INDEX))
+
+
+def testMatchingETagIsNotModified(root):
+    app = StaticAssets(str(root), compressInBackground=False)
+    status, headers, body = request(app, "/index.html")
+    etag = headers["ETag"]
+    assert request(app, "/index.html", if_none_match=etag)[0] == "304 Not Modified"
+    # Weak comparison, and the tag of any encoding matches
+    assert request(app, "/index.html", if_none_match="W/" + etag)[0] == "304 Not Modified"
+    gzipTag = request(app, "/index.html", accept_encoding="gzip")[1]["ETag"]
+    assert gzipTag != etag
+    status, headers, body = request(app, "/index.html", if_none_match=gzipTag)
+    assert status == "304 Not Modified" and body == b""
+    assert headers["ETag"] == etag
+    assert request(app, "/index.html", if_none_match='"0123456789abcdef0123"')[0] == "200 OK"
+
+
+def testIfModifiedSince(root):
+    app = StaticAssets(str(root), compressInBackground=False)
+    lastModified = request(app, "/robots.txt")[1]["Last-Modified"]
+    assert request(app, "/robots.txt", if_modified_since=lastModified)[0] == "304 Not Modified"
+    assert request(app, "/robots.txt", if_modified_since="Thu, 01 Jan 1970 00:00:00 GMT")[0] == "200 OK"
+    assert request(app, "/robots.txt", if_modified_since="yesterday")[0] == "200 OK"
+
+
+def testOnlyHashedNamesAreImmutable(root):
+    app = StaticAssets(str(root), compressInBackground=False)
+    assert request(app, "/static/main.3f9a0b1c.js")[1]["Cache-Control"] == IMMUTABLE_CACHE_CONTROL
+    assert request(app, "/index.html")[1]["Cache-Control"] == REVALIDATE_CACHE_CONTROL
+    assert request(app, "/robots.txt")[1]["Cache-Control"] == REVALIDATE_CACHE_CONTROL
+
+
+def testGzipVariantIsSelectedByAcceptEncoding(root):
+    app = StaticAssets(str(root), compressInBackground=False)
+    status, headers, body = request(app, "/static/main.3f9a0b1c.js", accept_encoding="gzip, deflate")
+    assert headers["Content-Encoding"] == "gzip"
+    assert headers["Vary"] == "Accept-Encoding"
+    assert int(headers["Content-Length"]) == len(body) < len(SCRIPT)
+    assert gzip.decompress(body) == SCRIPT
+
+    for acceptEncoding in ["", "identity", "gzip;q=0", "deflate"]:
+        status, headers, body = request(app, "/static/main.3f9a0b1c.js", accept_encoding=acceptEncoding)
+        assert "Content-Encoding" not in headers
+        assert body == SCRIPT
+
+
+def testSmallAndIncompressibleFilesAreNeverCompressed(root):
+    app = StaticAssets(str(root), compressInBackground=False)
+    for path in ["/robots.txt", "/favicon.png"]:
+        headers = request(app, path, accept_encoding="gzip")[1]
+        assert "Content-Encoding" not in headers
+        assert "Vary" not in headers
+
+
+def testCompressedVariantsAreCachedByContentHash(root):
+    StaticAssets(str(root), compressInBackground=False)
+    cacheDirectory = root / DEFAULT_CACHE_DIRECTORY
+    cached = sorted(os.listdir(cacheDirectory))
+    assert len([name for name in cached if name.endswith(".gzip")]) == 2
+    # The cache directory itself is not served
+    app = StaticAssets(str(root), compressInBackground=False)
+    assert sorted(os.listdir(cacheDirectory)) == cached
+    assert request(app, f"/{DEFAULT_CACHE_DIRECTORY}/{cached[0]}")[0] == "404 Not Found"
+
+    # Changed content gets a new tag, the stale cache file is removed
+    (root / "index.html").write_bytes(INDEX + b"<!-- v2 -->")
+    StaticAssets(str(root), compressInBackground=False)
+    assert len(set(os.listdir(cacheDirectory)) - set(cached)) >= 1
+    assert len(set(cached) - set(os.listdir(cacheDirectory))) >= 1
+
+
+def testLargeFilesAreStreamed(root):
+    data = b"".join(b"%08d sample\n" % i for i in range(MEMORY_LIMIT // 16 + 1000))
+    (root / "history.txt").write_bytes(data)
+    app = StaticAssets(str(root), compressInBackground=False)
+    environ = {"PATH_INFO": "/history.txt", "REQUEST_METHOD": "GET"}
+    chunks = list(app(environ, lambda status, headers: None))
+    assert len(chunks) > 1
+    assert b"".join(chunks) == data
+
+
+def testHeadAndOtherMethods(root):
+    app = StaticAssets(str(root), compressInBackground=False)
+    status, headers, body = request(app, "/index.html", method="HEAD")
+    assert status == "200 OK" and body == b""
+    assert headers["Content-Length"] == str(len(INDEX))
+    assert request(app, "/index.html", method="POST")[0] == "405 Method Not Allowed"
+
+
+def testUnknownPathsGoToTheFallback(root):
+    def fallback(environ, start_response):
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return [b"metrics"]
+
+    assert request(StaticAssets(str(root), fallback, compressInBackground=False), "/metrics")[2] == b"metrics"
+    assert request(StaticAssets(str(root), compressInBackground=False), "/metrics")[0] == "404 Not Found"
+
+
+def testAcceptEncodingParsing():
+    assert parseAcceptEncoding("gzip, deflate") == ("gzip",)
+    assert parseAcceptEncoding("GZIP;q=0.5") == ("gzip",)
+    assert parseAcceptEncoding("gzip;q=0") == ()
+    assert parseAcceptEncoding("*;q=0.1, gzip;q=0") == ("br",)
+    assert parseAcceptEncoding("br;q=1, gzip;q=0.8") == ("br", "gzip")
@@ -0,0 +1,129 @@
+import asyncio
+import numpy as np
+from shotrecorder import listSegments, loadSegment, SEGMENT_IDLE, SEGMENT_SHOT
+from telemetryaggregator import SampleRing, MachineTelemetry, TelemetryAggregator
+from telemetryreceiver import SAMPLE_DTYPE, decodeDatagram
+from telemetrysample import TelemetrySample
+from udptelemetry import DATAGRAM_HEADER, SAMPLE_RECORD, packDatagramHeader, packSampleRecord
+
+
+class FakeClock():
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+def samples(numbers) -> np.ndarray:
+    ring = np.zeros(len(numbers), dtype=SAMPLE_DTYPE)
+    ring["sampleNumber"] = numbers
+    ring["timestamp"] = [number * 0.5 for number in numbers]
+    return ring
+
+
+def datagram(numbers: list, sequence: int, session: int = 1, brewing: set = frozenset()) -> bytes:
+    buffer = bytearray(DATAGRAM_HEADER.size + len(numbers) * SAMPLE_RECORD.size)
+    for i, number in enumerate(numbers):
+        sample = TelemetrySample(1700000000.0 + number * 0.5, number, 93.0, 94.0, 0.5, 0.0, number in brewing, False)
+        packSampleRecord(buffer, DATAGRAM_HEADER.size + i * SAMPLE_RECORD.size, sample)
+    packDatagramHeader(buffer, len(numbers), session, sequence)
+    return bytes(buffer)
+
+
+def testRingKeepsTheLatestSamplesAcrossTheWrap():
+    ring = SampleRing(5)
+    assert len(ring.latest(3)) == 0
+    ring.write(samples([1, 2, 3]))
+    assert ring.latest(10)["sampleNumber"].tolist() == [1, 2, 3]
+    ring.write(samples([4, 5, 6, 7]))
+    assert ring.latest(5)["sampleNumber"].tolist() == [3, 4, 5, 6, 7]
+    assert ring.latest(2)["sampleNumber"].tolist() == [6, 7]
+    assert len(ring.latest(0)) == 0 and len(ring.latest(-1)) == 0
+
+
+def testRingBurstLargerThanTheCapacity():
+    ring = SampleRing(5)
+    ring.write(samples([1, 2]))
+    ring.write(samples(list(range(3, 15))))
+    assert ring.writtenCount == 14
+    assert ring.latest(5)["sampleNumber"].tolist() == [10, 11, 12, 13, 14]
+    # The write position carries on after the burst
+    ring.write(samples([15]))
+    assert ring.latest(5)["sampleNumber"].tolist() == [11, 12, 13, 14, 15]
+
+
+def testLossIsTrackedPerMachine():
+    clock = FakeClock()
+    aggregator = TelemetryAggregator(names={"10.0.0.1": "kitchen"}, clock=clock)
+    aggregator.datagram_received(datagram([1, 2], 0), ("10.0.0.1", 7788))
+    aggregator.datagram_received(datagram([1, 2], 0), ("10.0.0.2", 7788))
+    # kitchen loses datagram 1 with samples 3 and 4, the other machine gets everything
+    aggregator.datagram_received(datagram([5, 6], 2), ("10.0.0.1", 7788))
+    aggregator.datagram_received(datagram([3, 4], 1), ("10.0.0.2", 7788))
+    aggregator.datagram_received(b"not telemetry", ("10.0.0.3", 7788))
+    assert aggregator.datagramCount == 4 and aggregator.invalidCount == 1
+    assert "10.0.0.3" not in aggregator.machines
+
+    kitchen = aggregator.findMachine("kitchen")
+    assert aggregator.findMachine("10.0.0.1") is kitchen
+    assert (kitchen.lossTracker.lostDatagramCount, kitchen.lossTracker.missingSampleCount) == (1, 2)
+    other = aggregator.findMachine("10.0.0.2")
+    assert (other.lossTracker.lostDatagramCount, other.lossTracker.missingSampleCount) == (0, 0)
+    assert other.ring.latest(4)["sampleNumber"].tolist() == [1, 2, 3, 4]
+
+    clock.now = 5.0
+    assert kitchen.describe(clock.now)["online"]
+    assert kitchen.describe(clock.now)["latest"]["seq"] == 6
+    clock.now = 30.0
+    assert not kitchen.describe(clock.now)["online"]
+
+
+def testSubscribersDropTheirOldestEventsWhenFull():
+    aggregator = TelemetryAggregator()
+    queue = asyncio.Queue(2)
+    aggregator.subscribers.append(queue)
+    for sequence in range(3):
+        aggregator.datagram_received(datagram([sequence], sequence), ("10.0.0.1", 7788))
+    assert aggregator.droppedEventCount == 1
+    assert b'"seq": 1' in queue.get_nowait()
+
+
+def testBrewSwitchSegmentsTheStoredShots(tmp_path):
+    machine = MachineTelemetry("kitchen", "10.0.0.1", 100, str(tmp_path))
+    # A shot over samples 3 to 6 spans two datagrams, a short one within datagram 3 starts and ends at once
+    machine.add(decodeDatagram(datagram([1, 2, 3, 4], 0, brewing={3, 4, 5, 6})), 0.0)
+    machine.add(decodeDatagram(datagram([5, 6, 7, 8], 1, brewing={3, 4, 5, 6})), 1.0)
+    machine.add(decodeDatagram(datagram([9, 10, 11, 12], 2, brewing={10})), 2.0)
+    machine.close()
+
+    segments = listSegments(str(tmp_path / "kitchen"))
+    assert [kind for start, kind, path in segments] == [SEGMENT_IDLE, SEGMENT_SHOT, SEGMENT_IDLE, SEGMENT_SHOT,
+                                                        SEGMENT_IDLE]
+    counts = [len(loadSegment(path)) for start, kind, path in segments]
+    assert counts == [2, 4, 3, 1, 2]
+    assert loadSegment(segments[1][2])["brew"].tolist() == [1, 1, 1, 1]
+
+
+def testManyMachinesUnderLoad():
+    """
+    Correctness at volume: 20 machines each send a minute of 2 Hz telemetry in one second batches, interleaved,
+    and every other machine loses one datagram. gaggiabenchmark.py aggregator measures the ingest cost.
+    """
+    machines = 20
+    aggregator = TelemetryAggregator(ringCapacity=100)
+    sent = 0
+    for sequence in range(60):
+        for machine in range(machines):
+            if (sequence % 50 == 49 and machine % 2 == 0):
+                continue
+            aggregator.datagram_received(datagram([sequence * 2, sequence * 2 + 1], sequence, session=machine + 1),
+                                         (f"10.0.1.{machine}", 7788))
+            sent += 1
+    assert aggregator.datagramCount == sent
+    for machine in range(machines):
+        tracker = aggregator.findMachine(f"10.0.1.{machine}").lossTracker
+        lost = 1 if machine % 2 == 0 else 0
+        assert (tracker.lostDatagramCount, tracker.missingSampleCount) == (lost, 2 * lost)
+        assert tracker.sampleCount == 120 - 2 * lost
+        assert aggregator.findMachine(f"10.0.1.{machine}").ring.latest(1)["sampleNumber"].tolist() == [119]
@@ -0,0 +1,156 @@
+import threading
+import pytest
+from telemetrybus import TelemetryBus, TelemetrySink, DROP_OLDEST, DROP_NEWEST
+from telemetrydecimator import TelemetryDecimator
+
+
+def testDropOldestKeepsTheNewestSamples():
+    delivered = []
+    sink = TelemetrySink("test", delivered.append, 3, DROP_OLDEST)
+    for i in range(5):
+        sink.offer(i)
+    sink.deliverQueued()
+    assert delivered == [2, 3, 4]
+    assert sink.droppedCount == 2
+    assert sink.deliveredCount == 3
+
+
+def testDropNewestKeepsTheOldestSamples():
+    delivered = []
+    sink = TelemetrySink("test", delivered.append, 3, DROP_NEWEST)
+    for i in range(5):
+        sink.offer(i)
+    sink.deliverQueued()
+    assert delivered == [0, 1, 2]
+    assert sink.droppedCount == 2
+
+
+def testUnknownDropPolicy():
+    with pytest.raises(ValueError):
+        TelemetrySink("test", print, 3, "drop_random")
+
+
+def testFailingHandlerIsCountedAndDoesNotStopDelivery():
+    delivered = []
+
+    def handler(sample):
+        if (sample == 1):
+            raise RuntimeError("broken")
+        delivered.append(sample)
+
+    sink = TelemetrySink("test", handler)
+    for i in range(3):
+        sink.offer(i)
+    sink.deliverQueued()
+    assert delivered == [0, 2]
+    assert sink.errorCount == 1
+
+
+def testPublishBeforeStartDeliversSynchronously():
+    bus = TelemetryBus()
+    first = []
+    second = []
+    bus.addSink("first", first.append)
+    bus.addSink("second", second.append)
+    bus.publish(1)
+    assert first == [1] and second == [1]
+    bus.publish(2)
+    assert first == [1, 2] and second == [1, 2]
+    assert bus.publishedCount == 2
+    assert bus.droppedCount == 0
+
+
+def testSlowSinkOnlyFillsItsOwnQueue():
+    bus = TelemetryBus()
+    blocked = threading.Event()
+    release = threading.Event()
+    slow = []
+    fast = []
+    bus.addSink("slow", lambda sample: (blocked.set(), release.wait(), slow.append(sample)), 4, DROP_OLDEST)
+    fastSink = bus.addSink("fast", fast.append, 4, DROP_OLDEST)
+    bus.start()
+    try:
+        for i in range(20):
+            bus.publish(i)
+            if (i == 0):
+                assert blocked.wait(5)
+            # Give the fast sink time to keep up, the slow one is stuck on its first sample
+            for attempt in range(1000):
+                if (len(fast) == i + 1):
+                    break
+                threading.Event().wait(0.001)
+        assert fast == list(range(20))
+        assert fastSink.droppedCount == 0
+        stats = bus.getStats()
+        assert stats["slow"]["dropped"] > 0
+    finally:
+        release.set()
+        bus.stop()
+    # The slow sink got its first sample and the newest ones that fit its queue
+    assert slow[0] == 0
+    assert slow[-4:] == [16, 17, 18, 19]
+
+
+def testStopDeliversEverythingPublished():
+    bus = TelemetryBus()
+    delivered = []
+    bus.addSink("slow", lambda sample: (threading.Event().wait(0.001), delivered.append(sample)), 128)
+    bus.start()
+    for i in range(100):
+        bus.publish(i)
+    bus.stop()
+    assert delivered == list(range(100))
+    assert bus.droppedCount == 0
+    # Once stopped the bus goes back to synchronous delivery
+    bus.publish(100)
+    assert delivered[-1] == 100
+
+
+class StallingDecimator(TelemetryDecimator):
+    """
+    Holds the dispatcher thread inside the sink's offer() of the first sample until released
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.stalled = threading.Event()
+        self.release = threading.Event()
+
+    def update(self, sample):
+        if (not self.stalled.is_set()):
+            self.stalled.set()
+            self.release.wait()
+        return [sample]
+
+
+def testSamplesPublishedWhileTheDispatcherIsStalledAreCounted():
+    bus = TelemetryBus(maxPending=8)
+    decimator = StallingDecimator()
+    delivered = []
+    udp = bus.addSink("udp", delivered.append, 4, DROP_OLDEST, decimator)
+    bus.start()
+    try:
+        bus.publish(0)
+        assert decimator.stalled.wait(5)
+        for i in range(1, 21):
+            bus.publish(i)
+        # The pending deque keeps the newest 8, every sample it evicted is counted
+        assert bus.droppedCount == 12
+    finally:
+        decimator.release.set()
+        bus.stop()
+    # The sink queue keeps the newest of what the dispatcher hands over in one go, the rest is counted too
+    assert delivered[-4:] == [17, 18, 19, 20]
+    assert len(delivered) + udp.droppedCount + bus.droppedCount == bus.publishedCount == 21
+    assert bus.getStats()["udp"]["dropped"] == udp.droppedCount
+
+
+def testPollRunsOnTheSinkThreadWithoutSamples():
+    bus = TelemetryBus()
+    polled = threading.Event()
+    bus.addSink("udp", print, poll=polled.set, pollInterval=0.01)
+    bus.start()
+    try:
+        assert polled.wait(5)
+    finally:
+        bus.stop()
@@ -0,0 +1,86 @@
+import pytest
+from telemetrycodec import (encodeTelemetryBlock, decodeTelemetryBlock, appendVarint, readVarint, TelemetryStreamEncoder,
+                            TelemetryStreamDecoder, BLOCK_KEYFRAME, BLOCK_DELTA)
+
+
+def liveRecords(count: int) -> list:
+    return [{"ts": 1700000000000 + i * 500, "temp": round(93.5 + (i % 7) * 0.13 - (i % 3) * 0.41, 2),
+             "set": 94.0, "shotdur": round(i * 0.5, 1), "seq": 1000 + i} for i in range(count)]
+
+
+def testRoundTripRestoresEveryField():
+    records = liveRecords(50)
+    assert decodeTelemetryBlock(encodeTelemetryBlock(records)) == records
+
+
+def testRoundTripWithNegativeDeltasAndGaps():
+    records = [{"ts": 5000, "temp": 150.25, "set": 150.0, "shotdur": 12.3, "seq": 9},
+               {"ts": 4000, "temp": -3.5, "set": 94.0, "shotdur": 0.0, "seq": 2},
+               {"ts": 90000000000000, "temp": 0.01, "set": 0.0, "shotdur": 45.0, "seq": 2 ** 40}]
+    assert decodeTelemetryBlock(encodeTelemetryBlock(records)) == records
+
+
+def testEmptyBlock():
+    assert decodeTelemetryBlock(encodeTelemetryBlock([])) == []
+
+
+def testLiveSamplesAreSmall():
+    records = liveRecords(30)
+    # The first record carries the absolute values, the rest only small deltas
+    assert len(encodeTelemetryBlock(records)) < 30 * 10
+
+
+def testVarintRoundTrip():
+    block = bytearray()
+    values = [0, 1, 127, 128, 300, 2 ** 35 + 5]
+    for value in values:
+        appendVarint(block, value)
+    offset = 0
+    for value in values:
+        decoded, offset = readVarint(block, offset)
+        assert decoded == value
+    assert offset == len(block)
+
+
+def testUnknownVersionIsRejected():
+    with pytest.raises(ValueError):
+        decodeTelemetryBlock(bytes([99, 0]))
+
+
+def testStreamContinuesFromThePreviousBlock():
+    records = liveRecords(40)
+    encoder = TelemetryStreamEncoder()
+    decoder = TelemetryStreamDecoder()
+    blocks = [encoder.encode([record]) for record in records]
+    assert blocks[0][0] == BLOCK_KEYFRAME
+    assert all(block[0] == BLOCK_DELTA for block in blocks[1:])
+    assert [decoder.decode(block)[0] for block in blocks] == records
+    # Without the absolute timestamp and sequence number a live sample shrinks from 16 to 8 or 9 bytes
+    assert max(len(block) for block in blocks[1:]) <= 9
+
+
+def testResetSendsAKeyframeAJoiningClientCanStartFrom():
+    records = liveRecords(10)
+    encoder = TelemetryStreamEncoder()
+    listening = TelemetryStreamDecoder()
+    for record in records[:5]:
+        listening.decode(encoder.encode([record]))
+    encoder.reset()
+    joined = TelemetryStreamDecoder()
+    keyframe = encoder.encode(records[5:7])
+    assert keyframe[0] == BLOCK_KEYFRAME
+    assert decodeTelemetryBlock(keyframe) == records[5:7]
+    assert joined.decode(keyframe) == listening.decode(keyframe) == records[5:7]
+    delta = encoder.encode(records[7:])
+    assert joined.decode(delta) == listening.decode(delta) == records[7:]
+
+
+def testDeltaBlockWithoutKeyframeIsRejected():
+    encoder = TelemetryStreamEncoder()
+    records = liveRecords(2)
+    encoder.encode(records[:1])
+    delta = encoder.encode(records[1:])
+    with pytest.raises(ValueError):
+        TelemetryStreamDecoder().decode(delta)
+    with pytest.raises(ValueError):
+        decodeTelemetryBlock(delta)
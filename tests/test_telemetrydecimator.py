@@ -0,0 +1,51 @@
+import pytest
+from telemetrydecimator import TelemetryDecimator, DECIMATE_FULL, DECIMATE_AVERAGE, DECIMATE_MINMAX, \
+    DECIMATE_ONCHANGE
+from telemetrysample import TelemetrySample
+
+
+def samples(temperatures: list, brewing: list = None) -> list:
+    brewing = brewing if brewing != None else [False] * len(temperatures)
+    return [TelemetrySample(100.0 + i * 0.5, i + 1, temperature, 94.0, 0.1 * i, 0.0, brew, False)
+            for i, (temperature, brew) in enumerate(zip(temperatures, brewing))]
+
+
+def run(decimator: TelemetryDecimator, inputs: list) -> list:
+    return [passed for sample in inputs for passed in decimator.update(sample)]
+
+
+def testFullPassesEverySample():
+    inputs = samples([90.0, 91.0, 92.0])
+    assert run(TelemetryDecimator(DECIMATE_FULL), inputs) == inputs
+
+
+def testAverageReportsTheMeanAtTheNewestSample():
+    passed = run(TelemetryDecimator(DECIMATE_AVERAGE, factor=2), samples([90.0, 92.0, 94.0, 96.0, 98.0]))
+    assert [s.sampleNumber for s in passed] == [2, 4]
+    assert [s.temperature for s in passed] == [91.0, 95.0]
+    assert passed[0].output == pytest.approx(0.05)
+
+
+def testMinMaxKeepsPeaksInTimeOrder():
+    inputs = samples([93.0, 99.0, 92.0, 94.0, 95.0, 95.0, 95.0, 95.0])
+    passed = run(TelemetryDecimator(DECIMATE_MINMAX, factor=2), inputs)
+    assert [s.temperature for s in passed] == [99.0, 92.0, 95.0]
+
+
+def testOnChangeSkipsSmallMovesAndSendsHeartbeats():
+    inputs = samples([90.0, 90.1, 90.15, 90.3, 90.3] + [90.3] * 20)
+    passed = run(TelemetryDecimator(DECIMATE_ONCHANGE, heartbeatInterval=5.0), inputs)
+    assert [s.sampleNumber for s in passed] == [1, 4, 14, 24]
+
+
+def testEverySampleWhileBrewingAndNothingHeldBack():
+    inputs = samples([90.0, 91.0, 92.0, 88.0, 87.0, 89.0], brewing=[False, False, False, True, True, False])
+    passed = run(TelemetryDecimator(DECIMATE_AVERAGE, factor=4), inputs)
+    # The partial window is closed when the shot starts
+    assert [s.sampleNumber for s in passed] == [3, 4, 5]
+    assert passed[0].temperature == 91.0
+
+
+def testUnknownModeIsRejected():
+    with pytest.raises(ValueError):
+        TelemetryDecimator("every-third")
@@ -0,0 +1,67 @@
+import numpy as np
+from shotrecorder import ShotRecorder
+from telemetryquery import TelemetryHistory, lttbIndices, minMaxIndices, METHOD_MINMAX
+from telemetrysample import TelemetrySample
+
+
+def spikySignal(count: int = 1000):
+    x = np.arange(count, dtype=float)
+    y = np.sin(x / 50.0)
+    y[437] = 5.0
+    y[812] = -4.0
+    return x, y
+
+
+def testLttbKeepsEndpointsAndPeaks():
+    x, y = spikySignal()
+    indices = lttbIndices(x, y, 50)
+    assert len(indices) == 50
+    assert indices[0] == 0 and indices[-1] == len(x) - 1
+    assert np.all(np.diff(indices) > 0)
+    assert 437 in indices and 812 in indices
+
+
+def testLttbReturnsEverythingBelowThreshold():
+    x = np.arange(20, dtype=float)
+    assert np.array_equal(lttbIndices(x, np.sin(x), 50), np.arange(20))
+
+
+def testMinMaxKeepsExtremesWithinBudget():
+    x, y = spikySignal()
+    indices = minMaxIndices(y, 40)
+    assert len(indices) <= 40
+    assert np.all(np.diff(indices) > 0)
+    assert 437 in indices and 812 in indices
+
+
+def recordShot(directory: str, start: float, count: int):
+    recorder = ShotRecorder(directory, batchSize=7)
+    recorder.startShot(start)
+    for i in range(count):
+        timestamp = start + i * 0.5
+        recorder.append(TelemetrySample(timestamp, i, 90.0 + np.sin(i / 10.0), 94.0, 0.3, i * 0.5, True, False))
+    recorder.endShot(start + count * 0.5)
+    recorder.append(TelemetrySample(start + count * 0.5, count, 93.0, 94.0, 0.1, 0.0, False, False))
+    recorder.close()
+
+
+def testQueryDownsamplesRecordedSegments(tmp_path):
+    recordShot(str(tmp_path), 1000.0, 400)
+    history = TelemetryHistory(str(tmp_path))
+    assert history.listShots()[0]["start"] == 1000000
+    result = history.query(1000000, 1100000, 30)
+    assert len(result) == 30
+    assert result[0]["ts"] == 1000000
+    assert all(a["ts"] < b["ts"] for a, b in zip(result, result[1:]))
+    inner = history.query(1050000, 1060000, 1000, METHOD_MINMAX)
+    assert len(inner) == 21
+    assert all(1050000 <= record["ts"] <= 1060000 for record in inner)
+
+
+def testQueryResultIsCachedUntilTheSegmentGrows(tmp_path):
+    recordShot(str(tmp_path), 1000.0, 100)
+    history = TelemetryHistory(str(tmp_path))
+    first = history.query(0, 2000000, 500)
+    assert history.query(0, 2000000, 500) is first
+    recordShot(str(tmp_path), 1100.0, 10)
+    assert len(history.query(0, 2000000, 500)) == len(first) + 11
@@ -0,0 +1,180 @@
+import socket
+import time
+import numpy as np
+import pytest
+from telemetryreceiver import LossTracker, TelemetryDatagram, decodeDatagram, SAMPLE_DTYPE
+from telemetrybus import TelemetryBus
+from telemetrysample import TelemetrySample, UDP_PACKET
+from udptelemetry import UdpTelemetrySender, DATAGRAM_HEADER, SAMPLE_RECORD, MAX_BATCH_SIZE, MAX_DATAGRAM_SIZE, \
+    PROTOCOL_BATCHED, PROTOCOL_LEGACY, PROTOCOL_MAGIC, PROTOCOL_VERSION, packDatagramHeader, packSampleRecord, \
+    parseAddress
+
+
+class FakeClock():
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+def sample(number: int) -> TelemetrySample:
+    return TelemetrySample(1700000000.0 + number * 0.5, number, 90.0 + number * 0.25, 94.0, 0.5, number * 0.5,
+                           number % 2 == 0, False)
+
+
+def datagram(numbers: list, session: int = 7, sequence: int = 0) -> bytearray:
+    buffer = bytearray(DATAGRAM_HEADER.size + len(numbers) * SAMPLE_RECORD.size)
+    for i, number in enumerate(numbers):
+        packSampleRecord(buffer, DATAGRAM_HEADER.size + i * SAMPLE_RECORD.size, sample(number))
+    packDatagramHeader(buffer, len(numbers), session, sequence)
+    return buffer
+
+
+def testDecodeViewsTheDatagramWithoutCopying():
+    data = datagram([1, 2, 3], session=42, sequence=9)
+    decoded = decodeDatagram(data)
+    assert (decoded.session, decoded.sequence) == (42, 9)
+    assert decoded.samples.dtype == SAMPLE_DTYPE
+    assert decoded.samples["sampleNumber"].tolist() == [1, 2, 3]
+    assert decoded.samples["temperature"].tolist() == [90.25, 90.5, 90.75]
+    assert decoded.samples["brewSwitch"].tolist() == [0, 1, 0]
+    assert np.shares_memory(decoded.samples, np.frombuffer(data, dtype=np.uint8))
+
+
+def testDecodeSkipsFieldsAppendedByNewerSenders():
+    recordSize = SAMPLE_RECORD.size + 8
+    data = bytearray(DATAGRAM_HEADER.size + 2 * recordSize)
+    for i in range(2):
+        packSampleRecord(data, DATAGRAM_HEADER.size + i * recordSize, sample(i + 5))
+    DATAGRAM_HEADER.pack_into(data, 0, PROTOCOL_MAGIC, PROTOCOL_VERSION, recordSize, 2, 1, 0)
+    assert decodeDatagram(data).samples["sampleNumber"].tolist() == [5, 6]
+
+
+@pytest.mark.parametrize("data", [b"", b"GT", bytes(DATAGRAM_HEADER.size), datagram([1, 2])[:-1],
+                                  b"XX" + bytes(datagram([1]))[2:], bytes(UDP_PACKET.size)])
+def testDecodeRejectsForeignOrTruncatedData(data):
+    with pytest.raises(ValueError):
+        decodeDatagram(data)
+
+
+def testLossTrackerCountsLostDatagramsAndSamples():
+    tracker = LossTracker()
+    tracker.track(decodeDatagram(datagram([1, 2], sequence=0)))
+    tracker.track(decodeDatagram(datagram([3, 5], sequence=1)))
+    # Datagram 2 with samples 6 and 7 is lost
+    tracker.track(decodeDatagram(datagram([8], sequence=3)))
+    tracker.track(decodeDatagram(datagram([], sequence=4)))
+    stats = tracker.getStats()
+    assert stats["datagrams"] == 4 and stats["samples"] == 5
+    assert stats["lostDatagrams"] == 1
+    assert stats["missingSamples"] == 3
+
+
+def testLossTrackerHandlesWraparoundReorderingAndRestarts():
+    tracker = LossTracker()
+    tracker.track(decodeDatagram(datagram([1], sequence=0xFFFFFFFF)))
+    tracker.track(decodeDatagram(datagram([2], sequence=0)))
+    assert tracker.lostDatagramCount == 0
+    tracker.track(TelemetryDatagram(7, 0xFFFFFFFE, np.zeros(0, dtype=SAMPLE_DTYPE)))
+    assert tracker.reorderedCount == 1
+    tracker.track(decodeDatagram(datagram([1], session=8, sequence=0)))
+    assert tracker.restartCount == 1 and tracker.lostDatagramCount == 0 and tracker.missingSampleCount == 0
+
+
+@pytest.fixture
+def receiver():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.settimeout(1.0)
+    yield sock
+    sock.close()
+
+
+def receiveAll(sock: socket.socket) -> list:
+    datagrams = []
+    sock.settimeout(0.2)
+    try:
+        while True:
+            datagrams.append(sock.recv(MAX_DATAGRAM_SIZE))
+    except socket.timeout:
+        return datagrams
+
+
+def testSenderBatchesUntilTheIntervalWouldBeExceeded(receiver):
+    clock = FakeClock()
+    sender = UdpTelemetrySender([receiver.getsockname()], PROTOCOL_BATCHED, batchInterval=1.0, clock=clock)
+    for number in range(1, 6):
+        sender.send(sample(number))
+        clock.now += 0.5
+    sender.close()
+    decoded = [decodeDatagram(data) for data in receiveAll(receiver)]
+    # Two samples half a second apart fill a one second batch, the last one is sent by close()
+    assert [d.samples["sampleNumber"].tolist() for d in decoded] == [[1, 2], [3, 4], [5]]
+    assert [d.sequence for d in decoded] == [0, 1, 2]
+    assert len({d.session for d in decoded}) == 1
+
+
+def testSenderSplitsLargeBatchesBelowTheMtu(receiver):
+    clock = FakeClock()
+    sender = UdpTelemetrySender([receiver.getsockname()], PROTOCOL_BATCHED, batchInterval=1000.0, clock=clock)
+    for number in range(MAX_BATCH_SIZE + 3):
+        sender.send(sample(number))
+        clock.now += 0.01
+    sender.close()
+    datagrams = receiveAll(receiver)
+    assert [len(data) <= MAX_DATAGRAM_SIZE for data in datagrams] == [True, True]
+    assert [len(decodeDatagram(data).samples) for data in datagrams] == [MAX_BATCH_SIZE, 3]
+
+
+def testPartialBatchIsFlushedOnceItHasWaitedTheBatchInterval(receiver):
+    clock = FakeClock()
+    sender = UdpTelemetrySender([receiver.getsockname()], PROTOCOL_BATCHED, batchInterval=1.0, clock=clock)
+    sender.send(sample(1))
+    clock.now += 0.1
+    # The next sample is expected after the same gap, so the batch keeps waiting for more
+    sender.send(sample(2))
+    clock.now += 0.5
+    sender.flushIfDue()
+    assert sender.datagramCount == 0
+    # The samples stop coming, the poll sends what is pending
+    clock.now += 0.4
+    sender.flushIfDue()
+    sender.flushIfDue()
+    assert [decodeDatagram(data).samples["sampleNumber"].tolist() for data in receiveAll(receiver)] == [[1, 2]]
+    sender.close()
+    assert receiveAll(receiver) == []
+
+
+def testBusSinkPollFlushesTheLastBatch(receiver):
+    sender = UdpTelemetrySender([receiver.getsockname()], PROTOCOL_BATCHED, batchInterval=0.2)
+    bus = TelemetryBus()
+    bus.addSink("udp", sender.send, poll=sender.flushIfDue, pollInterval=0.02)
+    bus.start()
+    started = time.monotonic()
+    try:
+        bus.publish(sample(1))
+        receiver.settimeout(2.0)
+        data = receiver.recv(MAX_DATAGRAM_SIZE)
+    finally:
+        bus.stop()
+        sender.close()
+    assert decodeDatagram(data).samples["sampleNumber"].tolist() == [1]
+    assert 0.2 <= time.monotonic() - started < 1.0
+
+
+def testLegacySenderSendsOnePacketPerSample(receiver):
+    sender = UdpTelemetrySender([receiver.getsockname()])
+    # Batched is opt-in, existing receivers of the Simulink layout keep working
+    assert sender.protocol == PROTOCOL_LEGACY
+    sender.send(sample(3))
+    sender.close()
+    datagrams = receiveAll(receiver)
+    assert len(datagrams) == 1
+    assert UDP_PACKET.unpack(datagrams[0])[:2] == (3, pytest.approx(90.75))
+
+
+def testParseAddress():
+    assert parseAddress("10.0.0.5") == ("10.0.0.5", 7788)
+    assert parseAddress("10.0.0.5:9000") == ("10.0.0.5", 9000)
+    assert parseAddress("logger.local", 1234) == ("logger.local", 1234)
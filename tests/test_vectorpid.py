@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+import simulinkpid
+from vectorpid import VectorPid
+
+GAINS = [(0.046, 0.0018, -0.0030, 3.168544), (0.08, 0.004, -0.01, 2.0), (0.02, 0.0, 0.0, 5.0), (0.5, 0.05, 0.02, 1.0)]
+SAMPLE_TIME = 0.5
+
+
+def scalarPid(gains: tuple):
+    try:
+        return simulinkpid.DiscretePid(*gains, 1.0, 0.0)
+    except OSError:
+        pytest.skip("Neither the _pidcontroller extension nor DiscretePid.so is built")
+
+
+def errorSequence(count: int, seed: int) -> np.ndarray:
+    # Large steps drive the controllers into both limits, so anti-windup is exercised too
+    rng = np.random.default_rng(seed)
+    return np.concatenate([np.full(20, 60.0), rng.normal(0.0, 3.0, count - 40), np.full(20, -30.0)])
+
+
+def testMatchesDiscretePidForEveryController():
+    errors = np.stack([errorSequence(200, seed) for seed in range(len(GAINS))], axis=1)
+    pids = [scalarPid(gains) for gains in GAINS]
+    p, i, d, n = (np.array(column) for column in zip(*GAINS))
+    vectorPid = VectorPid(p, i, d, n, 1.0, 0.0)
+    for stepErrors in errors:
+        expected = [pid.step(float(error), SAMPLE_TIME) for pid, error in zip(pids, stepErrors)]
+        np.testing.assert_allclose(vectorPid.step(stepErrors, SAMPLE_TIME), expected, rtol=1e-12, atol=1e-12)
+
+
+def testMatchesDiscretePidWithMeasuredSampleTimes():
+    errors = errorSequence(100, 7)
+    sampleTimes = np.random.default_rng(8).uniform(0.45, 0.55, len(errors))
+    pid = scalarPid(GAINS[0])
+    vectorPid = VectorPid(*GAINS[0], 1.0, 0.0)
+    for error, sampleTime in zip(errors, sampleTimes):
+        expected = pid.step(float(error), float(sampleTime))
+        assert vectorPid.step(error, sampleTime)[0] == pytest.approx(expected, rel=1e-12, abs=1e-12)
+
+
+def testOutputStaysWithinLimits():
+    vectorPid = VectorPid(0.5, 0.1, 0.0, 1.0, 0.8, 0.1, count=3)
+    for error in [100.0, 100.0, -100.0, -100.0, 0.0]:
+        output = vectorPid.step(np.full(3, error), SAMPLE_TIME)
+        assert np.all(output <= 0.8) and np.all(output >= 0.1)
+
+
+def testResetClearsOnlyTheGivenControllers():
+    vectorPid = VectorPid(0.05, 0.01, 0.0, 1.0, 1.0, 0.0, count=3)
+    vectorPid.step(np.array([5.0, 5.0, 5.0]), SAMPLE_TIME)
+    vectorPid.reset([1])
+    assert vectorPid.integratorState[1] == 0.0
+    assert vectorPid.integratorState[0] != 0.0 and vectorPid.integratorState[2] != 0.0
@@ -0,0 +1,128 @@
+import os
+import socket
+import struct
+import threading
+import time
+from telemetrysample import TelemetrySample, UDP_PACKET
+
+PROTOCOL_BATCHED = "batched"
+PROTOCOL_LEGACY = "legacy"
+UDP_PROTOCOLS = (PROTOCOL_BATCHED, PROTOCOL_LEGACY)
+
+PROTOCOL_MAGIC = b"GT"
+PROTOCOL_VERSION = 1
+# magic, version, record size, record count, session id, datagram sequence number
+DATAGRAM_HEADER = struct.Struct("<2sBBHxxII")
+# wall clock timestamp (s), sample number, temperature, setpoint, heater output, shot duration, brew switch,
+# steam switch. Receivers use the record size in the header, so later versions may append fields.
+SAMPLE_RECORD = struct.Struct("<dIffffBBxx")
+# Largest payload that is not fragmented on an Ethernet link
+MAX_DATAGRAM_SIZE = 1472
+MAX_BATCH_SIZE = (MAX_DATAGRAM_SIZE - DATAGRAM_HEADER.size) // SAMPLE_RECORD.size
+DEFAULT_BATCH_INTERVAL = 1.0
+# How often the sink thread checks for a batch that has waited batchInterval without a sample completing it
+FLUSH_POLL_INTERVAL = 0.1
+DEFAULT_PORT = 7788
+
+
+def packSampleRecord(buffer, offset: int, sample: TelemetrySample):
+    SAMPLE_RECORD.pack_into(buffer, offset, sample.timestamp, sample.sampleNumber, sample.temperature,
+                            sample.setpoint, sample.output, sample.shotDuration, sample.brewSwitch,
+                            sample.steamSwitch)
+
+
+def packDatagramHeader(buffer, count: int, session: int, sequence: int):
+    DATAGRAM_HEADER.pack_into(buffer, 0, PROTOCOL_MAGIC, PROTOCOL_VERSION, SAMPLE_RECORD.size, count, session,
+                              sequence)
+
+
+def parseAddress(address: str, defaultPort: int = DEFAULT_PORT) -> tuple:
+    """
+    "host" or "host:port" to a (host, port) address
+    """
+    host, separator, port = address.rpartition(":")
+    if (separator == "" or not port.isdigit()):
+        return (address, defaultPort)
+    return (host, int(port))
+
+
+class UdpTelemetrySender():
+    """
+    Sends telemetry samples to every subscriber address. With the batched protocol samples are collected
+    into one datagram until batchSize samples are pending or waiting for the next sample, expected after the
+    same gap as the last one, would hold the oldest pending sample for longer than batchInterval;
+    every datagram has a header with the protocol version, a random session id that changes with every
+    sender and a datagram sequence number, and every sample keeps its timestamp and sample number, so
+    receivers can detect lost datagrams and samples. The legacy protocol sends one UDP_PACKET per sample.
+    send() is meant to be the handler of a telemetry bus sink and flushIfDue() its poll, which sends a batch
+    whose next sample does not arrive in time.
+    """
+
+    def __init__(self, addresses: list, protocol: str = PROTOCOL_LEGACY, batchInterval: float = DEFAULT_BATCH_INTERVAL,
+                 batchSize: int = MAX_BATCH_SIZE, clock=time):
+        if (protocol not in UDP_PROTOCOLS):
+            raise ValueError(f"Unknown UDP telemetry protocol {protocol}")
+        self.addresses = list(addresses)
+        self.protocol = protocol
+        self.batchInterval = batchInterval
+        self.batchSize = max(1, min(MAX_BATCH_SIZE, int(batchSize)))
+        self.clock = clock
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.session = int.from_bytes(os.urandom(4), "little")
+        self.sequence = 0
+        self.batchCount = 0
+        self.batchStarted = 0.0
+        self.lastSampleTime = None
+        # Samples are packed straight into the datagram they will be sent in
+        self.datagram = bytearray(DATAGRAM_HEADER.size + self.batchSize * SAMPLE_RECORD.size)
+        self.legacyPacket = bytearray(UDP_PACKET.size)
+        self.lock = threading.Lock()
+        self.datagramCount = 0
+        self.sendErrorCount = 0
+
+    def send(self, sample: TelemetrySample):
+        with self.lock:
+            if (self.protocol == PROTOCOL_LEGACY):
+                sample.packUdpInto(self.legacyPacket)
+                self.__sendToAll(self.legacyPacket)
+                return
+            now = self.clock.monotonic()
+            gap = now - self.lastSampleTime if self.lastSampleTime != None else 0.0
+            self.lastSampleTime = now
+            if (self.batchCount == 0):
+                self.batchStarted = now
+            packSampleRecord(self.datagram, DATAGRAM_HEADER.size + self.batchCount * SAMPLE_RECORD.size, sample)
+            self.batchCount += 1
+            if (self.batchCount >= self.batchSize or now + gap - self.batchStarted >= self.batchInterval):
+                self.__flushBatch()
+
+    def flushIfDue(self):
+        with self.lock:
+            if (self.batchCount > 0 and self.clock.monotonic() - self.batchStarted >= self.batchInterval):
+                self.__flushBatch()
+
+    def flush(self):
+        with self.lock:
+            self.__flushBatch()
+
+    def close(self):
+        self.flush()
+        self.sock.close()
+
+    def __flushBatch(self):
+        if (self.batchCount == 0):
+            return
+        packDatagramHeader(self.datagram, self.batchCount, self.session, self.sequence)
+        self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+        length = DATAGRAM_HEADER.size + self.batchCount * SAMPLE_RECORD.size
+        self.batchCount = 0
+        self.__sendToAll(memoryview(self.datagram)[:length])
+
+    def __sendToAll(self, data):
+        # One unreachable subscriber must not cost the others their telemetry
+        for address in self.addresses:
+            try:
+                self.sock.sendto(data, address)
+                self.datagramCount += 1
+            except OSError:
+                self.sendErrorCount += 1
@@ -0,0 +1,84 @@
+import numpy as np
+
+
+class VectorPid():
+    """
+    Array-backed equivalent of simulinkpid.DiscretePid that steps N controllers per call.
+    Follows PIDController_step in CodegenPid/PIDController.c: parallel PID with a forward Euler
+    filtered derivative, output saturation and clamping anti-windup.
+    Gains and limits may be scalars or arrays of length N.
+    """
+
+    def __init__(self, pGains, iGains, dGains, filterCoeffs, upperLimits, lowerLimits, count: int = None) -> None:
+        if (count is None):
+            count = np.broadcast(np.asarray(pGains), np.asarray(iGains), np.asarray(dGains),
+                                 np.asarray(filterCoeffs), np.asarray(upperLimits), np.asarray(lowerLimits)).size
+        self.count = count
+        self.integratorState = np.zeros(count)
+        self.filterState = np.zeros(count)
+        self.output = np.zeros(count)
+        self.__nProdOut = np.empty(count)
+        self.__sum = np.empty(count)
+        self.__iProdOut = np.empty(count)
+        self.setGains(pGains, iGains, dGains,
+                      filterCoeffs, upperLimits, lowerLimits)
+
+    def setGains(self, pGains, iGains, dGains, filterCoeffs, upperLimits, lowerLimits):
+        shape = (self.count,)
+        self.pGains = np.broadcast_to(np.asarray(pGains, dtype=float), shape)
+        self.iGains = np.broadcast_to(np.asarray(iGains, dtype=float), shape)
+        self.dGains = np.broadcast_to(np.asarray(dGains, dtype=float), shape)
+        self.filterCoeffs = np.broadcast_to(
+            np.asarray(filterCoeffs, dtype=float), shape)
+        self.upperLimits = np.broadcast_to(
+            np.asarray(upperLimits, dtype=float), shape)
+        self.lowerLimits = np.broadcast_to(
+            np.asarray(lowerLimits, dtype=float), shape)
+
+    def reset(self, indices=None):
+        """
+        Clears integrator and filter states, for all controllers or only the given indices
+        """
+        if (indices is None):
+            indices = slice(None)
+        self.integratorState[indices] = 0.0
+        self.filterState[indices] = 0.0
+        self.output[indices] = 0.0
+
+    def getOutput(self) -> np.ndarray:
+        return self.output
+
+    def step(self, errors, sampleTime) -> np.ndarray:
+        """
+        Steps every controller once. errors and sampleTime may be scalars or arrays of length N.
+        Returns the output array, which is reused between calls.
+        """
+        nProdOut = self.__nProdOut
+        pidSum = self.__sum
+        iProdOut = self.__iProdOut
+
+        # Filtered derivative: (u*D - filterState) * N
+        np.multiply(errors, self.dGains, out=nProdOut)
+        np.subtract(nProdOut, self.filterState, out=nProdOut)
+        np.multiply(nProdOut, self.filterCoeffs, out=nProdOut)
+
+        # u*P + integratorState + derivative
+        np.multiply(errors, self.pGains, out=pidSum)
+        np.add(pidSum, self.integratorState, out=pidSum)
+        np.add(pidSum, nProdOut, out=pidSum)
+
+        # Output saturation, upper limit checked first like the generated code
+        np.maximum(pidSum, self.lowerLimits, out=self.output)
+        np.copyto(self.output, self.upperLimits,
+                  where=pidSum > self.upperLimits)
+
+        # Clamping: stop integrating while saturated and the integrator input pushes further into saturation
+        saturationExcess = pidSum - self.output
+        np.multiply(errors, self.iGains, out=iProdOut)
+        clamped = (saturationExcess != 0.0) & (
+            np.sign(saturationExcess) == np.sign(iProdOut))
+        iProdOut[clamped] = 0.0
+
+        self.integratorState += iProdOut * sampleTime
+        self.filterState += nProdOut * sampleTime
+        return self.output